@@ -0,0 +1,15 @@
+import pathlib
+import tempfile
+
+import pytest
+
+
+def pytest_addoption(parser):
+    parser.addoption("--synthetic-data-dir", type=pathlib.Path,
+                     default=pathlib.Path(tempfile.gettempdir()) / "co2sa1_benchmark_data",
+                     help="Where to keep the synthetic benchmark inputs, which take minutes to generate at 100x.")
+
+
+@pytest.fixture(scope="session")
+def synthetic_data_dir(request) -> pathlib.Path:
+    return request.config.getoption("--synthetic-data-dir")
@@ -0,0 +1,67 @@
+import tracemalloc
+from typing import Any, Callable, Optional, Tuple
+
+MIB = 1024 * 1024
+
+
+def trace_peak_memory(function: Callable[[], Any]) -> Tuple[Any, float]:
+    """
+    Runs a function under tracemalloc. tracemalloc sees pandas and numpy buffers, but not memory allocated by Arrow
+    while reading Parquet.
+
+    Parameters
+    ----------
+    function : Callable[[], Any]
+        The function to run.
+
+    Returns
+    -------
+    Tuple[Any, float]
+        The function's result and the peak traced memory in MiB.
+    """
+    tracemalloc.start()
+    try:
+        result = function()
+        _, peak_memory = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return result, peak_memory / MIB
+
+
+def benchmark_stage(benchmark,
+                    function: Callable[[], Any],
+                    rows_in: int,
+                    setup: Optional[Callable[[], None]] = None,
+                    rounds: int = 1) -> Any:
+    """
+    Times a stage with the pytest-benchmark fixture, then runs it once more under tracemalloc, since tracing
+    allocations slows the stage down too much to time it at the same time. The peak memory and row counts are stored in
+    benchmark.extra_info, so they are saved with the timings by --benchmark-save.
+
+    Parameters
+    ----------
+    benchmark : pytest_benchmark.fixture.BenchmarkFixture
+        The test's benchmark fixture.
+    function : Callable[[], Any]
+        The stage to run. Its result must have a length, reported as rows_out.
+    rows_in : int
+        The number of rows the stage reads, reported as rows_in.
+    setup : Optional[Callable[[], None]] = None
+        If given, runs before every run of the stage and is not measured. The stage is then timed for a fixed number
+        of rounds rather than calibrated by pytest-benchmark.
+    rounds : int = 1
+        The number of timed runs when setup is given.
+
+    Returns
+    -------
+    Any
+        The result of the stage.
+    """
+    if setup is None:
+        benchmark(function)
+    else:
+        benchmark.pedantic(function, setup=setup, rounds=rounds, iterations=1)
+        setup()
+    result, peak_memory_mib = trace_peak_memory(function)
+    benchmark.extra_info.update(rows_in=rows_in, rows_out=len(result), peak_memory_mib=peak_memory_mib)
+    return result
@@ -0,0 +1,313 @@
+import logging
+import math
+import pathlib
+from typing import List, NamedTuple
+
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+import shapely
+import xlsxwriter
+
+from emissions.initialise_co2_sa1s import FUEL_TYPES
+from mode_share.initialise_mode_share import SUPPRESSED_VALUE
+
+log = logging.getLogger(__name__)
+
+# The approximate size of one city, e.g. Christchurch, at a scale of 1
+CITY_SA1S = 3_000
+CITY_SA2S = 100
+# The national inputs also cover SA1s and SA2s outside the city, which the pipeline filters out
+OUTSIDE_CITY_RATIO = 0.5
+WORKPLACES_PER_SA2 = 40
+URBAN_AREA_NAME = "Synthetic City"
+URBAN_AREA_VERTICES = 1_000
+# EPSG:2193 (NZTM) coordinates near Christchurch, so grid cells can be laid out in metres
+CRS = 2193
+ORIGIN = (1_560_000, 5_170_000)
+SA1_CELL_SIZE = 300
+
+VEHICLE_CLASSES = ["Light Passenger Vehicle", "Light Commercial Vehicle", "Motorcycle"]
+# Vehicle types without a fuel type suffix, which split_vehicle_type assigns to Diesel
+OTHER_VEHICLE_TYPES = ["Heavy Truck", "Bus"]
+EMISSIONS_VARIABLES = ["VKT\n('000 km/Year)", "CO2\n(Tonnes/Year)"]
+MEANS_OF_TRAVEL_COLUMNS = [
+    "Work_at_home",
+    "Drive_a_private_car_truck_or_van",
+    "Drive_a_company_car_truck_or_van",
+    "Passenger_in_a_car_truck_van_or_company_bus",
+    "Public_bus",
+    "Train",
+    "Bicycle",
+    "Walk_or_jog",
+    "Ferry",
+    "Other",
+]
+
+
+class SyntheticGeographies(NamedTuple):
+    sa1s: gpd.GeoDataFrame
+    sa2s: gpd.GeoDataFrame
+    urban_rural: gpd.GeoDataFrame
+
+
+class SyntheticStatsNz:
+    """
+    Serves synthetic Stats NZ layers by id, as a stats_nz_geographies.VectorFetcher that never touches the network.
+    Like the Stats NZ layers, the SA1 and SA2 codes are returned as columns rather than the index.
+
+    Parameters
+    ----------
+    geographies : SyntheticGeographies
+        The layers to serve.
+    """
+    LAYER_IDS = {92210: "sa1s", 92212: "sa2s", 111198: "urban_rural"}
+
+    def __init__(self, geographies: SyntheticGeographies):
+        self.geographies = geographies
+
+    def run(self, layer: int) -> gpd.GeoDataFrame:
+        layer_gdf = getattr(self.geographies, self.LAYER_IDS[layer])
+        return layer_gdf.reset_index() if layer_gdf.index.name else layer_gdf.copy()
+
+
+def get_vehicle_types() -> List[str]:
+    return [f"{vehicle_class} {fuel_type}" for vehicle_class in VEHICLE_CLASSES for fuel_type in FUEL_TYPES] \
+        + OTHER_VEHICLE_TYPES
+
+
+def make_grid(num_cells: int, cell_size: float, first_id: int, id_column: str) -> gpd.GeoDataFrame:
+    """
+    Lays out square polygons in a square grid, starting at ORIGIN.
+
+    Parameters
+    ----------
+    num_cells : int
+        The number of polygons.
+    cell_size : float
+        The width of each polygon in metres.
+    first_id : int
+        The id of the first polygon, with ids increasing by one across each row of the grid.
+    id_column : str
+        The name of the id index.
+
+    Returns
+    -------
+    gpd.GeoDataFrame
+        The polygons indexed by id, in EPSG:2193.
+    """
+    columns = math.ceil(math.sqrt(num_cells))
+    cell_numbers = np.arange(num_cells)
+    min_x = ORIGIN[0] + (cell_numbers % columns) * cell_size
+    min_y = ORIGIN[1] + (cell_numbers // columns) * cell_size
+    geometry = shapely.box(min_x, min_y, min_x + cell_size, min_y + cell_size)
+    index = pd.Index(first_id + cell_numbers, name=id_column)
+    return gpd.GeoDataFrame(index=index, geometry=geometry, crs=CRS)
+
+
+def make_urban_area_polygon(extent: shapely.Polygon, area_fraction: float, rng: np.random.Generator) -> shapely.Polygon:
+    """
+    Creates a jagged urban area boundary in the middle of an extent, with as many vertices as a real urban area.
+
+    Parameters
+    ----------
+    extent : shapely.Polygon
+        The area covered by the synthetic SA1s.
+    area_fraction : float
+        The approximate fraction of the extent that the urban area covers.
+    rng : np.random.Generator
+        The random number generator.
+
+    Returns
+    -------
+    shapely.Polygon
+        The urban area boundary.
+    """
+    center = extent.centroid
+    mean_radius = math.sqrt(extent.area * area_fraction / math.pi)
+    angles = np.linspace(0, 2 * math.pi, URBAN_AREA_VERTICES, endpoint=False)
+    radii = mean_radius * (1 + rng.uniform(-0.1, 0.1, URBAN_AREA_VERTICES))
+    return shapely.Polygon(np.column_stack([center.x + radii * np.cos(angles), center.y + radii * np.sin(angles)]))
+
+
+def make_geographies(scale: float, seed: int = 0) -> SyntheticGeographies:
+    """
+    Creates SA1, SA2 and urban/rural area polygons shaped like the Stats NZ layers, for a city of the given scale
+    surrounded by rural areas.
+
+    Parameters
+    ----------
+    scale : float
+        The size of the city, relative to CITY_SA1S and CITY_SA2S.
+    seed : int = 0
+        Seeds the random number generator, so the same scale and seed give the same polygons.
+
+    Returns
+    -------
+    SyntheticGeographies
+        The SA1s indexed by SA12018_V1_00 and the SA2s by SA22018_V1_00, as int64 like after find_sa1s_in_area and
+        find_sa2s_in_area set their index, and the urban/rural areas with a UR2023_V1_00_NAME column.
+    """
+    rng = np.random.default_rng(seed)
+    city_fraction = 1 / (1 + OUTSIDE_CITY_RATIO)
+    num_sa1s = round(CITY_SA1S * scale / city_fraction)
+    num_sa2s = round(CITY_SA2S * scale / city_fraction)
+
+    sa1s = make_grid(num_sa1s, SA1_CELL_SIZE, 7_000_000, "SA12018_V1_00")
+    sa1s["LANDWATER_NAME"] = np.where(rng.random(num_sa1s) < 0.02, "Inland water", "Mainland")
+    sa1s["AREA_SQ_KM"] = sa1s.area / 1e6
+    extent = shapely.box(*sa1s.total_bounds)
+
+    # SA2s cover the same extent as the SA1s with larger cells
+    sa2_cell_size = (extent.bounds[2] - extent.bounds[0]) / math.ceil(math.sqrt(num_sa2s))
+    sa2s = make_grid(num_sa2s, sa2_cell_size, 300_000, "SA22018_V1_00")
+    sa2s["SA22018_V1_NAME"] = [f"Synthetic SA2 {sa2_id}" for sa2_id in sa2s.index]
+
+    urban_area = make_urban_area_polygon(extent, city_fraction, rng)
+    urban_rural = gpd.GeoDataFrame(
+        {"UR2023_V1_00_NAME": [URBAN_AREA_NAME, "Rural Other"]},
+        geometry=[urban_area, extent.difference(urban_area)],
+        crs=CRS,
+    )
+    return SyntheticGeographies(sa1s, sa2s, urban_rural)
+
+
+def write_emissions_workbook(path: pathlib.Path, sa1_ids: pd.Index, seed: int = 0) -> None:
+    """
+    Writes an emissions workbook laid out like the BRANZ SA1 emissions workbook: the data is on the fourth sheet, with
+    a two-level header of vehicle type over variable, one row per SA1, and an unlabelled total column.
+
+    Parameters
+    ----------
+    path : pathlib.Path
+        The .xlsx file to write.
+    sa1_ids : pd.Index
+        The SA1 ids to write a row for.
+    seed : int = 0
+        Seeds the random number generator for the emissions values.
+
+    Returns
+    -------
+    None
+        This function does not return anything.
+    """
+    rng = np.random.default_rng(seed)
+    vehicle_types = get_vehicle_types()
+    num_values = len(vehicle_types) * len(EMISSIONS_VARIABLES)
+    # constant_memory streams each row to disk, keeping memory flat for the largest scales
+    with xlsxwriter.Workbook(path, {"constant_memory": True}) as workbook:
+        for sheet_name in ["Notes", "Method", "Summary"]:
+            workbook.add_worksheet(sheet_name).write(0, 0, f"Synthetic {sheet_name.lower()}")
+        sheet = workbook.add_worksheet("SA1")
+        # Each vehicle type is a merged cell over its variables, which pandas repeats across the merged columns
+        for i, vehicle_type in enumerate(vehicle_types):
+            first_column = 1 + i * len(EMISSIONS_VARIABLES)
+            sheet.merge_range(0, first_column, 0, first_column + len(EMISSIONS_VARIABLES) - 1, vehicle_type)
+        sheet.write(0, 1 + num_values, "Total")
+        sheet.write_row(1, 1, EMISSIONS_VARIABLES * len(vehicle_types))
+        # Write in blocks so the random values do not need to be held in memory all at once
+        block_size = 10_000
+        for block_start in range(0, len(sa1_ids), block_size):
+            block_ids = sa1_ids[block_start:block_start + block_size]
+            values = rng.gamma(2, 50, size=(len(block_ids), num_values)).round(3)
+            for row_offset, (sa1_id, row_values) in enumerate(zip(block_ids, values)):
+                row = 2 + block_start + row_offset
+                sheet.write_number(row, 0, sa1_id)
+                sheet.write_row(row, 1, row_values.tolist())
+                sheet.write_number(row, 1 + num_values, row_values.sum())
+
+
+def write_means_of_travel_csv(path: pathlib.Path, sa2s: gpd.GeoDataFrame, seed: int = 0) -> None:
+    """
+    Writes a means of travel to work CSV laid out like the 2018 census dataset, with up to WORKPLACES_PER_SA2 distinct
+    workplace SA2s for each usual residence SA2 and some suppressed counts.
+
+    Parameters
+    ----------
+    path : pathlib.Path
+        The .csv file to write.
+    sa2s : gpd.GeoDataFrame
+        The SA2s indexed by SA22018_V1_00, with SA22018_V1_NAME columns.
+    seed : int = 0
+        Seeds the random number generator for the counts.
+
+    Returns
+    -------
+    None
+        This function does not return anything.
+    """
+    rng = np.random.default_rng(seed)
+    num_sa2s = len(sa2s)
+    workplaces_per_sa2 = min(WORKPLACES_PER_SA2, num_sa2s)
+    # Distinct offsets give each residence distinct workplaces, so every (residence, workplace) pair is unique
+    offsets = np.concatenate([[0], rng.choice(np.arange(1, num_sa2s), workplaces_per_sa2 - 1, replace=False)])
+    residences = np.repeat(np.arange(num_sa2s), workplaces_per_sa2)
+    workplaces = (residences + np.tile(offsets, num_sa2s)) % num_sa2s
+
+    centroids = sa2s.centroid
+    sa2_codes = sa2s.index.to_numpy()
+    sa2_names = sa2s["SA22018_V1_NAME"].to_numpy()
+    means_of_travel = pd.DataFrame({
+        "SA2_code_usual_residence_address": sa2_codes[residences],
+        "SA2_name_usual_residence_address": sa2_names[residences],
+        "SA2_usual_residence_easting": centroids.x.to_numpy()[residences].round(),
+        "SA2_usual_residence_northing": centroids.y.to_numpy()[residences].round(),
+        "SA2_code_workplace_address": sa2_codes[workplaces],
+        "SA2_name_workplace_address": sa2_names[workplaces],
+        "SA2_workplace_easting": centroids.x.to_numpy()[workplaces].round(),
+        "SA2_workplace_northing": centroids.y.to_numpy()[workplaces].round(),
+    })
+    counts = rng.poisson(6, size=(len(means_of_travel), len(MEANS_OF_TRAVEL_COLUMNS)))
+    # Stats NZ suppresses small counts for confidentiality
+    counts[counts < 3] = SUPPRESSED_VALUE
+    for column, column_counts in zip(MEANS_OF_TRAVEL_COLUMNS, counts.T):
+        means_of_travel[column] = column_counts
+    means_of_travel["Total"] = np.where(counts > 0, counts, 0).sum(axis=1)
+    means_of_travel.to_csv(path, index=False)
+
+
+class SyntheticDataset(NamedTuple):
+    scale: float
+    geographies: SyntheticGeographies
+    emissions_workbook: pathlib.Path
+    means_of_travel_csv: pathlib.Path
+
+
+def make_dataset(data_dir: pathlib.Path, scale: float, seed: int = 0) -> SyntheticDataset:
+    """
+    Creates every synthetic input for a city of the given scale. The files are written to data_dir, and reused if they
+    were already generated for the same scale and seed, since the largest workbooks take minutes to write.
+
+    Parameters
+    ----------
+    data_dir : pathlib.Path
+        The directory to write the files to.
+    scale : float
+        The size of the city, relative to CITY_SA1S and CITY_SA2S.
+    seed : int = 0
+        Seeds the random number generator.
+
+    Returns
+    -------
+    SyntheticDataset
+        The polygons and the paths of the generated files.
+    """
+    data_dir.mkdir(parents=True, exist_ok=True)
+    geographies = make_geographies(scale, seed)
+    file_stem = f"scale_{scale:g}_seed_{seed}"
+
+    emissions_workbook = data_dir / f"emissions_{file_stem}.xlsx"
+    if not emissions_workbook.exists():
+        log.info(f"Writing synthetic emissions workbook {emissions_workbook} for {len(geographies.sa1s)} SA1s")
+        temp_path = emissions_workbook.with_name(f".{emissions_workbook.name}")
+        write_emissions_workbook(temp_path, geographies.sa1s.index, seed)
+        temp_path.replace(emissions_workbook)
+
+    means_of_travel_csv = data_dir / f"means_of_travel_{file_stem}.csv"
+    if not means_of_travel_csv.exists():
+        log.info(f"Writing synthetic means of travel CSV {means_of_travel_csv} for {len(geographies.sa2s)} SA2s")
+        temp_path = means_of_travel_csv.with_name(f".{means_of_travel_csv.name}")
+        write_means_of_travel_csv(temp_path, geographies.sa2s, seed)
+        temp_path.replace(means_of_travel_csv)
+
+    return SyntheticDataset(scale, geographies, emissions_workbook, means_of_travel_csv)
@@ -0,0 +1,87 @@
+"""
+Times how long the initialiser and each stage's module take to import with pytest-benchmark, so that start-up
+regressions, such as a heavy dependency imported at the top of a shared module, are visible. Each import runs in a fresh
+interpreter without any of the settings in config.EnvVariable set, which also checks that importing does not require
+them.
+
+Run from the initialise_db directory, e.g.
+    python -m pytest benchmarks/test_import_time.py --benchmark-save=import_times
+"""
+import json
+import os
+import pathlib
+import subprocess
+import sys
+from typing import Dict, List
+
+import pytest
+
+from config import EnvVariable, LazyEnvVariable
+from initialise_all_data_sources import STAGES
+
+# Run in a fresh interpreter, printing the import time, the number of modules imported and the peak RSS as JSON.
+# The peak RSS is read from /proc rather than getrusage, whose ru_maxrss carries over the parent's peak across exec.
+IMPORT_SCRIPT = """
+import importlib, json, sys, time
+modules_before = len(sys.modules)
+start = time.perf_counter()
+importlib.import_module(sys.argv[1])
+seconds = time.perf_counter() - start
+max_rss_mib = 0.0
+try:
+    with open("/proc/self/status") as status:
+        max_rss_mib = next(int(line.split()[1]) for line in status if line.startswith("VmHWM:")) / 1024
+except (OSError, StopIteration):
+    pass
+print(json.dumps({"seconds": seconds, "modules": len(sys.modules) - modules_before, "max_rss_mib": max_rss_mib}))
+"""
+ROUNDS = 5
+
+
+def get_default_modules() -> List[str]:
+    # The stage runner's own imports, then each stage's module as its process imports it
+    return ["config", "initialise_all_data_sources"] + list(dict.fromkeys(
+        stage.function.partition(":")[0] for stage in STAGES))
+
+
+def get_environment_without_settings() -> Dict[str, str]:
+    setting_names = {setting.var_name for setting in vars(EnvVariable).values()
+                     if isinstance(setting, LazyEnvVariable)}
+    return {name: value for name, value in os.environ.items() if name not in setting_names}
+
+
+def import_in_fresh_interpreter(module_name: str) -> Dict[str, float]:
+    """
+    Imports a module in a fresh interpreter.
+
+    Parameters
+    ----------
+    module_name : str
+        The module to import, e.g. emissions.initialise_co2_sa1s.
+
+    Returns
+    -------
+    Dict[str, float]
+        The import time in seconds, the number of modules it imported and the interpreter's peak RSS in MiB, which is
+        zero where /proc is not available.
+
+    Raises
+    ------
+    subprocess.CalledProcessError
+        If the import fails.
+    """
+    completed = subprocess.run([sys.executable, "-c", IMPORT_SCRIPT, module_name],
+                               env=get_environment_without_settings(), cwd=pathlib.Path(__file__).parents[1],
+                               capture_output=True, text=True, check=True)
+    return json.loads(completed.stdout.strip().splitlines()[-1])
+
+
+@pytest.mark.parametrize("module_name", get_default_modules())
+def test_import_time(benchmark, module_name):
+    # The benchmark times the whole interpreter start-up, and the import alone is recorded from the fastest round
+    measurements = []
+    benchmark.pedantic(lambda: measurements.append(import_in_fresh_interpreter(module_name)),
+                       rounds=ROUNDS, iterations=1)
+    fastest = min(measurements, key=lambda measurement: measurement["seconds"])
+    benchmark.extra_info.update(modules_imported=fastest["modules"], import_seconds=fastest["seconds"],
+                                peak_memory_mib=fastest["max_rss_mib"])
@@ -0,0 +1,115 @@
+"""
+Times the ingest pipeline's in-memory stages with pytest-benchmark and records their peak memory, on synthetic data at
+several multiples of a city's size. Everything runs offline: the inputs come from benchmarks.synthetic_data rather
+than Stats NZ, and no database is needed.
+
+Run from the initialise_db directory, e.g.
+    python -m pytest benchmarks/test_ingest.py --benchmark-save=baseline
+and later compare against those results to catch regressions:
+    python -m pytest benchmarks/test_ingest.py --benchmark-compare --benchmark-compare-fail=min:50%
+"""
+from typing import Iterator, NamedTuple
+
+import geopandas as gpd
+import pandas as pd
+import pytest
+
+import stats_nz_geographies
+from benchmarks.measurement import benchmark_stage
+from benchmarks.synthetic_data import URBAN_AREA_NAME, SyntheticDataset, SyntheticStatsNz, make_dataset
+from config import EnvVariable as Env
+from data_cache import get_cache_dir
+from emissions.initialise_co2_sa1s import (
+    get_long_format_sa1_emissions,
+    read_emissions_and_filter_by_sa1s,
+    split_vehicle_type,
+)
+from mode_share.initialise_mode_share import find_mode_shares_in_areas_of_interest
+
+SCALES = [1, 10, 100]
+
+
+class PipelineInputs(NamedTuple):
+    """The synthetic inputs, and the input of each stage, computed once from the output of the stage before it."""
+    dataset: SyntheticDataset
+    vector_fetcher: SyntheticStatsNz
+    sa1s_in_city: gpd.GeoDataFrame
+    sa2s_in_city: gpd.GeoDataFrame
+    emissions: pd.DataFrame
+    long_emissions: pd.DataFrame
+    num_csv_rows: int
+
+
+@pytest.fixture(scope="module", params=SCALES, ids=lambda scale: f"{scale:g}x")
+def pipeline_inputs(request, synthetic_data_dir, tmp_path_factory) -> Iterator[PipelineInputs]:
+    dataset = make_dataset(synthetic_data_dir, request.param)
+    vector_fetcher = SyntheticStatsNz(dataset.geographies)
+    settings = {
+        "EMISSIONS_DATA": dataset.emissions_workbook,
+        "MEANS_OF_TRAVEL_DATA": dataset.means_of_travel_csv,
+        # The emissions Parquet cache is written to a throwaway directory rather than the real data cache
+        "DATA_CACHE_DIR": tmp_path_factory.mktemp("benchmark_cache"),
+    }
+    # Saved from the class dict rather than with monkeypatch, whose getattr would read the unset environment variables
+    original_settings = {name: vars(Env)[name] for name in settings}
+    for name, value in settings.items():
+        setattr(Env, name, value)
+    try:
+        sa1s_in_city = stats_nz_geographies.filter_gdf_by_urban_rural_area(
+            dataset.geographies.sa1s, URBAN_AREA_NAME, vector_fetcher)
+        sa2s_in_city = stats_nz_geographies.filter_gdf_by_urban_rural_area(
+            dataset.geographies.sa2s, URBAN_AREA_NAME, vector_fetcher)
+        # The first read also writes the Parquet cache used by the cached read
+        emissions = read_emissions_and_filter_by_sa1s(sa1s_in_city)
+        long_emissions = get_long_format_sa1_emissions(emissions)
+        with open(dataset.means_of_travel_csv) as means_of_travel_file:
+            num_csv_rows = sum(1 for _ in means_of_travel_file) - 1
+        yield PipelineInputs(dataset, vector_fetcher, sa1s_in_city, sa2s_in_city, emissions, long_emissions,
+                             num_csv_rows)
+    finally:
+        for name, value in original_settings.items():
+            setattr(Env, name, value)
+
+
+def test_filter_sa1s_by_urban_rural_area(benchmark, pipeline_inputs):
+    sa1s = pipeline_inputs.dataset.geographies.sa1s
+    benchmark_stage(benchmark, lambda: stats_nz_geographies.filter_gdf_by_urban_rural_area(
+        sa1s, URBAN_AREA_NAME, pipeline_inputs.vector_fetcher), len(sa1s))
+
+
+def test_filter_sa2s_by_urban_rural_area(benchmark, pipeline_inputs):
+    sa2s = pipeline_inputs.dataset.geographies.sa2s
+    benchmark_stage(benchmark, lambda: stats_nz_geographies.filter_gdf_by_urban_rural_area(
+        sa2s, URBAN_AREA_NAME, pipeline_inputs.vector_fetcher), len(sa2s))
+
+
+def test_read_emissions_workbook(benchmark, pipeline_inputs):
+    def clear_emissions_cache():
+        for cache_path in get_cache_dir("emissions").glob("*.parquet"):
+            cache_path.unlink()
+
+    # Converting the workbook dominates a first run, but only happens once per workbook, so it is timed once
+    benchmark_stage(benchmark, lambda: read_emissions_and_filter_by_sa1s(pipeline_inputs.sa1s_in_city),
+                    len(pipeline_inputs.dataset.geographies.sa1s), setup=clear_emissions_cache)
+
+
+def test_read_cached_emissions(benchmark, pipeline_inputs):
+    # Makes sure the cache exists, whichever test ran before
+    read_emissions_and_filter_by_sa1s(pipeline_inputs.sa1s_in_city)
+    benchmark_stage(benchmark, lambda: read_emissions_and_filter_by_sa1s(pipeline_inputs.sa1s_in_city),
+                    len(pipeline_inputs.dataset.geographies.sa1s))
+
+
+def test_get_long_format_sa1_emissions(benchmark, pipeline_inputs):
+    benchmark_stage(benchmark, lambda: get_long_format_sa1_emissions(pipeline_inputs.emissions),
+                    len(pipeline_inputs.emissions))
+
+
+def test_split_vehicle_type(benchmark, pipeline_inputs):
+    benchmark_stage(benchmark, lambda: split_vehicle_type(pipeline_inputs.long_emissions),
+                    len(pipeline_inputs.long_emissions))
+
+
+def test_find_mode_shares_in_areas_of_interest(benchmark, pipeline_inputs):
+    benchmark_stage(benchmark, lambda: find_mode_shares_in_areas_of_interest(pipeline_inputs.sa2s_in_city),
+                    pipeline_inputs.num_csv_rows)
@@ -0,0 +1,68 @@
+"""
+Compares stats_nz_geographies.UrbanAreaFilter against the spatial join that filter_gdf_by_urban_rural_area used
+before it, on synthetic SA1 polygons, with pytest-benchmark. Everything runs offline.
+
+Run from the initialise_db directory, e.g.
+    python -m pytest benchmarks/test_urban_area_filter.py
+"""
+import geopandas as gpd
+import pandas as pd
+import pytest
+
+from benchmarks.measurement import benchmark_stage
+from benchmarks.synthetic_data import (CITY_SA1S, OUTSIDE_CITY_RATIO, URBAN_AREA_NAME, SyntheticGeographies,
+                                       make_geographies)
+from stats_nz_geographies import REPRESENTATIVE_POINT_WITHIN, UrbanAreaFilter
+
+NUM_POLYGONS = [10_000, 100_000]
+
+
+def filter_with_sjoin(gdf_to_filter: gpd.GeoDataFrame,
+                      area_name: str,
+                      urban_rural: gpd.GeoDataFrame,
+                      predicate: str = "intersects") -> gpd.GeoDataFrame:
+    """The previous implementation of filter_gdf_by_urban_rural_area, kept as the baseline to compare against."""
+    urban_area = urban_rural.loc[urban_rural['UR2023_V1_00_NAME'] == area_name]
+    gdf_join_urban_area = gdf_to_filter.sjoin(urban_area, how='inner', predicate=predicate)
+    polygons_in_urban_area = gdf_to_filter.loc[gdf_to_filter.index.isin(gdf_join_urban_area.index)].copy()
+    polygons_in_urban_area['UR2023_V1_00_NAME'] = gdf_join_urban_area["UR2023_V1_00_NAME"]
+    return polygons_in_urban_area
+
+
+@pytest.fixture(scope="module", params=NUM_POLYGONS, ids=lambda num_polygons: f"{num_polygons}_polygons")
+def geographies(request) -> SyntheticGeographies:
+    # The approximate number of SA1 polygons, inside and outside the city
+    return make_geographies(request.param / CITY_SA1S / (1 + OUTSIDE_CITY_RATIO))
+
+
+@pytest.fixture(scope="module")
+def urban_area_filter(geographies) -> UrbanAreaFilter:
+    return UrbanAreaFilter(geographies.urban_rural)
+
+
+def test_urban_area_filter_matches_sjoin(geographies, urban_area_filter):
+    expected = filter_with_sjoin(geographies.sa1s, URBAN_AREA_NAME, geographies.urban_rural)
+    pd.testing.assert_frame_equal(urban_area_filter.filter(geographies.sa1s, URBAN_AREA_NAME), expected,
+                                  check_like=True)
+
+
+def test_sjoin(benchmark, geographies):
+    benchmark_stage(benchmark, lambda: filter_with_sjoin(geographies.sa1s, URBAN_AREA_NAME, geographies.urban_rural),
+                    len(geographies.sa1s))
+
+
+def test_urban_area_filter_including_setup(benchmark, geographies):
+    benchmark_stage(benchmark, lambda: UrbanAreaFilter(geographies.urban_rural).filter(geographies.sa1s,
+                                                                                       URBAN_AREA_NAME),
+                    len(geographies.sa1s))
+
+
+def test_urban_area_filter_reused(benchmark, geographies, urban_area_filter):
+    benchmark_stage(benchmark, lambda: urban_area_filter.filter(geographies.sa1s, URBAN_AREA_NAME),
+                    len(geographies.sa1s))
+
+
+def test_urban_area_filter_representative_point_reused(benchmark, geographies, urban_area_filter):
+    benchmark_stage(benchmark, lambda: urban_area_filter.filter(geographies.sa1s, URBAN_AREA_NAME,
+                                                                REPRESENTATIVE_POINT_WITHIN),
+                    len(geographies.sa1s))
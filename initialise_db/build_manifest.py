@@ -0,0 +1,244 @@
+import hashlib
+import json
+import logging
+from typing import Any, Callable, Dict, List, Optional, Sequence
+
+import pandas as pd
+import sqlalchemy
+
+from bulk_load import copy_frame_to_table, create_table_from_query, replace_rows, replace_rows_from_query
+from table_schemas import TABLE_PARTITIONS, conform_to_schema, create_enum_types, get_sql_types
+
+log = logging.getLogger(__name__)
+
+MANIFEST_TABLE_NAME = "build_manifest"
+
+AreaInputs = Dict[str, Any]
+
+
+def fingerprint(inputs: AreaInputs) -> str:
+    """
+    Hashes the inputs that a stage's rows for one area were built from.
+
+    Parameters
+    ----------
+    inputs : AreaInputs
+        JSON serialisable description of the inputs, such as input file hashes, the area of interest definition and
+        the code version.
+
+    Returns
+    -------
+    str
+        A short hex digest that changes whenever any input changes.
+    """
+    return hashlib.sha256(json.dumps(inputs, sort_keys=True, default=str).encode()).hexdigest()[:16]
+
+
+class BuildManifest:
+    """
+    Records, per stage and urban area, the fingerprint of the inputs that area's rows were last built from,
+    so that only the areas whose inputs changed are rebuilt.
+
+    Parameters
+    ----------
+    engine : sqlalchemy.engine.Engine
+        The engine connected to the PostGIS database.
+    stage : str
+        The name of the stage, typically the table it builds.
+    """
+
+    def __init__(self, engine: sqlalchemy.engine.Engine, stage: str):
+        self.engine = engine
+        self.stage = stage
+        with engine.begin() as connection:
+            # Stages run in parallel processes, and concurrent CREATE TABLE IF NOT EXISTS statements can still fail
+            # with a unique violation on a fresh database, so they are serialised with a lock held until commit
+            connection.execute(sqlalchemy.text("SELECT pg_advisory_xact_lock(hashtext(:lock_name))"),
+                               {"lock_name": MANIFEST_TABLE_NAME})
+            connection.execute(sqlalchemy.text(f"""
+                CREATE TABLE IF NOT EXISTS {MANIFEST_TABLE_NAME} (
+                    stage       TEXT        NOT NULL,
+                    area        TEXT        NOT NULL,
+                    fingerprint TEXT        NOT NULL,
+                    inputs      JSONB       NOT NULL,
+                    updated_at  TIMESTAMPTZ NOT NULL DEFAULT now(),
+                    PRIMARY KEY (stage, area)
+                )
+            """))
+            rows = connection.execute(
+                sqlalchemy.text(f"SELECT area, fingerprint FROM {MANIFEST_TABLE_NAME} WHERE stage = :stage"),
+                {"stage": stage})
+            self.recorded_fingerprints: Dict[str, str] = dict(rows.all())
+
+    def find_changed_areas(self, area_inputs: Dict[str, AreaInputs]) -> List[str]:
+        """
+        Finds the areas that are new or whose inputs differ from when they were last built.
+
+        Parameters
+        ----------
+        area_inputs : Dict[str, AreaInputs]
+            The current inputs for each area.
+
+        Returns
+        -------
+        List[str]
+            The names of the areas that need to be rebuilt.
+        """
+        return [area for area, inputs in area_inputs.items()
+                if self.recorded_fingerprints.get(area) != fingerprint(inputs)]
+
+    def find_removed_areas(self, area_inputs: Dict[str, AreaInputs]) -> List[str]:
+        """
+        Finds the areas that were built previously but are no longer configured.
+
+        Parameters
+        ----------
+        area_inputs : Dict[str, AreaInputs]
+            The current inputs for each area.
+
+        Returns
+        -------
+        List[str]
+            The names of the areas whose rows should be deleted.
+        """
+        return [area for area in self.recorded_fingerprints if area not in area_inputs]
+
+    def record(self, area_inputs: Dict[str, AreaInputs], removed_areas: Sequence[str] = ()) -> None:
+        """
+        Records that areas were built from the given inputs, and forgets removed areas.
+
+        Parameters
+        ----------
+        area_inputs : Dict[str, AreaInputs]
+            The inputs each rebuilt area was built from.
+        removed_areas : Sequence[str] = ()
+            Areas whose rows were deleted.
+
+        Returns
+        -------
+        None
+            This function does not return anything.
+        """
+        with self.engine.begin() as connection:
+            for area, inputs in area_inputs.items():
+                connection.execute(sqlalchemy.text(f"""
+                    INSERT INTO {MANIFEST_TABLE_NAME} (stage, area, fingerprint, inputs)
+                    VALUES (:stage, :area, :fingerprint, CAST(:inputs AS JSONB))
+                    ON CONFLICT (stage, area) DO UPDATE
+                        SET fingerprint = EXCLUDED.fingerprint, inputs = EXCLUDED.inputs, updated_at = now()
+                """), {"stage": self.stage, "area": area, "fingerprint": fingerprint(inputs),
+                       "inputs": json.dumps(inputs, sort_keys=True, default=str)})
+                self.recorded_fingerprints[area] = fingerprint(inputs)
+            for area in removed_areas:
+                connection.execute(
+                    sqlalchemy.text(f"DELETE FROM {MANIFEST_TABLE_NAME} WHERE stage = :stage AND area = :area"),
+                    {"stage": self.stage, "area": area})
+                self.recorded_fingerprints.pop(area, None)
+
+
+def rebuild_changed_areas(engine: sqlalchemy.engine.Engine,
+                          table_name: str,
+                          area_inputs: Dict[str, AreaInputs],
+                          build_areas: Callable[[List[str]], pd.DataFrame],
+                          area_condition: str,
+                          index_label: Optional[Sequence[str]] = None) -> bool:
+    """
+    Brings a table up to date with its inputs, rebuilding only the areas whose inputs changed.
+    If the table does not exist, or every area changed (e.g. the code version changed), the whole table is rebuilt.
+    Otherwise the changed and removed areas' rows are deleted and the changed areas reinserted in place.
+    If the table has a schema in table_schemas.TABLE_SCHEMAS, the built rows are checked against it and stored with
+    its types. If it has partitions in table_schemas.TABLE_PARTITIONS, it is created with them.
+
+    Parameters
+    ----------
+    engine : sqlalchemy.engine.Engine
+        The engine connected to the PostGIS database.
+    table_name : str
+        The table built by the stage, also used as the stage name in the manifest.
+    area_inputs : Dict[str, AreaInputs]
+        The current inputs for each configured area.
+    build_areas : Callable[[List[str]], pd.DataFrame]
+        Builds the table rows for the given area names.
+    area_condition : str
+        SQL WHERE clause selecting the rows belonging to the areas in the %(areas)s array parameter.
+    index_label : Optional[Sequence[str]] = None
+        Column names for the index levels of the built frames.
+
+    Returns
+    -------
+    bool
+        True if the table was modified.
+    """
+    manifest = BuildManifest(engine, table_name)
+    changed_areas = manifest.find_changed_areas(area_inputs)
+    removed_areas = manifest.find_removed_areas(area_inputs)
+    table_exists = sqlalchemy.inspect(engine).has_table(table_name)
+    if table_exists and not changed_areas and not removed_areas:
+        log.info(f"Table {table_name} is up to date, skipping")
+        return False
+
+    if not table_exists or set(changed_areas) == set(area_inputs):
+        log.info(f"Building table {table_name} for all areas")
+        frame = conform_to_schema(build_areas(list(area_inputs)), table_name)
+        create_enum_types(engine, table_name, frame)
+        copy_frame_to_table(frame, table_name, engine, index=True, index_label=index_label,
+                            dtype=get_sql_types(table_name), partitions=TABLE_PARTITIONS.get(table_name))
+        manifest.record(area_inputs, removed_areas)
+    else:
+        log.info(f"Rebuilding table {table_name} for areas {changed_areas}, removing areas {removed_areas}")
+        frame = conform_to_schema(build_areas(changed_areas), table_name) if changed_areas else None
+        if frame is not None:
+            create_enum_types(engine, table_name, frame)
+        replace_rows(frame, table_name, engine, area_condition, {"areas": changed_areas + removed_areas},
+                     index=True, index_label=index_label)
+        manifest.record({area: area_inputs[area] for area in changed_areas}, removed_areas)
+    log.info(f"Table {table_name} initialised.")
+    return True
+
+
+def rebuild_changed_areas_from_query(engine: sqlalchemy.engine.Engine,
+                                     table_name: str,
+                                     area_inputs: Dict[str, AreaInputs],
+                                     query: str,
+                                     area_condition: str) -> bool:
+    """
+    Like rebuild_changed_areas, but builds the rows with a query run inside the database rather than in Python, for
+    tables derived from other tables.
+
+    Parameters
+    ----------
+    engine : sqlalchemy.engine.Engine
+        The engine connected to the PostGIS database.
+    table_name : str
+        The table built by the stage, also used as the stage name in the manifest.
+    area_inputs : Dict[str, AreaInputs]
+        The current inputs for each configured area.
+    query : str
+        SELECT statement producing the table rows for the areas in the %(areas)s array parameter.
+    area_condition : str
+        SQL WHERE clause selecting the rows belonging to the areas in the %(areas)s array parameter.
+
+    Returns
+    -------
+    bool
+        True if the table was modified.
+    """
+    manifest = BuildManifest(engine, table_name)
+    changed_areas = manifest.find_changed_areas(area_inputs)
+    removed_areas = manifest.find_removed_areas(area_inputs)
+    table_exists = sqlalchemy.inspect(engine).has_table(table_name)
+    if table_exists and not changed_areas and not removed_areas:
+        log.info(f"Table {table_name} is up to date, skipping")
+        return False
+
+    if not table_exists or set(changed_areas) == set(area_inputs):
+        log.info(f"Building table {table_name} for all areas")
+        create_table_from_query(query, table_name, engine, {"areas": list(area_inputs)})
+        manifest.record(area_inputs, removed_areas)
+    else:
+        log.info(f"Rebuilding table {table_name} for areas {changed_areas}, removing areas {removed_areas}")
+        replace_rows_from_query(query if changed_areas else None, table_name, engine, area_condition,
+                                {"areas": changed_areas + removed_areas}, {"areas": changed_areas})
+        manifest.record({area: area_inputs[area] for area in changed_areas}, removed_areas)
+    log.info(f"Table {table_name} initialised.")
+    return True
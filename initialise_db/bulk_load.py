@@ -0,0 +1,379 @@
+import io
+import logging
+from typing import Any, Dict, List, NamedTuple, Optional, Sequence
+
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+import shapely
+import sqlalchemy
+from geoalchemy2 import Geometry
+
+import instrumentation
+from sql_quoting import quote_identifier, quote_literal
+from table_schemas import ListPartitions
+
+log = logging.getLogger(__name__)
+
+
+def _index_labels(frame: pd.DataFrame, index_label: Optional[Sequence[str]]) -> List[str]:
+    # Mirrors the column names DataFrame.to_sql gives index levels
+    if index_label is not None:
+        return list(index_label)
+    if frame.index.nlevels == 1:
+        return [frame.index.name if frame.index.name is not None else "index"]
+    return [name if name is not None else f"level_{i}" for i, name in enumerate(frame.index.names)]
+
+
+def _geometry_columns(frame: pd.DataFrame) -> Dict[str, Optional[int]]:
+    # Maps each geometry column to its EPSG code
+    return {
+        column: frame[column].crs.to_epsg() if frame[column].crs is not None else None
+        for column in frame.columns
+        if isinstance(frame[column].dtype, gpd.array.GeometryDtype)
+    }
+
+
+def _to_ewkb_hex(geometries: gpd.GeoSeries, srid: Optional[int]) -> np.ndarray:
+    geometry_array = np.asarray(geometries, dtype=object)
+    if srid is not None:
+        geometry_array = shapely.set_srid(geometry_array, srid)
+    return shapely.to_wkb(geometry_array, hex=True, include_srid=srid is not None)
+
+
+def _prepare_frame(frame: pd.DataFrame, index: bool, index_label: Optional[Sequence[str]]) -> pd.DataFrame:
+    if index:
+        labels = _index_labels(frame, index_label)
+        frame = frame.reset_index()
+        frame.columns = labels + frame.columns[len(labels):].tolist()
+    return frame
+
+
+def _copy_rows(cursor, frame: pd.DataFrame, table_name: str, chunk_size: int) -> None:
+    # Streams the frame into an existing table in chunks, so only one chunk is serialised in memory at a time
+    geometry_columns = _geometry_columns(frame)
+    columns = ", ".join(quote_identifier(column) for column in frame.columns)
+    copy_statement = f"COPY {quote_identifier(table_name)} ({columns}) FROM STDIN WITH (FORMAT csv)"
+    for start in range(0, len(frame), chunk_size):
+        chunk = frame.iloc[start:start + chunk_size]
+        if geometry_columns:
+            chunk = pd.DataFrame(chunk).assign(**{
+                column: _to_ewkb_hex(chunk[column], srid) for column, srid in geometry_columns.items()
+            })
+        buffer = io.StringIO()
+        chunk.to_csv(buffer, index=False, header=False)
+        buffer.seek(0)
+        cursor.copy_expert(copy_statement, buffer)
+
+
+def _create_partitions(cursor, table_name: str, partitions: ListPartitions) -> None:
+    for value in partitions.values:
+        cursor.execute(f"CREATE TABLE {quote_identifier(partitions.partition_name(table_name, value))} "
+                       f"PARTITION OF {quote_identifier(table_name)} FOR VALUES IN ({quote_literal(value)})")
+
+
+def _rename_partitions(cursor, table_name: str, new_table_name: str, partitions: ListPartitions) -> None:
+    for value in partitions.values:
+        cursor.execute(f"ALTER TABLE {quote_identifier(partitions.partition_name(table_name, value))} "
+                       f"RENAME TO {quote_identifier(partitions.partition_name(new_table_name, value))}")
+
+
+class _DependentView(NamedTuple):
+    # A view or materialised view built on a table, with what is needed to recreate it
+    name: str
+    materialised: bool
+    definition: str
+    index_definitions: List[str]
+    comment: Optional[str]
+
+
+# Views built on a table, and views built on those, each ordered after the views it is built on
+_DEPENDENT_VIEWS_QUERY = """
+    WITH RECURSIVE dependents AS (
+        SELECT rewrite.ev_class AS view_oid, 1 AS depth
+        FROM pg_depend depend
+            JOIN pg_rewrite rewrite ON depend.objid = rewrite.oid
+        WHERE depend.classid = 'pg_rewrite'::regclass
+          AND depend.refobjid = to_regclass(%(table_name)s)
+          AND rewrite.ev_class <> depend.refobjid
+        UNION
+        SELECT rewrite.ev_class, dependents.depth + 1
+        FROM dependents
+            JOIN pg_depend depend ON depend.refobjid = dependents.view_oid
+            JOIN pg_rewrite rewrite ON depend.objid = rewrite.oid
+        WHERE depend.classid = 'pg_rewrite'::regclass
+          AND rewrite.ev_class <> dependents.view_oid
+    )
+    SELECT class.relname,
+           class.relkind = 'm',
+           pg_get_viewdef(class.oid),
+           ARRAY(SELECT indexdef FROM pg_indexes WHERE schemaname = namespace.nspname AND tablename = class.relname),
+           obj_description(class.oid, 'pg_class')
+    FROM dependents
+        JOIN pg_class class ON class.oid = dependents.view_oid
+        JOIN pg_namespace namespace ON namespace.oid = class.relnamespace
+    GROUP BY class.oid, class.relname, class.relkind, namespace.nspname
+    ORDER BY max(dependents.depth), class.relname
+"""
+
+
+def _find_dependent_views(cursor, table_name: str) -> List[_DependentView]:
+    cursor.execute(_DEPENDENT_VIEWS_QUERY, {"table_name": quote_identifier(table_name)})
+    return [_DependentView(name, materialised, definition.strip().rstrip(";"), list(index_definitions), comment)
+            for name, materialised, definition, index_definitions, comment in cursor.fetchall()]
+
+
+def _recreate_views(cursor, views: Sequence[_DependentView]) -> None:
+    # Recreates views dropped by DROP TABLE ... CASCADE, which now read from the table that replaced it
+    for view in views:
+        log.info(f"Recreating view {view.name}")
+        view_type = "MATERIALIZED VIEW" if view.materialised else "VIEW"
+        cursor.execute(f"CREATE {view_type} {quote_identifier(view.name)} AS {view.definition}")
+        for index_definition in view.index_definitions:
+            cursor.execute(index_definition)
+        if view.comment is not None:
+            # Keeps the definition hash that materialised_views compares against
+            cursor.execute(f"COMMENT ON {view_type} {quote_identifier(view.name)} IS {quote_literal(view.comment)}")
+
+
+def copy_frame_to_table(frame: pd.DataFrame,
+                        table_name: str,
+                        engine: sqlalchemy.engine.Engine,
+                        index: bool = True,
+                        index_label: Optional[Sequence[str]] = None,
+                        dtype: Optional[Dict[str, sqlalchemy.types.TypeEngine]] = None,
+                        partitions: Optional[ListPartitions] = None,
+                        chunk_size: int = 100_000) -> None:
+    """
+    Replaces a database table with the contents of a DataFrame or GeoDataFrame using COPY FROM STDIN.
+    The data is streamed into a staging table, which is swapped in for the live table in the same transaction.
+    Readers keep seeing the old table until the swap commits.
+    Views that depend on the live table are dropped with it and recreated on the new table, with their indexes, before
+    the swap commits, so readers of the views never find them missing.
+    A partitioned table is staged with its partitions, which are renamed for the live table in the swap.
+
+    Parameters
+    ----------
+    frame : pd.DataFrame
+        The data to write. Geometry columns are written as EWKB so that their SRID is preserved.
+    table_name : str
+        The name of the table to replace.
+    engine : sqlalchemy.engine.Engine
+        The engine connected to the PostGIS database.
+    index : bool = True
+        If True, write the frame index as columns, like DataFrame.to_sql.
+    index_label : Optional[Sequence[str]] = None
+        Column names for the index levels. Defaults to the index names.
+    dtype : Optional[Dict[str, sqlalchemy.types.TypeEngine]] = None
+        Column types to use instead of those inferred from the frame.
+    partitions : Optional[ListPartitions] = None
+        If given, the table is list partitioned, with a partition for each value.
+    chunk_size : int = 100_000
+        The number of rows serialised and sent to the database at a time, to bound memory use.
+
+    Returns
+    -------
+    None
+        This function does not return anything.
+    """
+    frame = _prepare_frame(frame, index, index_label)
+    geometry_columns = _geometry_columns(frame)
+    column_types = {column: Geometry(geometry_type="GEOMETRY", srid=srid if srid is not None else -1)
+                    for column, srid in geometry_columns.items()}
+    column_types.update(dtype or {})
+
+    staging_table_name = f"{table_name}__staging"
+    # Created by hand instead of with to_sql/to_postgis, so that no indexes are created on the staging table.
+    # Index names are global to a schema, so they would clash with the next reload after the staging table is renamed.
+    create_staging_table = pd.io.sql.get_schema(frame, staging_table_name, con=engine, dtype=column_types)
+    if partitions is not None:
+        create_staging_table = (f"{create_staging_table.rstrip()} "
+                                f"PARTITION BY LIST ({quote_identifier(partitions.column)})")
+
+    log.info(f"Copying {len(frame)} rows into {table_name}")
+    write_span = instrumentation.span("db_write", rows_in=len(frame), table=table_name, method="copy_frame_to_table")
+    connection = engine.raw_connection()
+    try:
+        with write_span, connection.cursor() as cursor:
+            cursor.execute(f"DROP TABLE IF EXISTS {quote_identifier(staging_table_name)}")
+            cursor.execute(create_staging_table)
+            if partitions is not None:
+                _create_partitions(cursor, staging_table_name, partitions)
+            _copy_rows(cursor, frame, staging_table_name, chunk_size)
+            dependent_views = _find_dependent_views(cursor, table_name)
+            # Dropping the live table also drops its partitions, freeing their names for the staging partitions
+            cursor.execute(f"DROP TABLE IF EXISTS {quote_identifier(table_name)} CASCADE")
+            cursor.execute(f"ALTER TABLE {quote_identifier(staging_table_name)} "
+                           f"RENAME TO {quote_identifier(table_name)}")
+            if partitions is not None:
+                _rename_partitions(cursor, staging_table_name, table_name, partitions)
+            # Spatial index, as to_postgis would create. Indexes are created after the rename so they are named for
+            # the live table.
+            for column in geometry_columns:
+                cursor.execute(
+                    f"CREATE INDEX ON {quote_identifier(table_name)} USING GIST ({quote_identifier(column)})")
+            _recreate_views(cursor, dependent_views)
+            connection.commit()
+            write_span.rows_out = len(frame)
+    except Exception:
+        connection.rollback()
+        raise
+    finally:
+        connection.close()
+    log.info(f"Table {table_name} replaced with {len(frame)} rows")
+
+
+def replace_rows(frame: Optional[pd.DataFrame],
+                 table_name: str,
+                 engine: sqlalchemy.engine.Engine,
+                 delete_condition: str,
+                 params: Dict[str, Any],
+                 index: bool = True,
+                 index_label: Optional[Sequence[str]] = None,
+                 chunk_size: int = 100_000) -> None:
+    """
+    Replaces a subset of an existing table's rows: deletes the rows matching a condition, then inserts the frame using
+    COPY FROM STDIN, in a single transaction. Used to rebuild one area without rewriting the rest of the table.
+
+    Parameters
+    ----------
+    frame : Optional[pd.DataFrame]
+        The replacement rows, with the same columns as the table. If None, the matching rows are only deleted.
+    table_name : str
+        The name of the table to update.
+    engine : sqlalchemy.engine.Engine
+        The engine connected to the PostGIS database.
+    delete_condition : str
+        SQL WHERE clause selecting the rows to delete, using psycopg2 %(name)s placeholders.
+    params : Dict[str, Any]
+        Values for the placeholders in delete_condition.
+    index : bool = True
+        If True, write the frame index as columns, like DataFrame.to_sql.
+    index_label : Optional[Sequence[str]] = None
+        Column names for the index levels. Defaults to the index names.
+    chunk_size : int = 100_000
+        The number of rows serialised and sent to the database at a time, to bound memory use.
+
+    Returns
+    -------
+    None
+        This function does not return anything.
+    """
+    num_rows = len(frame) if frame is not None else 0
+    write_span = instrumentation.span("db_write", rows_in=num_rows, table=table_name, method="replace_rows")
+    connection = engine.raw_connection()
+    try:
+        with write_span, connection.cursor() as cursor:
+            cursor.execute(f"DELETE FROM {quote_identifier(table_name)} WHERE {delete_condition}", params)
+            log.info(f"Deleted {cursor.rowcount} rows from {table_name}")
+            write_span.set(deleted_rows=cursor.rowcount)
+            if frame is not None:
+                log.info(f"Copying {len(frame)} replacement rows into {table_name}")
+                _copy_rows(cursor, _prepare_frame(frame, index, index_label), table_name, chunk_size)
+            connection.commit()
+            write_span.rows_out = num_rows
+    except Exception:
+        connection.rollback()
+        raise
+    finally:
+        connection.close()
+
+
+def create_table_from_query(query: str,
+                            table_name: str,
+                            engine: sqlalchemy.engine.Engine,
+                            params: Dict[str, Any]) -> None:
+    """
+    Replaces a database table with the result of a query run inside the database, so the rows never leave it.
+    Like copy_frame_to_table, the result is written to a staging table that is swapped in for the live table in the
+    same transaction, and views that depend on the live table are recreated on the new table before it commits.
+
+    Parameters
+    ----------
+    query : str
+        The SELECT statement producing the table's rows, using psycopg2 %(name)s placeholders.
+    table_name : str
+        The name of the table to replace.
+    engine : sqlalchemy.engine.Engine
+        The engine connected to the PostGIS database.
+    params : Dict[str, Any]
+        Values for the placeholders in query.
+
+    Returns
+    -------
+    None
+        This function does not return anything.
+    """
+    staging_table_name = f"{table_name}__staging"
+    write_span = instrumentation.span("db_write", table=table_name, method="create_table_from_query")
+    connection = engine.raw_connection()
+    try:
+        with write_span, connection.cursor() as cursor:
+            cursor.execute(f"DROP TABLE IF EXISTS {quote_identifier(staging_table_name)}")
+            cursor.execute(f"CREATE TABLE {quote_identifier(staging_table_name)} AS {query}", params)
+            num_rows = cursor.rowcount
+            dependent_views = _find_dependent_views(cursor, table_name)
+            cursor.execute(f"DROP TABLE IF EXISTS {quote_identifier(table_name)} CASCADE")
+            cursor.execute(f"ALTER TABLE {quote_identifier(staging_table_name)} "
+                           f"RENAME TO {quote_identifier(table_name)}")
+            _recreate_views(cursor, dependent_views)
+            connection.commit()
+            write_span.rows_out = num_rows
+    except Exception:
+        connection.rollback()
+        raise
+    finally:
+        connection.close()
+    log.info(f"Table {table_name} replaced with {num_rows} rows")
+
+
+def replace_rows_from_query(query: Optional[str],
+                            table_name: str,
+                            engine: sqlalchemy.engine.Engine,
+                            delete_condition: str,
+                            delete_params: Dict[str, Any],
+                            query_params: Dict[str, Any]) -> None:
+    """
+    Replaces a subset of an existing table's rows with the result of a query run inside the database: deletes the rows
+    matching a condition, then inserts the query result, in a single transaction.
+
+    Parameters
+    ----------
+    query : Optional[str]
+        The SELECT statement producing the replacement rows, with the same columns as the table, using psycopg2
+        %(name)s placeholders. If None, the matching rows are only deleted.
+    table_name : str
+        The name of the table to update.
+    engine : sqlalchemy.engine.Engine
+        The engine connected to the PostGIS database.
+    delete_condition : str
+        SQL WHERE clause selecting the rows to delete, using psycopg2 %(name)s placeholders.
+    delete_params : Dict[str, Any]
+        Values for the placeholders in delete_condition.
+    query_params : Dict[str, Any]
+        Values for the placeholders in query.
+
+    Returns
+    -------
+    None
+        This function does not return anything.
+    """
+    write_span = instrumentation.span("db_write", table=table_name, method="replace_rows_from_query")
+    connection = engine.raw_connection()
+    try:
+        with write_span, connection.cursor() as cursor:
+            cursor.execute(f"DELETE FROM {quote_identifier(table_name)} WHERE {delete_condition}", delete_params)
+            log.info(f"Deleted {cursor.rowcount} rows from {table_name}")
+            write_span.set(deleted_rows=cursor.rowcount)
+            num_rows = 0
+            if query is not None:
+                cursor.execute(f"INSERT INTO {quote_identifier(table_name)} {query}", query_params)
+                num_rows = cursor.rowcount
+                log.info(f"Inserted {num_rows} replacement rows into {table_name}")
+            connection.commit()
+            write_span.rows_out = num_rows
+    except Exception:
+        connection.rollback()
+        raise
+    finally:
+        connection.close()
@@ -3,16 +3,20 @@ import json
 import logging
 import os
 import pathlib
-from typing import Optional
+from typing import TYPE_CHECKING, Any, Callable, Generic, Optional, TypeVar
 
 from dotenv import load_dotenv
-from sqlalchemy.engine import create_engine, Engine
+
+if TYPE_CHECKING:
+    from sqlalchemy.engine import Engine
 
 load_dotenv("..")
 load_dotenv()
 
 log = logging.getLogger(__name__)
 
+T = TypeVar("T")
+
 
 def get_env_variable(var_name: str, default: str = None, allow_empty: bool = False) -> str:
     """
@@ -70,7 +74,7 @@ def get_bool_env_variable(var_name: str, default: Optional[bool] = None, allow_e
     ValueError
         If allow_empty is False and the environment variable is empty string or None
     """
-    env_variable = get_env_variable(var_name, default, allow_empty)
+    env_variable = get_env_variable(var_name, None if default is None else str(default), allow_empty)
     truth_values = {"true", "t", "1"}
     false_values = {"false", "f", "0"}
     if env_variable.lower() in truth_values:
@@ -81,27 +85,95 @@ def get_bool_env_variable(var_name: str, default: Optional[bool] = None, allow_e
                      f"but is not in {truth_values} or {false_values}")
 
 
-class EnvVariable:
-    ADMIN_EMAIL = get_env_variable("ADMIN_EMAIL", default="luke.parkinson@canterbury.ac.nz")
-    EMISSIONS_DATA = pathlib.Path(get_env_variable("EMISSIONS_DATA"))
-    MEANS_OF_TRAVEL_DATA = pathlib.Path(get_env_variable("MEANS_OF_TRAVEL_DATA"))
+class LazyEnvVariable(Generic[T]):
+    """
+    A setting of EnvVariable that is read from the environment the first time it is accessed, rather than when config
+    is imported, so a process only needs the settings it uses and does not pay to parse the others.
+    The value then replaces the setting on the class, so later accesses are plain attribute lookups.
+    Assigning to the setting on the class, e.g. in a benchmark, overrides it without reading the environment.
+
+    Parameters
+    ----------
+    var_name : str
+        The name of the environment variable to read.
+    default : Optional[Any] = None
+        Default value if the environment variable does not exist, as for get_env_variable or get_bool_env_variable.
+    allow_empty : bool = False
+        If False then a KeyError will be raised on access if the environment variable is empty.
+    parse : Callable[[str], T] = str
+        Converts the value, e.g. int. bool settings are read with get_bool_env_variable, since bool("False") is True.
+    """
+
+    def __init__(self, var_name: str, default: Optional[Any] = None, allow_empty: bool = False,
+                 parse: Callable[[str], T] = str):
+        self.var_name = var_name
+        self.default = default
+        self.allow_empty = allow_empty
+        self.parse = parse
+        self.name = var_name
+
+    def __set_name__(self, owner: type, name: str) -> None:
+        self.name = name
 
-    POSTGRES_HOST = get_env_variable("POSTGRES_HOST")
-    POSTGRES_PORT = get_env_variable("POSTGRES_PORT")
-    POSTGRES_DB = get_env_variable("POSTGRES_DB")
-    POSTGRES_USER = get_env_variable("POSTGRES_USER")
-    POSTGRES_PASSWORD = get_env_variable("POSTGRES_PASSWORD")
+    def read(self) -> T:
+        if self.parse is bool:
+            return get_bool_env_variable(self.var_name, self.default, self.allow_empty)
+        env_variable = get_env_variable(self.var_name, self.default, self.allow_empty)
+        return env_variable if env_variable is None else self.parse(env_variable)
 
-    GEOSERVER_HOST = get_env_variable("GEOSERVER_HOST")
-    GEOSERVER_PORT = get_env_variable("GEOSERVER_PORT")
-    GEOSERVER_ADMIN_NAME = get_env_variable("GEOSERVER_ADMIN_NAME")
-    GEOSERVER_ADMIN_PASSWORD: str = get_env_variable("GEOSERVER_ADMIN_PASSWORD")
+    def __get__(self, instance: Any, owner: type) -> T:
+        value = self.read()
+        setattr(owner, self.name, value)
+        return value
 
-    STATS_API_KEY: str = get_env_variable("STATS_API_KEY")
-    GOOGLE_CREDENTIALS: dict = json.loads(base64.b64decode(get_env_variable("GOOGLE_CREDENTIALS_BASE64")))
 
+def decode_base64_json(encoded: str) -> Any:
+    return json.loads(base64.b64decode(encoded))
+
+
+class EnvVariable:
+    ADMIN_EMAIL = LazyEnvVariable("ADMIN_EMAIL", default="luke.parkinson@canterbury.ac.nz")
+    INITIALISATION_WORKERS: int = LazyEnvVariable("INITIALISATION_WORKERS", default="3", parse=int)
+    EMISSIONS_DATA = LazyEnvVariable("EMISSIONS_DATA", parse=pathlib.Path)
+    EMISSIONS_EXCEL_ENGINE = LazyEnvVariable("EMISSIONS_EXCEL_ENGINE", default="openpyxl")
+    MEANS_OF_TRAVEL_DATA = LazyEnvVariable("MEANS_OF_TRAVEL_DATA", parse=pathlib.Path)
+
+    POSTGRES_HOST = LazyEnvVariable("POSTGRES_HOST")
+    POSTGRES_PORT = LazyEnvVariable("POSTGRES_PORT")
+    POSTGRES_DB = LazyEnvVariable("POSTGRES_DB")
+    POSTGRES_USER = LazyEnvVariable("POSTGRES_USER")
+    POSTGRES_PASSWORD = LazyEnvVariable("POSTGRES_PASSWORD")
+
+    GEOSERVER_HOST = LazyEnvVariable("GEOSERVER_HOST")
+    GEOSERVER_PORT = LazyEnvVariable("GEOSERVER_PORT")
+    GEOSERVER_ADMIN_NAME = LazyEnvVariable("GEOSERVER_ADMIN_NAME")
+    GEOSERVER_ADMIN_PASSWORD: str = LazyEnvVariable("GEOSERVER_ADMIN_PASSWORD")
+    GEOSERVER_PROVISIONING_MODE: str = LazyEnvVariable("GEOSERVER_PROVISIONING_MODE", default="sync")
+    GEOSERVER_CONCURRENCY: int = LazyEnvVariable("GEOSERVER_CONCURRENCY", default="8", parse=int)
+
+    STATS_API_KEY: str = LazyEnvVariable("STATS_API_KEY")
+    STATS_NZ_FETCH_WORKERS: int = LazyEnvVariable("STATS_NZ_FETCH_WORKERS", default="4", parse=int)
+    STATS_NZ_CACHE_TTL_DAYS: float = LazyEnvVariable("STATS_NZ_CACHE_TTL_DAYS", default="90", parse=float)
+    STATS_NZ_CACHE_REFRESH: bool = LazyEnvVariable("STATS_NZ_CACHE_REFRESH", default=False, parse=bool)
+    URBAN_AREA_PREDICATE: str = LazyEnvVariable("URBAN_AREA_PREDICATE", default="intersects")
+    AREA_FILTER_MODE: str = LazyEnvVariable("AREA_FILTER_MODE", default="python")
+
+    DATA_CACHE_DIR = LazyEnvVariable("DATA_CACHE_DIR", default="data/cache", parse=pathlib.Path)
+    DATA_CACHE_MAX_MB: float = LazyEnvVariable("DATA_CACHE_MAX_MB", default="2048", parse=float)
+    STATIC_DATA_DIR = LazyEnvVariable("STATIC_DATA_DIR", default="data/static", parse=pathlib.Path)
+    VECTOR_TILE_WORKERS: int = LazyEnvVariable("VECTOR_TILE_WORKERS", default="4", parse=int)
+    SHEETS_REQUESTS_PER_MINUTE: float = LazyEnvVariable("SHEETS_REQUESTS_PER_MINUTE", default="60", parse=float)
+    SHEETS_UPLOAD_WORKERS: int = LazyEnvVariable("SHEETS_UPLOAD_WORKERS", default="3", parse=int)
+    INSTRUMENTATION_REPORT: str = LazyEnvVariable("INSTRUMENTATION_REPORT", default="", allow_empty=True)
+    INSTRUMENTATION_TRACEMALLOC: bool = LazyEnvVariable("INSTRUMENTATION_TRACEMALLOC", default=False, parse=bool)
+    INSTRUMENTATION_PROFILE_STAGE: str = LazyEnvVariable("INSTRUMENTATION_PROFILE_STAGE", default="", allow_empty=True)
+    GOOGLE_CREDENTIALS: dict = LazyEnvVariable("GOOGLE_CREDENTIALS_BASE64", parse=decode_base64_json)
+
+
+def get_db_engine() -> "Engine":
+    # Imported here so that processes which never connect to the database, such as the stage runner, do not load it
+    from sqlalchemy.engine import create_engine
 
-def get_db_engine() -> Engine:
     pg_user = EnvVariable.POSTGRES_USER
     pg_pass = EnvVariable.POSTGRES_PASSWORD
     pg_host = EnvVariable.POSTGRES_HOST
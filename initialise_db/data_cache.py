@@ -0,0 +1,252 @@
+import hashlib
+import logging
+import os
+import pathlib
+import time
+import uuid
+from typing import Optional
+
+import geoapis.vector
+import geopandas as gpd
+import pandas as pd
+
+import instrumentation
+from config import EnvVariable as Env
+
+log = logging.getLogger(__name__)
+
+# Stats NZ layers are versioned datasets whose version is part of their column names, e.g. SA12018_V1_00.
+# Bump the version here when the code switches to a newer release of a layer so that old cache entries are not reused.
+STATS_NZ_LAYER_VERSIONS = {
+    92210: "SA12018_V1_00",
+    92212: "SA22018_V1_00",
+    111198: "UR2023_V1_00",
+}
+
+
+def get_cache_dir(sub_directory: str) -> pathlib.Path:
+    """
+    Retrieves a directory within the local data cache, creating it if it does not exist.
+
+    Parameters
+    ----------
+    sub_directory : str
+        The name of the directory within DATA_CACHE_DIR.
+
+    Returns
+    -------
+    pathlib.Path
+        The path to the cache directory.
+    """
+    cache_dir = Env.DATA_CACHE_DIR / sub_directory
+    cache_dir.mkdir(parents=True, exist_ok=True)
+    return cache_dir
+
+
+def file_hash(path: pathlib.Path) -> str:
+    """
+    Hashes the content of a file.
+
+    Parameters
+    ----------
+    path : pathlib.Path
+        The file to hash.
+
+    Returns
+    -------
+    str
+        A short hex digest of the file content.
+    """
+    content_hash = hashlib.sha256()
+    with open(path, "rb") as file:
+        for block in iter(lambda: file.read(1024 * 1024), b""):
+            content_hash.update(block)
+    return content_hash.hexdigest()[:16]
+
+
+def file_fingerprint(path: pathlib.Path) -> str:
+    """
+    Identifies the current version of a file by its content hash and modification time.
+
+    Parameters
+    ----------
+    path : pathlib.Path
+        The file to fingerprint.
+
+    Returns
+    -------
+    str
+        A short hex digest that changes whenever the file is modified.
+    """
+    fingerprint = f"{file_hash(path)}|{path.stat().st_mtime_ns}"
+    return hashlib.sha256(fingerprint.encode()).hexdigest()[:16]
+
+
+def write_atomically(frame: pd.DataFrame, path: pathlib.Path) -> None:
+    """
+    Writes a DataFrame or GeoDataFrame to (Geo)Parquet through a temporary file, so that concurrent readers never see
+    a partial file.
+
+    Parameters
+    ----------
+    frame : pd.DataFrame
+        The data to write.
+    path : pathlib.Path
+        The final location of the Parquet file.
+
+    Returns
+    -------
+    None
+        This function does not return anything.
+    """
+    tmp_path = path.with_name(f".{path.name}.{uuid.uuid4().hex}.tmp")
+    try:
+        frame.to_parquet(tmp_path, index=True)
+        os.replace(tmp_path, path)
+    finally:
+        tmp_path.unlink(missing_ok=True)
+
+
+def evict_cache_entries(cache_dir: pathlib.Path, ttl_seconds: float, max_bytes: float) -> None:
+    """
+    Removes cache entries older than the time-to-live, then removes the oldest remaining entries until the cache
+    directory is within the maximum size.
+
+    Parameters
+    ----------
+    cache_dir : pathlib.Path
+        The cache directory to evict entries from.
+    ttl_seconds : float
+        The maximum age of a cache entry in seconds, measured from when it was written.
+    max_bytes : float
+        The maximum total size of the cache entries in the directory.
+
+    Returns
+    -------
+    None
+        This function does not return anything.
+    """
+    now = time.time()
+    entries = []
+    for path in cache_dir.glob("*.parquet"):
+        try:
+            stat = path.stat()
+        except FileNotFoundError:
+            # Removed by another thread while iterating
+            continue
+        if now - stat.st_mtime > ttl_seconds:
+            log.info(f"Evicting expired cache entry {path.name}")
+            path.unlink(missing_ok=True)
+        else:
+            entries.append((stat.st_mtime, stat.st_size, path))
+    total_bytes = sum(size for _, size, _ in entries)
+    for _, size, path in sorted(entries):
+        if total_bytes <= max_bytes:
+            break
+        log.info(f"Evicting cache entry {path.name} to keep cache under {max_bytes / 1e6:.0f} MB")
+        path.unlink(missing_ok=True)
+        total_bytes -= size
+
+
+class CachedStatsNz:
+    """
+    Drop-in replacement for geoapis.vector.StatsNz that keeps each downloaded layer in a local GeoParquet cache.
+    Cache entries are keyed by the layer id, layer version, bounding polygon and CRS, so repeat runs do not need the
+    network.
+
+    Parameters
+    ----------
+    key : str
+        The Stats NZ API key.
+    bounding_polygon : Optional[gpd.GeoDataFrame] = None
+        The area to fetch layers within. If None, layers are fetched nationally.
+    crs : Optional[int] = None
+        The EPSG code to fetch layers in. Defaults to the CRS of the bounding polygon, or if there is none, the layer's
+        native CRS, which for Stats NZ layers is NZTM (EPSG:2193).
+    refresh : Optional[bool] = None
+        If True, ignore existing cache entries and download layers again.
+        Defaults to the STATS_NZ_CACHE_REFRESH environment variable.
+    """
+
+    def __init__(self, key: str, bounding_polygon: Optional[gpd.GeoDataFrame] = None, crs: Optional[int] = None,
+                 refresh: Optional[bool] = None):
+        self.key = key
+        self.bounding_polygon = bounding_polygon
+        self.crs = crs
+        self.refresh = Env.STATS_NZ_CACHE_REFRESH if refresh is None else refresh
+        self.cache_dir = get_cache_dir("stats_nz")
+
+    def _bounding_polygon_hash(self) -> str:
+        if self.bounding_polygon is None:
+            return "national"
+        polygon_description = str(self.bounding_polygon.crs) + "|".join(self.bounding_polygon.geometry.to_wkt())
+        return hashlib.sha256(polygon_description.encode()).hexdigest()[:16]
+
+    def cache_path(self, layer: int) -> pathlib.Path:
+        """
+        Finds the cache file location for a layer fetched within this bounding polygon.
+
+        Parameters
+        ----------
+        layer : int
+            The Stats NZ layer id.
+
+        Returns
+        -------
+        pathlib.Path
+            The location of the cache entry, which may not exist yet.
+        """
+        layer_version = STATS_NZ_LAYER_VERSIONS.get(layer, "unversioned")
+        # Entries fetched without a CRS keep their original names, so existing caches stay valid
+        crs_suffix = "" if self.crs is None else f"_epsg{self.crs}"
+        return self.cache_dir / f"{layer}_{layer_version}_{self._bounding_polygon_hash()}{crs_suffix}.parquet"
+
+    def is_cached(self, layer: int) -> bool:
+        """
+        Checks whether run would read a layer from the cache rather than download it.
+
+        Parameters
+        ----------
+        layer : int
+            The Stats NZ layer id.
+
+        Returns
+        -------
+        bool
+            True if the layer has a cache entry younger than STATS_NZ_CACHE_TTL_DAYS, and refresh is not set.
+        """
+        cache_path = self.cache_path(layer)
+        ttl_seconds = Env.STATS_NZ_CACHE_TTL_DAYS * 24 * 60 * 60
+        return not self.refresh and cache_path.exists() and time.time() - cache_path.stat().st_mtime <= ttl_seconds
+
+    def run(self, layer: int) -> gpd.GeoDataFrame:
+        """
+        Reads a Stats NZ layer from the cache, downloading and caching it first if required.
+
+        Parameters
+        ----------
+        layer : int
+            The Stats NZ layer id.
+
+        Returns
+        -------
+        gpd.GeoDataFrame
+            The layer features within the bounding polygon.
+        """
+        cache_path = self.cache_path(layer)
+        ttl_seconds = Env.STATS_NZ_CACHE_TTL_DAYS * 24 * 60 * 60
+        if self.is_cached(layer):
+            log.info(f"Reading Stats NZ layer {layer} from cache {cache_path.name}")
+            with instrumentation.span("stats_nz_cache_read", layer=layer) as read_span:
+                layer_gdf = gpd.read_parquet(cache_path)
+                read_span.rows_out = len(layer_gdf)
+            return layer_gdf
+
+        log.info(f"Fetching Stats NZ layer {layer}")
+        vector_fetcher = geoapis.vector.StatsNz(key=self.key, bounding_polygon=self.bounding_polygon, crs=self.crs)
+        with instrumentation.span("stats_nz_fetch", layer=layer) as fetch_span:
+            layer_gdf = vector_fetcher.run(layer)
+            fetch_span.rows_out = len(layer_gdf)
+        write_atomically(layer_gdf, cache_path)
+        evict_cache_entries(self.cache_dir, ttl_seconds, Env.DATA_CACHE_MAX_MB * 1e6)
+        return layer_gdf
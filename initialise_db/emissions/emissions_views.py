@@ -0,0 +1,90 @@
+import logging
+
+import sqlalchemy
+
+from config import get_db_engine
+from geometry_simplification import SA1_SIMPLIFICATION_LEVELS, create_simplified_geometry_views
+from materialised_views import MaterialisedView, refresh_materialised_views
+
+log = logging.getLogger(__name__)
+
+SA1_EMISSIONS_ALL_CARS_VIEW = MaterialisedView(
+    name="sa1_emissions_all_cars",
+    query="""
+        SELECT sa1s."SA12018_V1_00",
+               "geometry",
+               "AREA_SQ_KM",
+               "UR2023_V1_00_NAME",
+               -- VKT and CO2 are stored as single precision, so they are summed as double precision
+               sum("VKT ('000 km/Year)"::double precision)                                               AS "VKT",
+               sum(CASE WHEN fuel_type = 'Petrol' THEN "CO2 (Tonnes/Year)"::double precision END)        AS "CO2_Petrol",
+               sum(CASE WHEN fuel_type = 'Diesel' THEN "CO2 (Tonnes/Year)"::double precision END)        AS "CO2_Diesel",
+               sum(CASE WHEN fuel_type = 'Electric' THEN "CO2 (Tonnes/Year)"::double precision END)      AS "CO2_Electric",
+               sum(CASE WHEN fuel_type = 'Hybrid' THEN "CO2 (Tonnes/Year)"::double precision END)        AS "CO2_Hybrid",
+               sum(CASE WHEN fuel_type = 'Plugin Hybrid' THEN "CO2 (Tonnes/Year)"::double precision END) AS "CO2_Plugin_Hybrid"
+
+        FROM vehicle_stats
+            JOIN sa1s
+                ON vehicle_stats."SA12018_V1_00" = sa1s."SA12018_V1_00"
+
+        GROUP BY sa1s."SA12018_V1_00", "geometry", "AREA_SQ_KM", "UR2023_V1_00_NAME"
+    """,
+    unique_columns=["SA12018_V1_00"],
+    index_columns=["UR2023_V1_00_NAME"],
+    geometry_column="geometry",
+)
+
+VKT_SUM_VIEW = MaterialisedView(
+    name="vkt_sum",
+    query="""
+        SELECT fuel_type::text AS fuel_type,
+               "UR2023_V1_00_NAME",
+               SUM("VKT ('000 km/Year)"::double precision) AS "VKT",
+               SUM("CO2 (Tonnes/Year)"::double precision)  AS "CO2"
+
+        FROM sa1s
+            INNER JOIN vehicle_stats vs
+                ON sa1s."SA12018_V1_00" = vs."SA12018_V1_00"
+
+        GROUP BY vs.fuel_type,
+                 "UR2023_V1_00_NAME"
+        ORDER BY "UR2023_V1_00_NAME", "VKT" DESC
+    """,
+    unique_columns=["fuel_type", "UR2023_V1_00_NAME"],
+    index_columns=["UR2023_V1_00_NAME"],
+)
+
+SA1_SIMPLIFIED_VIEWS = create_simplified_geometry_views(
+    "sa1s", "SA12018_V1_00",
+    attribute_columns=["UR2023_V1_00_NAME", "AREA_SQ_KM"],
+    index_columns=["UR2023_V1_00_NAME"],
+    coverage_columns=["UR2023_V1_00_NAME"],
+    levels=SA1_SIMPLIFICATION_LEVELS,
+)
+
+EMISSIONS_VIEWS = [SA1_EMISSIONS_ALL_CARS_VIEW, VKT_SUM_VIEW, *SA1_SIMPLIFIED_VIEWS]
+
+
+def refresh_emissions_views(engine: sqlalchemy.engine.Engine) -> None:
+    """
+    Creates or refreshes the materialised views that aggregate vehicle_stats and simplify sa1s for GeoServer.
+    Should run whenever sa1s or vehicle_stats are reloaded.
+
+    Parameters
+    ----------
+    engine : sqlalchemy.engine.Engine
+        The engine connected to the PostGIS database.
+
+    Returns
+    -------
+    None
+        This function does not return anything.
+    """
+    log.info("Refreshing SA1 emissions materialised views")
+    refresh_materialised_views(engine, EMISSIONS_VIEWS)
+    log.info("SA1 emissions materialised views refreshed")
+
+
+if __name__ == '__main__':
+    engine = get_db_engine()
+    refresh_emissions_views(engine)
@@ -0,0 +1,3 @@
+# Fuel types that vehicle types end with. Vehicle types without one of these are diesel.
+# Kept free of imports, so the GeoServer stage can validate fuel types without loading the data pipeline.
+FUEL_TYPES = ["Petrol", "Diesel", "Electric", "Plugin Hybrid", "Hybrid"]
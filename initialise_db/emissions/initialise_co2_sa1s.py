@@ -1,71 +1,161 @@
+import functools
 import logging
+import pathlib
+from typing import List, Optional, Sequence
 
-import geoapis.vector
 import geopandas as gpd
+import numpy as np
 import pandas as pd
+import instrumentation
+import national_geographies
 import sqlalchemy
 import stats_nz_geographies
+from build_manifest import fingerprint, rebuild_changed_areas, rebuild_changed_areas_from_query
 from config import EnvVariable as Env
 from config import get_db_engine
+from data_cache import CachedStatsNz, file_fingerprint, file_hash, get_cache_dir, write_atomically
+from emissions.emissions_views import EMISSIONS_VIEWS, refresh_emissions_views
+from emissions.fuel_types import FUEL_TYPES
+from materialised_views import create_materialised_views_if_not_exist
+from table_indexes import ensure_table_indexes
+from table_schemas import describe_schema
 
 log = logging.getLogger(__name__)
 
 
-def find_sa1s_in_areas_of_interest() -> gpd.GeoDataFrame:
-    return pd.concat([find_sa1s_in_area(aoi) for aoi in stats_nz_geographies.AREAS_OF_INTEREST])
+def find_sa1s_in_areas_of_interest(
+        areas_of_interest: Sequence[stats_nz_geographies.AreaOfInterest] = stats_nz_geographies.AREAS_OF_INTEREST
+) -> gpd.GeoDataFrame:
+    # The urban/rural layer is fetched nationally in the CRS of the sa1s, so one filter serves every area
+    urban_area_filter = stats_nz_geographies.fetch_urban_area_filter(
+        CachedStatsNz(key=Env.STATS_API_KEY, crs=4326), [aoi.ua_name for aoi in areas_of_interest])
+    return pd.concat(stats_nz_geographies.fetch_for_areas_of_interest(
+        functools.partial(find_sa1s_in_area, urban_area_filter=urban_area_filter), areas_of_interest))
 
 
-def find_sa1s_in_area(area_of_interest: stats_nz_geographies.AreaOfInterest) -> gpd.GeoDataFrame:
+def find_sa1s_in_area(area_of_interest: stats_nz_geographies.AreaOfInterest,
+                      urban_area_filter: Optional[stats_nz_geographies.UrbanAreaFilter] = None) -> gpd.GeoDataFrame:
     # All SA1s in bbox
-    vector_fetcher = geoapis.vector.StatsNz(key=Env.STATS_API_KEY,
-                                            bounding_polygon=area_of_interest.bbox.as_gdf())
+    vector_fetcher = CachedStatsNz(key=Env.STATS_API_KEY, bounding_polygon=area_of_interest.bbox.as_gdf())
     sa1s = vector_fetcher.run(92210)
     sa1s.set_index("SA12018_V1_00", verify_integrity=True, inplace=True)
     sa1s.index = sa1s.index.astype('int64')
-    sa1s_in_urban_area = stats_nz_geographies.filter_gdf_by_urban_rural_area(sa1s,
-                                                                             area_of_interest.ua_name,
-                                                                             vector_fetcher)
+    sa1s_in_urban_area = stats_nz_geographies.filter_gdf_by_urban_rural_area(
+        sa1s, area_of_interest.ua_name, vector_fetcher, urban_area_filter=urban_area_filter)
     # Filter to remove SA1s that represent inlets and other non-mainland features.
     return sa1s_in_urban_area.loc[sa1s_in_urban_area["LANDWATER_NAME"] == "Mainland"]
 
 
+def read_emissions_workbook(data_file: pathlib.Path) -> pd.DataFrame:
+    """
+    Reads the SA1 emissions sheet of the emissions workbook, keeping its two-level column header.
+    The first read converts the sheet to a Parquet cache keyed by the workbook fingerprint, which is reused until the
+    workbook changes.
+
+    Parameters
+    ----------
+    data_file : pathlib.Path
+        The emissions Excel workbook.
+
+    Returns
+    -------
+    pd.DataFrame
+        The emissions data indexed by SA1, with (vehicle type, variable) columns.
+    """
+    cache_dir = get_cache_dir("emissions")
+    cache_path = cache_dir / f"{data_file.stem}_{file_fingerprint(data_file)}.parquet"
+    if cache_path.exists():
+        log.info(f"Reading {data_file} from cache {cache_path.name}")
+        with instrumentation.span("emissions_cache_read", file=cache_path.name) as read_span:
+            emissions_data = pd.read_parquet(cache_path)
+            read_span.rows_out = len(emissions_data)
+        return emissions_data
+
+    log.info(f"Reading {data_file} into memory using {Env.EMISSIONS_EXCEL_ENGINE}")
+    with instrumentation.span("excel_read", file=data_file.name, engine=Env.EMISSIONS_EXCEL_ENGINE) as read_span:
+        emissions_data = pd.read_excel(data_file, header=[0, 1], index_col=0, sheet_name=3,
+                                       engine=Env.EMISSIONS_EXCEL_ENGINE)
+        read_span.rows_out = len(emissions_data)
+    write_atomically(emissions_data, cache_path)
+    # Remove conversions of previous versions of the workbook
+    for stale_cache_path in cache_dir.glob(f"{data_file.stem}_*.parquet"):
+        if stale_cache_path != cache_path:
+            stale_cache_path.unlink(missing_ok=True)
+    return emissions_data
+
+
 def read_emissions_and_filter_by_sa1s(sa1s: gpd.GeoDataFrame) -> gpd.GeoDataFrame:
-    data_file = Env.EMISSIONS_DATA
-    log.info(f"Reading {data_file} into memory")
-    emissions_data = pd.read_excel(data_file, header=[0, 1], index_col=0, sheet_name=3)
+    emissions_data = read_emissions_workbook(Env.EMISSIONS_DATA)
     log.info("Filtering data for relevant SA1s")
     return emissions_data.loc[emissions_data.index.isin(sa1s.index)]
 
 
-def get_long_format_sa1_emissions(emissions_data) -> pd.DataFrame:
+def get_long_format_sa1_emissions(emissions_data: pd.DataFrame) -> pd.DataFrame:
+    """
+    Reshapes the wide emissions data, which has one (vehicle type, variable) column per combination, into a long
+    format DataFrame indexed by (SA1, Vehicle Type) with one column per variable.
+
+    Parameters
+    ----------
+    emissions_data : pd.DataFrame
+        The emissions data indexed by SA1, with (vehicle type, variable) columns.
+
+    Returns
+    -------
+    pd.DataFrame
+        The emissions data indexed by (SA1, Vehicle Type), with one column for each variable, e.g. VKT and CO2.
+        Rows are grouped by SA1 in the input order, then sorted by vehicle type. Variables are sorted by name.
+    """
     log.info("Converting to long format DataFrame")
-    vehicle_types, variables = (level.values.tolist() for level in emissions_data.columns.levels)
-    melts = []
-    for var in variables:
-        if var.startswith("Unnamed"):
-            break
-        melt = emissions_data.melt(ignore_index=False, var_name="Vehicle Type", value_name=var,
-                                   value_vars=[(vehicle_type, var) for vehicle_type in vehicle_types])
-        melt.set_index('Vehicle Type', append=True, inplace=True)
-        melts.append(melt)
-    merged = pd.merge(melts[0], melts[1], left_index=True, right_index=True)
-    return merged.rename(columns=lambda name: name.replace("\n", " "))
+    # Drop the spreadsheet's unlabelled columns, which are not variables
+    is_variable = ~emissions_data.columns.get_level_values(1).str.startswith("Unnamed")
+    emissions_data = emissions_data.loc[:, is_variable]
+    emissions_data.columns = emissions_data.columns.remove_unused_levels()
+    # A single stack moves the vehicle type level into the index for every variable at once
+    long_emissions = emissions_data.stack(level=0, dropna=False)
+    long_emissions.index = long_emissions.index.set_names([emissions_data.index.name, "Vehicle Type"])
+    long_emissions.columns.name = None
+    return long_emissions.rename(columns=lambda name: name.replace("\n", " "))
 
 
 def split_vehicle_type(df: pd.DataFrame) -> pd.DataFrame:
-    fuel_types = ["Petrol", "Diesel", "Electric", "Plugin Hybrid", "Hybrid"]
+    """
+    Splits the Vehicle Type index level into vehicle_class and fuel_type categorical columns.
+    There are only a few dozen distinct vehicle types, so each is split once and the result broadcast to every row
+    through the categorical codes, instead of running a regular expression over every row.
+
+    Parameters
+    ----------
+    df : pd.DataFrame
+        The long format emissions data, indexed by (SA1, Vehicle Type).
+
+    Returns
+    -------
+    pd.DataFrame
+        The emissions data indexed by (SA12018_V1_00, vehicle_class, fuel_type).
+    """
     log.info("Splitting vehicle class and fuel type")
     df = df.reset_index()
+    vehicle_types = df["Vehicle Type"].astype("category")
+    unique_vehicle_types = pd.Series(vehicle_types.cat.categories)
     # Splitting vehicle class and fuel type
     # Regular expression pattern to capture both vehicle class and fuel type
-    pattern = f'(?P<vehicle_class>.*?)\s*({"|".join(fuel_types)})$'
+    pattern = f'(?P<vehicle_class>.*?)\s*({"|".join(FUEL_TYPES)})$'
 
-    # Extracting vehicle class and fuel type
-    df[['vehicle_class', 'fuel_type']] = df['Vehicle Type'].str.extract(pattern)
+    # Extracting vehicle class and fuel type for each distinct vehicle type
+    splits = unique_vehicle_types.str.extract(pattern)
+    splits.columns = ["vehicle_class", "fuel_type"]
 
     # Values that don't specify a valid fuel type are set to na, so replace these with valid values.
-    df['fuel_type'].fillna("Diesel", inplace=True)
-    df['vehicle_class'].fillna(df['Vehicle Type'], inplace=True)
+    splits["fuel_type"] = splits["fuel_type"].fillna("Diesel")
+    splits["vehicle_class"] = splits["vehicle_class"].fillna(unique_vehicle_types)
+
+    # Broadcast each split back to the rows using the vehicle type codes
+    vehicle_type_codes = vehicle_types.cat.codes.to_numpy()
+    for column in ["vehicle_class", "fuel_type"]:
+        split_categorical = pd.Categorical(splits[column])
+        codes = np.where(vehicle_type_codes >= 0, split_categorical.codes[vehicle_type_codes], -1)
+        df[column] = pd.Categorical.from_codes(codes, categories=split_categorical.categories)
 
     # Clean up dataframe, renaming columns and deleting redundant columns
     df = df.drop(columns=["Vehicle Type"])
@@ -75,30 +165,66 @@ def split_vehicle_type(df: pd.DataFrame) -> pd.DataFrame:
 
 def initialise_co2_sa1s(engine: sqlalchemy.engine.Engine) -> None:
     sa1s_table_name = "sa1s"
-    index_col = "SA12018_V1_00"
-    if sqlalchemy.inspect(engine).has_table(sa1s_table_name):
-        log.info(f"Table {sa1s_table_name} exists, reading")
-        sa1_ids = pd.read_sql(f'SELECT "{index_col}" FROM {sa1s_table_name}', engine, index_col=index_col)
-    else:
-        log.info(f"Table {sa1s_table_name} does not exist, initialising...")
-        sa1s = find_sa1s_in_areas_of_interest()
-        sa1s.to_postgis(sa1s_table_name, engine, if_exists="replace", index=True)
-        sa1_ids = sa1s[[]]  # Only save the index since its all we need
-        log.info(f"Table {sa1s_table_name} initialised.")
     vehicle_stats_table_name = "vehicle_stats"
-    if sqlalchemy.inspect(engine).has_table(vehicle_stats_table_name):
-        log.info(f"Table {vehicle_stats_table_name} exists, skipping")
+    index_col = "SA12018_V1_00"
+    code_version = file_hash(pathlib.Path(__file__))
+    areas_of_interest = {aoi.ua_name: aoi for aoi in stats_nz_geographies.AREAS_OF_INTEREST}
+
+    def build_sa1s(area_names: List[str]) -> gpd.GeoDataFrame:
+        return find_sa1s_in_areas_of_interest([areas_of_interest[area_name] for area_name in area_names])
+
+    if national_geographies.is_enabled():
+        sa1s_inputs = national_geographies.get_area_inputs(engine, "national_sa1s", code_version)
+        sa1s_reloaded = rebuild_changed_areas_from_query(
+            engine, sa1s_table_name, sa1s_inputs,
+            # Filter to remove SA1s that represent inlets and other non-mainland features.
+            national_geographies.select_polygons_in_urban_areas(
+                "national_sa1s", condition="polygons.\"LANDWATER_NAME\" = 'Mainland'"),
+            area_condition='"UR2023_V1_00_NAME" = ANY(%(areas)s)',
+        )
     else:
-        log.info(f"Table {vehicle_stats_table_name} does not exist, initialising...")
+        sa1s_inputs = {
+            area_name: {"area_of_interest": aoi, "code_version": code_version,
+                        "urban_area_predicate": Env.URBAN_AREA_PREDICATE}
+            for area_name, aoi in areas_of_interest.items()
+        }
+        sa1s_reloaded = rebuild_changed_areas(
+            engine, sa1s_table_name, sa1s_inputs, build_sa1s,
+            area_condition='"UR2023_V1_00_NAME" = ANY(%(areas)s)',
+        )
+
+    def build_vehicle_stats(area_names: List[str]) -> pd.DataFrame:
+        sa1_ids = pd.read_sql(
+            f'SELECT "{index_col}" FROM {sa1s_table_name} WHERE "UR2023_V1_00_NAME" = ANY(%(areas)s)',
+            engine, index_col=index_col, params={"areas": area_names})
         emissions = read_emissions_and_filter_by_sa1s(sa1_ids)
         emissions = get_long_format_sa1_emissions(emissions)
-        emissions = split_vehicle_type(emissions)
-        log.info(f"Saving {vehicle_stats_table_name} to database.")
-        emissions.to_sql(vehicle_stats_table_name, engine, if_exists="replace", index=True,
-                         index_label=[index_col, "vehicle_class", "fuel_type"])
-        log.info(f"Table {vehicle_stats_table_name} initialised.")
+        return split_vehicle_type(emissions)
+
+    emissions_data_hash = file_hash(Env.EMISSIONS_DATA)
+    vehicle_stats_inputs = {
+        area_name: {"emissions_data": emissions_data_hash, "code_version": code_version, "sa1s": fingerprint(inputs),
+                    "schema": describe_schema(vehicle_stats_table_name)}
+        for area_name, inputs in sa1s_inputs.items()
+    }
+    vehicle_stats_reloaded = rebuild_changed_areas(
+        engine, vehicle_stats_table_name, vehicle_stats_inputs, build_vehicle_stats,
+        # Rows for the areas, plus any left behind by SA1s that were removed when sa1s was rebuilt
+        area_condition=f'''
+            "{index_col}" IN (SELECT "{index_col}" FROM {sa1s_table_name} WHERE "UR2023_V1_00_NAME" = ANY(%(areas)s))
+            OR NOT EXISTS (SELECT 1 FROM {sa1s_table_name} sa1s
+                           WHERE sa1s."{index_col}" = {vehicle_stats_table_name}."{index_col}")
+        ''',
+        index_label=[index_col, "vehicle_class", "fuel_type"],
+    )
+
+    ensure_table_indexes(engine, [sa1s_table_name, vehicle_stats_table_name])
+    if sa1s_reloaded or vehicle_stats_reloaded:
+        refresh_emissions_views(engine)
+    else:
+        create_materialised_views_if_not_exist(engine, EMISSIONS_VIEWS)
 
 
 if __name__ == '__main__':
     engine = get_db_engine()
-    initialise_co2_sa1s()
+    initialise_co2_sa1s(engine)
@@ -0,0 +1,211 @@
+import gzip
+import json
+import logging
+import os
+import pathlib
+import shutil
+from typing import Dict, List
+
+import geopandas as gpd
+import sqlalchemy
+
+import stats_nz_geographies
+from build_manifest import BuildManifest
+from config import EnvVariable as Env, get_db_engine
+from data_cache import file_hash
+from emissions.fuel_types import FUEL_TYPES
+
+log = logging.getLogger(__name__)
+
+EXPORTS_STAGE_NAME = "sa1_emissions_exports"
+
+
+def get_exports_dir() -> pathlib.Path:
+    return Env.STATIC_DATA_DIR / "emissions"
+
+
+def get_fuel_type_file_stem(fuel_type: str) -> str:
+    return fuel_type.lower().replace(" ", "_")
+
+
+def read_sa1_emissions_by_fuel_type(engine: sqlalchemy.engine.Engine, urban_area_name: str) -> gpd.GeoDataFrame:
+    """
+    Reads the CO2 and VKT of every SA1 in an urban area, summed over vehicle classes for each fuel type.
+
+    Parameters
+    ----------
+    engine : sqlalchemy.engine.Engine
+        The engine connected to the PostGIS database.
+    urban_area_name : str
+        The UR2023_V1_00_NAME of the urban area.
+
+    Returns
+    -------
+    gpd.GeoDataFrame
+        One row per SA1 and fuel type.
+    """
+    query = """
+        SELECT sa1s."SA12018_V1_00",
+               sa1s."UR2023_V1_00_NAME",
+               sa1s."AREA_SQ_KM",
+               vs.fuel_type::text                            AS fuel_type,
+               sum(vs."CO2 (Tonnes/Year)"::double precision)  AS "CO2",
+               sum(vs."VKT ('000 km/Year)"::double precision) AS "VKT",
+               sa1s.geometry
+        FROM sa1s
+            INNER JOIN vehicle_stats vs
+                ON sa1s."SA12018_V1_00" = vs."SA12018_V1_00"
+        WHERE sa1s."UR2023_V1_00_NAME" = %(urban_area_name)s
+        GROUP BY sa1s."SA12018_V1_00", sa1s."UR2023_V1_00_NAME", sa1s."AREA_SQ_KM", vs.fuel_type, sa1s.geometry
+    """
+    return gpd.read_postgis(query, engine, geom_col="geometry", params={"urban_area_name": urban_area_name})
+
+
+def write_bytes_atomically(data: bytes, path: pathlib.Path) -> None:
+    temp_path = path.with_name(f".{path.name}.{os.getpid()}.tmp")
+    temp_path.write_bytes(data)
+    os.replace(temp_path, path)
+
+
+def write_flatgeobuf(frame: gpd.GeoDataFrame, path: pathlib.Path) -> None:
+    """
+    Writes a FlatGeobuf file with a packed R-tree, so clients can fetch only the features in a bounding box with
+    HTTP range requests. The file is written next to its destination and moved into place.
+
+    Parameters
+    ----------
+    frame : gpd.GeoDataFrame
+        The features to write.
+    path : pathlib.Path
+        The .fgb file to write.
+
+    Returns
+    -------
+    None
+        This function does not return anything.
+    """
+    temp_path = path.with_name(f".{path.stem}.{os.getpid()}.tmp.fgb")
+    try:
+        frame.to_file(temp_path, driver="FlatGeobuf", SPATIAL_INDEX="YES")
+        os.replace(temp_path, path)
+    finally:
+        temp_path.unlink(missing_ok=True)
+
+
+def write_compressed_geojson(frame: gpd.GeoDataFrame, path: pathlib.Path) -> List[pathlib.Path]:
+    """
+    Writes a GeoJSON file along with a gzip copy, which nginx serves with gzip_static instead of compressing on every
+    request. Only gzip is provided, since the nginx image does not include the brotli module.
+
+    Parameters
+    ----------
+    frame : gpd.GeoDataFrame
+        The features to write.
+    path : pathlib.Path
+        The .geojson file to write. The gzip copy is written alongside with a .gz suffix.
+
+    Returns
+    -------
+    List[pathlib.Path]
+        The files that were written.
+    """
+    geojson = frame.to_json(drop_id=True).encode()
+    written = {path: geojson, path.with_name(f"{path.name}.gz"): gzip.compress(geojson, compresslevel=9, mtime=0)}
+    for written_path, data in written.items():
+        write_bytes_atomically(data, written_path)
+    return list(written)
+
+
+def export_area(engine: sqlalchemy.engine.Engine, urban_area_name: str) -> Dict[str, Dict[str, str]]:
+    """
+    Writes one FlatGeobuf and one GeoJSON file, with a gzip copy, per fuel type for an urban area.
+
+    Parameters
+    ----------
+    engine : sqlalchemy.engine.Engine
+        The engine connected to the PostGIS database.
+    urban_area_name : str
+        The UR2023_V1_00_NAME of the urban area.
+
+    Returns
+    -------
+    Dict[str, Dict[str, str]]
+        For each fuel type with data, the paths of its files relative to the exports directory, by format.
+    """
+    exports_dir = get_exports_dir()
+    area_dir = exports_dir / urban_area_name
+    area_dir.mkdir(parents=True, exist_ok=True)
+    sa1_emissions = read_sa1_emissions_by_fuel_type(engine, urban_area_name)
+    exported = {}
+    for fuel_type in FUEL_TYPES:
+        fuel_type_emissions = sa1_emissions.loc[sa1_emissions["fuel_type"] == fuel_type]
+        if fuel_type_emissions.empty:
+            log.warning(f"No {fuel_type} emissions for {urban_area_name}, skipping export")
+            continue
+        file_stem = get_fuel_type_file_stem(fuel_type)
+        flatgeobuf_path = area_dir / f"{file_stem}.fgb"
+        geojson_path = area_dir / f"{file_stem}.geojson"
+        write_flatgeobuf(fuel_type_emissions, flatgeobuf_path)
+        write_compressed_geojson(fuel_type_emissions, geojson_path)
+        exported[fuel_type] = {
+            "flatgeobuf": flatgeobuf_path.relative_to(exports_dir).as_posix(),
+            "geojson": geojson_path.relative_to(exports_dir).as_posix(),
+        }
+    log.info(f"Exported {list(exported)} emissions for {urban_area_name} to {area_dir}")
+    return exported
+
+
+def export_sa1_emissions(engine: sqlalchemy.engine.Engine) -> None:
+    """
+    Exports the SA1 emissions of every area of interest and fuel type as static files for the www container, with an
+    index.json listing them. Only areas whose SA1s or vehicle stats changed, or whose files are missing, are exported
+    again.
+
+    Parameters
+    ----------
+    engine : sqlalchemy.engine.Engine
+        The engine connected to the PostGIS database.
+
+    Returns
+    -------
+    None
+        This function does not return anything.
+    """
+    exports_dir = get_exports_dir()
+    index_path = exports_dir / "index.json"
+    code_version = file_hash(pathlib.Path(__file__))
+    sa1s_fingerprints = BuildManifest(engine, "sa1s").recorded_fingerprints
+    vehicle_stats_fingerprints = BuildManifest(engine, "vehicle_stats").recorded_fingerprints
+    area_inputs = {
+        aoi.ua_name: {
+            "code_version": code_version,
+            "fuel_types": FUEL_TYPES,
+            "sa1s": sa1s_fingerprints.get(aoi.ua_name),
+            "vehicle_stats": vehicle_stats_fingerprints.get(aoi.ua_name),
+        }
+        for aoi in stats_nz_geographies.AREAS_OF_INTEREST
+    }
+
+    manifest = BuildManifest(engine, EXPORTS_STAGE_NAME)
+    index = json.loads(index_path.read_text()) if index_path.exists() else {}
+    # Also export areas missing from the index, such as when the static volume was recreated
+    inputs_changed = set(manifest.find_changed_areas(area_inputs))
+    changed_areas = [area for area in area_inputs if area in inputs_changed or area not in index]
+    removed_areas = manifest.find_removed_areas(area_inputs)
+    if not changed_areas and not removed_areas:
+        log.info(f"SA1 emissions exports in {exports_dir} are up to date, skipping")
+        return
+
+    exports_dir.mkdir(parents=True, exist_ok=True)
+    for area in removed_areas:
+        log.info(f"Removing SA1 emissions exports for {area}")
+        shutil.rmtree(exports_dir / area, ignore_errors=True)
+        index.pop(area, None)
+    for area in changed_areas:
+        index[area] = export_area(engine, area)
+    write_bytes_atomically(json.dumps(index, indent=2, sort_keys=True).encode(), index_path)
+    manifest.record({area: area_inputs[area] for area in changed_areas}, removed_areas)
+
+
+if __name__ == '__main__':
+    export_sa1_emissions(get_db_engine())
@@ -0,0 +1,285 @@
+import gzip
+import logging
+import math
+import os
+import pathlib
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Iterator, List, NamedTuple, Sequence, Tuple
+
+import sqlalchemy
+from pmtiles.tile import Compression, TileType, zxy_to_tileid
+from pmtiles.writer import Writer
+
+import stats_nz_geographies
+from build_manifest import BuildManifest
+from config import EnvVariable as Env, get_db_engine
+from data_cache import file_hash
+from emissions.emissions_views import SA1_EMISSIONS_ALL_CARS_VIEW
+
+log = logging.getLogger(__name__)
+
+TILE_LAYER_NAME = "sa1_emissions"
+TILE_EXTENT = 4096
+TILE_BUFFER = 64
+# Attributes of sa1_emissions_all_cars carried into each tile feature, with their vector_layers field types
+TILE_ATTRIBUTES = {
+    "SA12018_V1_00": "Number",
+    "UR2023_V1_00_NAME": "String",
+    "AREA_SQ_KM": "Number",
+    "VKT": "Number",
+    "CO2_Petrol": "Number",
+    "CO2_Diesel": "Number",
+    "CO2_Electric": "Number",
+    "CO2_Hybrid": "Number",
+    "CO2_Plugin_Hybrid": "Number",
+}
+
+Tile = Tuple[int, int, int]
+
+
+class TileZoomRange(NamedTuple):
+    min_zoom: int
+    max_zoom: int
+
+
+DEFAULT_ZOOM_RANGE = TileZoomRange(min_zoom=8, max_zoom=14)
+AREA_ZOOM_RANGES = {
+    # The bounding box covers a large rural area, so stop a level earlier to keep the tile count down
+    "Queenstown": TileZoomRange(min_zoom=7, max_zoom=13),
+}
+
+
+def get_tiles_path() -> pathlib.Path:
+    return Env.STATIC_DATA_DIR / "tiles" / f"{TILE_LAYER_NAME}.pmtiles"
+
+
+def lng_lat_to_tile(lng: float, lat: float, zoom: int) -> Tuple[int, int]:
+    """
+    Finds the web mercator (XYZ) tile containing a point.
+
+    Parameters
+    ----------
+    lng : float
+        The longitude of the point in degrees.
+    lat : float
+        The latitude of the point in degrees.
+    zoom : int
+        The zoom level of the tile.
+
+    Returns
+    -------
+    Tuple[int, int]
+        The x and y index of the tile.
+    """
+    num_tiles = 2 ** zoom
+    x = int((lng + 180) / 360 * num_tiles)
+    y = int((1 - math.asinh(math.tan(math.radians(lat))) / math.pi) / 2 * num_tiles)
+    return min(max(x, 0), num_tiles - 1), min(max(y, 0), num_tiles - 1)
+
+
+def find_tiles_in_bbox(bbox: stats_nz_geographies.Bbox, zoom_range: TileZoomRange) -> Iterator[Tile]:
+    """
+    Lists every tile that overlaps a bounding box, across a range of zoom levels.
+
+    Parameters
+    ----------
+    bbox : stats_nz_geographies.Bbox
+        The bounding box in EPSG:4326.
+    zoom_range : TileZoomRange
+        The inclusive range of zoom levels.
+
+    Returns
+    -------
+    Iterator[Tile]
+        The (z, x, y) of each tile.
+    """
+    min_lng, min_lat, max_lng, max_lat = bbox.as_shapely_polygon().bounds
+    for zoom in range(zoom_range.min_zoom, zoom_range.max_zoom + 1):
+        # Tile y indices increase southwards
+        min_x, min_y = lng_lat_to_tile(min_lng, max_lat, zoom)
+        max_x, max_y = lng_lat_to_tile(max_lng, min_lat, zoom)
+        for x in range(min_x, max_x + 1):
+            for y in range(min_y, max_y + 1):
+                yield zoom, x, y
+
+
+def find_tiles_for_areas_of_interest(
+        areas_of_interest: Sequence[stats_nz_geographies.AreaOfInterest] = stats_nz_geographies.AREAS_OF_INTEREST
+) -> List[Tile]:
+    """
+    Lists the tiles to build for every area of interest, without duplicates, in PMTiles tile id order.
+
+    Parameters
+    ----------
+    areas_of_interest : Sequence[stats_nz_geographies.AreaOfInterest] = AREAS_OF_INTEREST
+        The areas of interest to build tiles for, each over its zoom range from AREA_ZOOM_RANGES.
+
+    Returns
+    -------
+    List[Tile]
+        The (z, x, y) of each tile, sorted by tile id so the archive is clustered.
+    """
+    tiles = {
+        tile
+        for aoi in areas_of_interest
+        for tile in find_tiles_in_bbox(aoi.bbox, AREA_ZOOM_RANGES.get(aoi.ua_name, DEFAULT_ZOOM_RANGE))
+    }
+    return sorted(tiles, key=lambda tile: zxy_to_tileid(*tile))
+
+
+def build_tile(engine: sqlalchemy.engine.Engine, tile: Tile) -> bytes:
+    """
+    Encodes the SA1 emissions polygons that overlap a tile as a Mapbox Vector Tile with PostGIS.
+
+    Parameters
+    ----------
+    engine : sqlalchemy.engine.Engine
+        The engine connected to the PostGIS database.
+    tile : Tile
+        The (z, x, y) of the tile.
+
+    Returns
+    -------
+    bytes
+        The uncompressed tile, which is empty if no polygons overlap it.
+    """
+    attributes = ", ".join(f'"{attribute}"' for attribute in TILE_ATTRIBUTES)
+    query = sqlalchemy.text(f"""
+        WITH bounds AS (
+            SELECT ST_TileEnvelope(:z, :x, :y) AS geom
+        ),
+        features AS (
+            SELECT ST_AsMVTGeom(ST_Transform(sa1s.geometry, 3857), bounds.geom, {TILE_EXTENT}, {TILE_BUFFER})
+                       AS geom,
+                   {attributes}
+            FROM {SA1_EMISSIONS_ALL_CARS_VIEW.name} sa1s, bounds
+            -- Filter in the view's own SRID so the spatial index is used
+            WHERE sa1s.geometry && ST_Transform(bounds.geom, 4326)
+        )
+        SELECT ST_AsMVT(features, '{TILE_LAYER_NAME}', {TILE_EXTENT}, 'geom')
+        FROM features
+        WHERE geom IS NOT NULL
+    """)
+    z, x, y = tile
+    with engine.connect() as connection:
+        tile_data = connection.execute(query, {"z": z, "x": x, "y": y}).scalar()
+    return bytes(tile_data) if tile_data is not None else b""
+
+
+def write_tiles(engine: sqlalchemy.engine.Engine,
+                tiles: Sequence[Tile],
+                areas_of_interest: Sequence[stats_nz_geographies.AreaOfInterest],
+                tiles_path: pathlib.Path,
+                max_workers: int) -> int:
+    """
+    Builds tiles concurrently and writes the non-empty ones, gzipped, into a PMTiles archive.
+    The archive is written to a temporary file first and moved into place, so nginx never serves a partial archive.
+
+    Parameters
+    ----------
+    engine : sqlalchemy.engine.Engine
+        The engine connected to the PostGIS database.
+    tiles : Sequence[Tile]
+        The tiles to build, sorted by tile id.
+    areas_of_interest : Sequence[stats_nz_geographies.AreaOfInterest]
+        The areas of interest the tiles cover, used for the archive bounds.
+    tiles_path : pathlib.Path
+        The PMTiles file to write.
+    max_workers : int
+        The number of tiles to build at once, each holding one database connection.
+
+    Returns
+    -------
+    int
+        The number of non-empty tiles written.
+    """
+    tiles_path.parent.mkdir(parents=True, exist_ok=True)
+    temp_path = tiles_path.with_name(f".{tiles_path.name}.{os.getpid()}.tmp")
+    num_tiles_written = 0
+    try:
+        with open(temp_path, "wb") as tiles_file, ThreadPoolExecutor(max_workers=max(max_workers, 1)) as executor:
+            writer = Writer(tiles_file)
+            # map yields results in submission order, so tiles are written in tile id order
+            for tile, tile_data in zip(tiles, executor.map(lambda tile: build_tile(engine, tile), tiles)):
+                if tile_data:
+                    writer.write_tile(zxy_to_tileid(*tile), gzip.compress(tile_data, mtime=0))
+                    num_tiles_written += 1
+            if num_tiles_written == 0:
+                raise ValueError(f"No tiles contain any SA1s, check {SA1_EMISSIONS_ALL_CARS_VIEW.name} is populated")
+
+            bounds = [aoi.bbox.as_shapely_polygon().bounds for aoi in areas_of_interest]
+            min_zoom = min(tile[0] for tile in tiles)
+            max_zoom = max(tile[0] for tile in tiles)
+            writer.finalize(
+                {
+                    "tile_type": TileType.MVT,
+                    "tile_compression": Compression.GZIP,
+                    "min_lon_e7": int(min(bound[0] for bound in bounds) * 10_000_000),
+                    "min_lat_e7": int(min(bound[1] for bound in bounds) * 10_000_000),
+                    "max_lon_e7": int(max(bound[2] for bound in bounds) * 10_000_000),
+                    "max_lat_e7": int(max(bound[3] for bound in bounds) * 10_000_000),
+                },
+                {
+                    "name": TILE_LAYER_NAME,
+                    "vector_layers": [{
+                        "id": TILE_LAYER_NAME,
+                        "minzoom": min_zoom,
+                        "maxzoom": max_zoom,
+                        "fields": TILE_ATTRIBUTES,
+                    }],
+                },
+            )
+        os.replace(temp_path, tiles_path)
+    finally:
+        temp_path.unlink(missing_ok=True)
+    return num_tiles_written
+
+
+def create_sa1_emissions_tiles(engine: sqlalchemy.engine.Engine) -> None:
+    """
+    Builds a PMTiles archive of the SA1 emissions vector tiles for every area of interest into the static data
+    directory served by nginx. The archive is only rebuilt if it is missing, or if the SA1s, vehicle stats, zoom
+    ranges or this module have changed since it was last built.
+
+    Parameters
+    ----------
+    engine : sqlalchemy.engine.Engine
+        The engine connected to the PostGIS database.
+
+    Returns
+    -------
+    None
+        This function does not return anything.
+    """
+    tiles_path = get_tiles_path()
+    areas_of_interest = stats_nz_geographies.AREAS_OF_INTEREST
+    code_version = file_hash(pathlib.Path(__file__))
+    sa1s_fingerprints = BuildManifest(engine, "sa1s").recorded_fingerprints
+    vehicle_stats_fingerprints = BuildManifest(engine, "vehicle_stats").recorded_fingerprints
+    area_inputs: Dict[str, dict] = {
+        aoi.ua_name: {
+            "code_version": code_version,
+            "zoom_range": AREA_ZOOM_RANGES.get(aoi.ua_name, DEFAULT_ZOOM_RANGE),
+            "sa1s": sa1s_fingerprints.get(aoi.ua_name),
+            "vehicle_stats": vehicle_stats_fingerprints.get(aoi.ua_name),
+        }
+        for aoi in areas_of_interest
+    }
+
+    manifest = BuildManifest(engine, TILE_LAYER_NAME + "_tiles")
+    changed_areas = manifest.find_changed_areas(area_inputs)
+    removed_areas = manifest.find_removed_areas(area_inputs)
+    if tiles_path.exists() and not changed_areas and not removed_areas:
+        log.info(f"Vector tiles {tiles_path} are up to date, skipping")
+        return
+
+    # A PMTiles archive cannot be updated in place, so any change rebuilds the whole archive
+    tiles = find_tiles_for_areas_of_interest(areas_of_interest)
+    log.info(f"Building {len(tiles)} vector tiles for {[aoi.ua_name for aoi in areas_of_interest]}")
+    num_tiles_written = write_tiles(engine, tiles, areas_of_interest, tiles_path, Env.VECTOR_TILE_WORKERS)
+    manifest.record(area_inputs, removed_areas)
+    log.info(f"Wrote {num_tiles_written} non-empty vector tiles to {tiles_path}")
+
+
+if __name__ == '__main__':
+    create_sa1_emissions_tiles(get_db_engine())
@@ -0,0 +1,93 @@
+from typing import List, NamedTuple, Sequence
+
+from materialised_views import MaterialisedView
+from sql_quoting import quote_identifier
+
+
+class SimplificationLevel(NamedTuple):
+    """
+    A precomputed geometry resolution for serving polygons to the browser.
+
+    Attributes
+    ----------
+    name : str
+        Suffix for the layer name, e.g. sa1s_medium.
+    tolerance : float
+        Simplification tolerance in degrees, since the geometries are stored in EPSG:4326.
+    num_decimals : int
+        Coordinate decimal places GeoServer writes for this layer. Precision finer than the tolerance is wasted bytes.
+    """
+    name: str
+    tolerance: float
+    num_decimals: int
+
+
+# ~10m, fine enough for viewing a single suburb
+MEDIUM = SimplificationLevel("medium", tolerance=0.0001, num_decimals=5)
+# ~50m, for viewing a whole city
+LOW = SimplificationLevel("low", tolerance=0.0005, num_decimals=4)
+SIMPLIFICATION_LEVELS = [MEDIUM, LOW]
+# Urban SA1s are often under 100m across, which the low level would reduce to a few vertices, so they only get medium
+SA1_SIMPLIFICATION_LEVELS = [MEDIUM]
+
+
+def get_simplified_layer_name(table_name: str, level: SimplificationLevel) -> str:
+    return f"{table_name}_{level.name}"
+
+
+def create_simplified_geometry_views(table_name: str,
+                                     id_column: str,
+                                     attribute_columns: Sequence[str],
+                                     index_columns: Sequence[str] = (),
+                                     coverage_columns: Sequence[str] = (),
+                                     geometry_column: str = "geometry",
+                                     levels: Sequence[SimplificationLevel] = SIMPLIFICATION_LEVELS
+                                     ) -> List[MaterialisedView]:
+    """
+    Defines one materialised view per simplification level, holding a simplification of a table's polygons alongside
+    the attributes needed to identify and filter them.
+    The polygons are simplified as a coverage with ST_CoverageSimplify, which needs PostGIS 3.4 with GEOS 3.12, so
+    boundaries shared by neighbouring polygons are simplified once and stay shared, without gaps or overlaps.
+
+    Parameters
+    ----------
+    table_name : str
+        The table holding the full resolution polygons.
+    id_column : str
+        The column that uniquely identifies each polygon.
+    attribute_columns : Sequence[str]
+        Other columns to carry into the simplified views.
+    index_columns : Sequence[str] = ()
+        Attribute columns that layers are filtered on, which each get an index.
+    coverage_columns : Sequence[str] = ()
+        Attribute columns grouping the polygons into separate coverages, such as the urban area, each simplified on its
+        own to bound the work done at once. By default all the polygons form one coverage.
+    geometry_column : str = "geometry"
+        The full resolution geometry column.
+    levels : Sequence[SimplificationLevel] = SIMPLIFICATION_LEVELS
+        The simplification levels to define views for.
+
+    Returns
+    -------
+    List[MaterialisedView]
+        The materialised view definitions, in the same order as levels.
+    """
+    columns = ", ".join(quote_identifier(column) for column in [id_column, *attribute_columns])
+    coverage_window = ", ".join(quote_identifier(column) for column in coverage_columns)
+    if coverage_window:
+        coverage_window = f"PARTITION BY {coverage_window}"
+    return [
+        MaterialisedView(
+            name=get_simplified_layer_name(table_name, level),
+            query=f"""
+                SELECT {columns},
+                       ST_CoverageSimplify({quote_identifier(geometry_column)}, {level.tolerance})
+                           OVER ({coverage_window}) AS {quote_identifier(geometry_column)}
+                FROM {quote_identifier(table_name)}
+            """,
+            unique_columns=[id_column],
+            index_columns=index_columns,
+            geometry_column=geometry_column,
+        )
+        for level in levels
+    ]
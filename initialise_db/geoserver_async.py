@@ -0,0 +1,253 @@
+import asyncio
+import json
+import logging
+from http import HTTPStatus
+from typing import Awaitable, Dict, List, Optional, Sequence, Set, Tuple
+
+import aiohttp
+
+import instrumentation
+from config import EnvVariable as Env
+from geoserver_common import (FeatureTypeDefinition, GeoServerRequestError, get_db_store_xml, get_feature_type_xml,
+                              get_geoserver_url, parse_names)
+
+log = logging.getLogger(__name__)
+
+
+async def gather_or_cancel(*awaitables: Awaitable) -> list:
+    """
+    Runs awaitables concurrently like asyncio.gather, but if one fails, cancels the others and waits for them to stop
+    before raising its error, so none are left running on a session that is about to be closed.
+
+    Parameters
+    ----------
+    *awaitables : Awaitable
+        The coroutines or futures to run.
+
+    Returns
+    -------
+    list
+        Their results, in the same order.
+    """
+    tasks = [asyncio.ensure_future(awaitable) for awaitable in awaitables]
+    try:
+        return await asyncio.gather(*tasks)
+    except BaseException:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        raise
+
+
+class AsyncGeoServerClient:
+    """
+    Provisions GeoServer through its REST API with asyncio, creating independent layers concurrently.
+    The workspace is always created before its data store, and the data store before its layers.
+    Like GeoServerClient, existing workspaces, data stores and layers are listed once and cached.
+
+    Parameters
+    ----------
+    base_url : Optional[str] = None
+        The GeoServer REST API URL. Defaults to the URL from the environment variables, and can point to a stub server.
+    auth : Optional[Tuple[str, str]] = None
+        The admin user name and password. Defaults to the credentials from the environment variables.
+    concurrency : Optional[int] = None
+        The maximum number of requests in flight at once, so GeoServer is not overwhelmed.
+        Defaults to GEOSERVER_CONCURRENCY.
+    """
+
+    def __init__(self,
+                 base_url: Optional[str] = None,
+                 auth: Optional[Tuple[str, str]] = None,
+                 concurrency: Optional[int] = None):
+        self.base_url = get_geoserver_url() if base_url is None else base_url
+        user_name, password = (Env.GEOSERVER_ADMIN_NAME, Env.GEOSERVER_ADMIN_PASSWORD) if auth is None else auth
+        self.auth = aiohttp.BasicAuth(user_name, password)
+        self.concurrency = max(Env.GEOSERVER_CONCURRENCY if concurrency is None else concurrency, 1)
+        self._semaphore = asyncio.Semaphore(self.concurrency)
+        self._session: Optional[aiohttp.ClientSession] = None
+        self._workspace_names: Optional[Set[str]] = None
+        self._data_store_names: Dict[str, Set[str]] = {}
+        self._feature_type_names: Dict[Tuple[str, str], Set[str]] = {}
+
+    async def __aenter__(self) -> "AsyncGeoServerClient":
+        self._session = aiohttp.ClientSession(auth=self.auth, connector=aiohttp.TCPConnector(limit=self.concurrency))
+        return self
+
+    async def __aexit__(self, *exc_info) -> None:
+        await self._session.close()
+
+    async def _request(self, method: str, path: str, expected_statuses: Sequence[int], **kwargs) -> Tuple[int, str]:
+        url = f"{self.base_url}/{path}"
+        async with self._semaphore:
+            # Opened once the semaphore is acquired, so the time spent queueing for a connection is not included
+            with instrumentation.span("geoserver_request", method=method, path=path) as request_span:
+                async with self._session.request(method, url, **kwargs) as response:
+                    text = await response.text()
+                request_span.set(status=response.status)
+        if response.status not in expected_statuses:
+            raise GeoServerRequestError(method, url, response.status, text)
+        return response.status, text
+
+    async def _get_names(self, path: str, collection_key: str, item_key: str) -> Set[str]:
+        _, text = await self._request("GET", path, [HTTPStatus.OK])
+        return parse_names(json.loads(text), collection_key, item_key)
+
+    async def _post_xml(self, path: str, data: str) -> None:
+        await self._request("POST", path, [HTTPStatus.CREATED],
+                            params={"configure": "all"}, headers={"Content-type": "text/xml"}, data=data)
+
+    async def get_workspace_names(self) -> Set[str]:
+        if self._workspace_names is None:
+            self._workspace_names = await self._get_names("workspaces.json", "workspaces", "workspace")
+        return self._workspace_names
+
+    async def get_data_store_names(self, workspace_name: str) -> Set[str]:
+        if workspace_name not in self._data_store_names:
+            self._data_store_names[workspace_name] = await self._get_names(
+                f"workspaces/{workspace_name}/datastores.json", "dataStores", "dataStore")
+        return self._data_store_names[workspace_name]
+
+    async def get_feature_type_names(self, workspace_name: str, data_store_name: str) -> Set[str]:
+        key = (workspace_name, data_store_name)
+        if key not in self._feature_type_names:
+            self._feature_type_names[key] = await self._get_names(
+                f"workspaces/{workspace_name}/datastores/{data_store_name}/featuretypes.json",
+                "featureTypes", "featureType")
+        return self._feature_type_names[key]
+
+    async def create_workspace_if_not_exists(self, workspace_name: str) -> None:
+        workspace_names = await self.get_workspace_names()
+        if workspace_name in workspace_names:
+            log.info(f"Workspace {workspace_name} already exists.")
+            return
+        status, _ = await self._request("POST", "workspaces", [HTTPStatus.CREATED, HTTPStatus.CONFLICT],
+                                        json={"workspace": {"name": workspace_name}})
+        if status == HTTPStatus.CREATED:
+            log.info(f"Created new workspace {workspace_name}.")
+        workspace_names.add(workspace_name)
+
+    async def create_db_store_if_not_exists(self, db_name: str, workspace_name: str, data_store_name: str) -> None:
+        data_store_names = await self.get_data_store_names(workspace_name)
+        if data_store_name in data_store_names:
+            return
+        await self._post_xml(f"workspaces/{workspace_name}/datastores", get_db_store_xml(db_name, data_store_name))
+        log.info(f"Created new db store {workspace_name}:{data_store_name}.")
+        data_store_names.add(data_store_name)
+        # A new data store has no layers, so there is no need to list them
+        self._feature_type_names[(workspace_name, data_store_name)] = set()
+
+    async def _create_feature_type(self,
+                                   workspace_name: str,
+                                   data_store_name: str,
+                                   feature_type: FeatureTypeDefinition) -> None:
+        await self._post_xml(f"workspaces/{workspace_name}/datastores/{data_store_name}/featuretypes",
+                             get_feature_type_xml(feature_type, data_store_name))
+        log.info(f"Created new datastore layer {workspace_name}:{feature_type.name}.")
+        self._feature_type_names[(workspace_name, data_store_name)].add(feature_type.name)
+
+    async def _update_feature_type(self,
+                                   workspace_name: str,
+                                   data_store_name: str,
+                                   feature_type: FeatureTypeDefinition) -> None:
+        await self._request("PUT",
+                            f"workspaces/{workspace_name}/datastores/{data_store_name}/featuretypes/{feature_type.name}",
+                            [HTTPStatus.OK], headers={"Content-type": "text/xml"},
+                            data=get_feature_type_xml(feature_type, data_store_name))
+        log.info(f"Updated datastore layer {workspace_name}:{feature_type.name}.")
+
+    async def create_feature_types_if_not_exist(self,
+                                                workspace_name: str,
+                                                data_store_name: str,
+                                                feature_types: Sequence[FeatureTypeDefinition]) -> List[str]:
+        """
+        Concurrently creates the layers that do not already exist in a data store, and updates existing layers with
+        update_existing set to their definitions.
+
+        Parameters
+        ----------
+        workspace_name : str
+            The workspace the data store is in.
+        data_store_name : str
+            The data store to publish the layers from.
+        feature_types : Sequence[FeatureTypeDefinition]
+            The layers that should exist.
+
+        Returns
+        -------
+        List[str]
+            The names of the layers that were created by this call.
+        """
+        feature_type_names = await self.get_feature_type_names(workspace_name, data_store_name)
+        missing_feature_types = [feature_type for feature_type in feature_types
+                                 if feature_type.name not in feature_type_names]
+        outdated_feature_types = [feature_type for feature_type in feature_types
+                                  if feature_type.update_existing and feature_type.name in feature_type_names]
+        await gather_or_cancel(*(self._create_feature_type(workspace_name, data_store_name, feature_type)
+                                 for feature_type in missing_feature_types),
+                               *(self._update_feature_type(workspace_name, data_store_name, feature_type)
+                                 for feature_type in outdated_feature_types))
+        return [feature_type.name for feature_type in missing_feature_types]
+
+    async def provision(self,
+                        workspace_name: str,
+                        db_name: str,
+                        data_store_name: str,
+                        feature_types: Sequence[FeatureTypeDefinition]) -> List[str]:
+        """
+        Ensures a workspace, a PostGIS data store within it, and the data store's layers all exist.
+        The workspace and data store are created in order, then the missing layers concurrently.
+
+        Parameters
+        ----------
+        workspace_name : str
+            The workspace to create if it does not exist.
+        db_name : str
+            The database the data store connects to.
+        data_store_name : str
+            The data store to create if it does not exist.
+        feature_types : Sequence[FeatureTypeDefinition]
+            The layers that should exist.
+
+        Returns
+        -------
+        List[str]
+            The names of the layers that were created by this call.
+        """
+        await self.create_workspace_if_not_exists(workspace_name)
+        await self.create_db_store_if_not_exists(db_name, workspace_name, data_store_name)
+        return await self.create_feature_types_if_not_exist(workspace_name, data_store_name, feature_types)
+
+
+def provision_concurrently(workspace_name: str,
+                           db_name: str,
+                           data_store_name: str,
+                           feature_types: Sequence[FeatureTypeDefinition],
+                           base_url: Optional[str] = None) -> List[str]:
+    """
+    Runs AsyncGeoServerClient.provision in a new event loop.
+
+    Parameters
+    ----------
+    workspace_name : str
+        The workspace to create if it does not exist.
+    db_name : str
+        The database the data store connects to.
+    data_store_name : str
+        The data store to create if it does not exist.
+    feature_types : Sequence[FeatureTypeDefinition]
+        The layers that should exist.
+    base_url : Optional[str] = None
+        The GeoServer REST API URL. Defaults to the URL from the environment variables.
+
+    Returns
+    -------
+    List[str]
+        The names of the layers that were created by this call.
+    """
+
+    async def provision() -> List[str]:
+        async with AsyncGeoServerClient(base_url) as client:
+            return await client.provision(workspace_name, db_name, data_store_name, feature_types)
+
+    return asyncio.run(provision())
@@ -1,13 +1,62 @@
 import logging
 from http import HTTPStatus
+from typing import Dict, List, NamedTuple, Optional, Sequence, Set, Tuple
 
 import requests
 
+import instrumentation
 from config import EnvVariable as Env
 
 log = logging.getLogger(__name__)
 
 
+class GeoServerRequestError(requests.HTTPError):
+    """
+    Raised by GeoServerClient and AsyncGeoServerClient when GeoServer responds to a REST API request with an
+    unexpected status, so callers see the same error whichever provisioning mode is used.
+
+    Parameters
+    ----------
+    method : str
+        The HTTP method of the request.
+    url : str
+        The URL of the request.
+    status : int
+        The status GeoServer responded with.
+    text : str
+        The body of the response.
+    response : Optional[requests.Response] = None
+        The response, when the request was sent with requests.
+    """
+
+    def __init__(self, method: str, url: str, status: int, text: str, response: Optional[requests.Response] = None):
+        super().__init__(f"{method} {url} returned {status}: {text}", response=response)
+        self.status = status
+
+
+class FeatureTypeDefinition(NamedTuple):
+    """
+    A GeoServer layer to publish from a PostGIS data store.
+
+    Attributes
+    ----------
+    name : str
+        The name of the layer, and of the table or view it is published from unless metadata_elem defines a
+        virtual table.
+    metadata_elem : str = ""
+        Extra featureType XML, such as a JDBC_VIRTUAL_TABLE metadata entry.
+    num_decimals : int = 8
+        The number of coordinate decimal places GeoServer writes for the layer.
+    update_existing : bool = False
+        If True, an existing layer is updated to this definition on every run rather than left alone, e.g. so that a
+        virtual table's query follows changes to the tables it reads.
+    """
+    name: str
+    metadata_elem: str = ""
+    num_decimals: int = 8
+    update_existing: bool = False
+
+
 def get_geoserver_url() -> str:
     """
     Retrieves full GeoServer URL from environment variables.
@@ -20,62 +69,26 @@ def get_geoserver_url() -> str:
     return f"{Env.GEOSERVER_HOST}:{Env.GEOSERVER_PORT}/geoserver/rest"
 
 
-def create_workspace_if_not_exists(workspace_name: str) -> None:
+def get_feature_type_xml(feature_type: FeatureTypeDefinition, data_store_name: str) -> str:
     """
-    Creates a geoserver workspace if it does not currently exist.
+    Builds the REST API request body that creates a layer.
 
     Parameters
     ----------
-    workspace_name : str
-        The name of the workspace to create if it does not exists.
+    feature_type : FeatureTypeDefinition
+        The layer to create.
+    data_store_name : str
+        The data store the layer is published from.
 
     Returns
     -------
-    None
-        This function does not return anything.
-    """
-
-    # Create the geoserver REST API request to create the workspace
-    log.info(f"Creating geoserver workspace {workspace_name} if it does not already exist.")
-    req_body = {
-        "workspace": {
-            "name": workspace_name
-        }
-    }
-    response = requests.post(
-        f"{get_geoserver_url()}/workspaces",
-        json=req_body,
-        auth=(Env.GEOSERVER_ADMIN_NAME, Env.GEOSERVER_ADMIN_PASSWORD)
-    )
-    if response.status_code == HTTPStatus.CREATED:
-        log.info(f"Created new workspace {workspace_name}.")
-    elif response.status_code == HTTPStatus.CONFLICT:
-        log.info(f"Workspace {workspace_name} already exists.")
-    else:
-        # If it does not meet the expected results then raise an error
-        # Raise error manually so we can configure the text
-        raise requests.HTTPError(response.text, response=response)
-
-
-def create_datastore_layer(workspace_name, data_store_name: str, layer_name, metadata_elem: str = "") -> None:
-    db_exists_response = requests.get(
-        f'{get_geoserver_url()}/workspaces/{workspace_name}/datastores/{data_store_name}/featuretypes.json',
-        auth=(Env.GEOSERVER_ADMIN_NAME, Env.GEOSERVER_ADMIN_PASSWORD),
-    )
-    response_data = db_exists_response.json()
-    # Parse JSON structure to get list of feature names
-    top_layer_node = response_data["featureTypes"]
-    # defaults to empty list if no layers exist
-    layers = top_layer_node["featureType"] if top_layer_node else []
-    layer_names = [layer["name"] for layer in layers]
-    if layer_name in layer_names:
-        # If the layer already exists, we don't have to add it again, and can instead return
-        return
-    # Construct new layer request
-    data = f"""
+    str
+        The featureType XML document.
+    """
+    return f"""
         <featureType>
-            <name>{layer_name}</name>
-            <title>{layer_name}</title>
+            <name>{feature_type.name}</name>
+            <title>{feature_type.name}</title>
             <srs>EPSG:4326</srs>
             <nativeBoundingBox>
                 <minx>170.0</minx>
@@ -95,62 +108,31 @@ def create_datastore_layer(workspace_name, data_store_name: str, layer_name, met
                 <class>dataStore</class>
                 <name>{data_store_name}</name>
             </store>
-            <numDecimals>8</numDecimals>
-            {metadata_elem}
+            <numDecimals>{feature_type.num_decimals}</numDecimals>
+            {feature_type.metadata_elem}
         </featureType>
         """
 
-    response = requests.post(
-        f"{get_geoserver_url()}/workspaces/{workspace_name}/datastores/{data_store_name}/featuretypes",
-        params={"configure": "all"},
-        headers={"Content-type": "text/xml"},
-        data=data,
-        auth=(Env.GEOSERVER_ADMIN_NAME, Env.GEOSERVER_ADMIN_PASSWORD),
-    )
-    if response.status_code == HTTPStatus.CREATED:
-        log.info(f"Created new datastore layer {workspace_name}:{layer_name}.")
-    else:
-        # If it does not meet the expected results then raise an error
-        # Raise error manually so we can configure the text
-        raise requests.HTTPError(response.text, response=response)
-
 
-def create_db_store_if_not_exists(db_name: str, workspace_name: str, new_data_store_name: str) -> None:
+def get_db_store_xml(db_name: str, data_store_name: str) -> str:
     """
-    Creates PostGIS database store in a geoserver workspace for a given database.
-    If it already exists, does not do anything.
+    Builds the REST API request body that creates a PostGIS data store.
 
     Parameters
     ----------
-    workspace_name : str
-        The name of the workspace to create views for
+    db_name : str
+        The database the data store connects to.
+    data_store_name : str
+        The name of the data store.
 
     Returns
     -------
-    None
-        This function does not return anything
-    """
-    # Create request to check if database store already exists
-    db_exists_response = requests.get(
-        f'{get_geoserver_url()}/workspaces/{workspace_name}/datastores',
-        auth=(Env.GEOSERVER_ADMIN_NAME, Env.GEOSERVER_ADMIN_PASSWORD),
-    )
-    response_data = db_exists_response.json()
-
-    # Parse JSON structure to get list of data store names
-    top_data_store_node = response_data["dataStores"]
-    # defaults to empty list if no data stores exist
-    data_stores = top_data_store_node["dataStore"] if top_data_store_node else []
-    data_store_names = [data_store["name"] for data_store in data_stores]
-
-    if new_data_store_name in data_store_names:
-        # If the data store already exists we don't have to do anything
-        return
-
-    # Create request to create database store
-    create_db_store_data = f"""
+    str
+        The dataStore XML document.
+    """
+    return f"""
         <dataStore>
-          <name>{new_data_store_name}</name>
+          <name>{data_store_name}</name>
           <connectionParameters>
             <host>postgis</host>
             <port>5432</port>
@@ -161,18 +143,275 @@ def create_db_store_if_not_exists(db_name: str, workspace_name: str, new_data_st
           </connectionParameters>
         </dataStore>
         """
-    # Send request to add datastore
-    response = requests.post(
-        f'{get_geoserver_url()}/workspaces/{workspace_name}/datastores',
-        params={"configure": "all"},
-        headers={"Content-type": "text/xml"},
-        data=create_db_store_data,
-        auth=(Env.GEOSERVER_ADMIN_NAME, Env.GEOSERVER_ADMIN_PASSWORD),
-    )
-    if response.status_code == HTTPStatus.CREATED:
-        log.info(f"Created new db store {workspace_name}.")
-    # Expected responses are CREATED if the new store is created or CONFLICT if one already exists.
-    else:
-        # If it does not meet the expected results then raise an error
-        # Raise error manually so we can configure the text
-        raise requests.HTTPError(response.text, response=response)
+
+
+def parse_names(response_data: dict, collection_key: str, item_key: str) -> Set[str]:
+    """
+    Reads the names out of a GeoServer REST API listing, such as {"dataStores": {"dataStore": [{"name": ...}]}}.
+    GeoServer returns an empty string rather than an empty list for the collection if it has no items.
+
+    Parameters
+    ----------
+    response_data : dict
+        The parsed JSON listing.
+    collection_key : str
+        The key of the collection, e.g. "dataStores".
+    item_key : str
+        The key of the list of items in the collection, e.g. "dataStore".
+
+    Returns
+    -------
+    Set[str]
+        The names of the items in the listing.
+    """
+    top_node = response_data[collection_key]
+    # defaults to empty list if no items exist
+    items = top_node[item_key] if top_node else []
+    return {item["name"] for item in items}
+
+
+class GeoServerClient:
+    """
+    Provisions GeoServer through its REST API over a single keep-alive session.
+    The workspaces, data stores and layers that already exist are listed once and cached, so each is only fetched
+    once per run no matter how many layers are created.
+
+    Parameters
+    ----------
+    base_url : Optional[str] = None
+        The GeoServer REST API URL. Defaults to the URL from the environment variables, and can point to a stub server.
+    auth : Optional[Tuple[str, str]] = None
+        The admin user name and password. Defaults to the credentials from the environment variables.
+    session : Optional[requests.Session] = None
+        The session to send requests with. A new session is created by default.
+    """
+
+    def __init__(self,
+                 base_url: Optional[str] = None,
+                 auth: Optional[Tuple[str, str]] = None,
+                 session: Optional[requests.Session] = None):
+        self.base_url = get_geoserver_url() if base_url is None else base_url
+        self.session = requests.Session() if session is None else session
+        self.session.auth = (Env.GEOSERVER_ADMIN_NAME, Env.GEOSERVER_ADMIN_PASSWORD) if auth is None else auth
+        self._workspace_names: Optional[Set[str]] = None
+        self._data_store_names: Dict[str, Set[str]] = {}
+        self._feature_type_names: Dict[Tuple[str, str], Set[str]] = {}
+
+    def __enter__(self) -> "GeoServerClient":
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+    def close(self) -> None:
+        self.session.close()
+
+    def _request(self, method: str, path: str, expected_statuses: Sequence[int], **kwargs) -> requests.Response:
+        url = f"{self.base_url}/{path}"
+        with instrumentation.span("geoserver_request", method=method, path=path) as request_span:
+            response = self.session.request(method, url, **kwargs)
+            request_span.set(status=response.status_code)
+        if response.status_code not in expected_statuses:
+            raise GeoServerRequestError(method, url, response.status_code, response.text, response=response)
+        return response
+
+    def _get_names(self, path: str, collection_key: str, item_key: str) -> Set[str]:
+        response = self._request("GET", path, [HTTPStatus.OK])
+        return parse_names(response.json(), collection_key, item_key)
+
+    def _post_xml(self, path: str, data: str) -> requests.Response:
+        return self._request(
+            "POST",
+            path,
+            [HTTPStatus.CREATED],
+            params={"configure": "all"},
+            headers={"Content-type": "text/xml"},
+            data=data,
+        )
+
+    def _put_xml(self, path: str, data: str) -> requests.Response:
+        return self._request("PUT", path, [HTTPStatus.OK], headers={"Content-type": "text/xml"}, data=data)
+
+    def get_workspace_names(self) -> Set[str]:
+        if self._workspace_names is None:
+            self._workspace_names = self._get_names("workspaces.json", "workspaces", "workspace")
+        return self._workspace_names
+
+    def get_data_store_names(self, workspace_name: str) -> Set[str]:
+        if workspace_name not in self._data_store_names:
+            self._data_store_names[workspace_name] = self._get_names(
+                f"workspaces/{workspace_name}/datastores.json", "dataStores", "dataStore")
+        return self._data_store_names[workspace_name]
+
+    def get_feature_type_names(self, workspace_name: str, data_store_name: str) -> Set[str]:
+        key = (workspace_name, data_store_name)
+        if key not in self._feature_type_names:
+            self._feature_type_names[key] = self._get_names(
+                f"workspaces/{workspace_name}/datastores/{data_store_name}/featuretypes.json",
+                "featureTypes", "featureType")
+        return self._feature_type_names[key]
+
+    def create_workspace_if_not_exists(self, workspace_name: str) -> None:
+        """
+        Creates a geoserver workspace if it does not currently exist.
+
+        Parameters
+        ----------
+        workspace_name : str
+            The name of the workspace to create if it does not exists.
+
+        Returns
+        -------
+        None
+            This function does not return anything.
+        """
+        log.info(f"Creating geoserver workspace {workspace_name} if it does not already exist.")
+        workspace_names = self.get_workspace_names()
+        if workspace_name in workspace_names:
+            log.info(f"Workspace {workspace_name} already exists.")
+            return
+        response = self._request("POST", "workspaces", [HTTPStatus.CREATED, HTTPStatus.CONFLICT],
+                                 json={"workspace": {"name": workspace_name}})
+        if response.status_code == HTTPStatus.CREATED:
+            log.info(f"Created new workspace {workspace_name}.")
+        else:
+            log.info(f"Workspace {workspace_name} already exists.")
+        workspace_names.add(workspace_name)
+
+    def create_db_store_if_not_exists(self, db_name: str, workspace_name: str, data_store_name: str) -> None:
+        """
+        Creates PostGIS database store in a geoserver workspace for a given database.
+        If it already exists, does not do anything.
+
+        Parameters
+        ----------
+        db_name : str
+            The database the data store connects to.
+        workspace_name : str
+            The workspace to create the data store in.
+        data_store_name : str
+            The name of the data store.
+
+        Returns
+        -------
+        None
+            This function does not return anything.
+        """
+        data_store_names = self.get_data_store_names(workspace_name)
+        if data_store_name in data_store_names:
+            # If the data store already exists we don't have to do anything
+            return
+        self._post_xml(f"workspaces/{workspace_name}/datastores", get_db_store_xml(db_name, data_store_name))
+        log.info(f"Created new db store {workspace_name}:{data_store_name}.")
+        data_store_names.add(data_store_name)
+        # A new data store has no layers, so there is no need to list them
+        self._feature_type_names[(workspace_name, data_store_name)] = set()
+
+    def create_feature_types_if_not_exist(self,
+                                          workspace_name: str,
+                                          data_store_name: str,
+                                          feature_types: Sequence[FeatureTypeDefinition]) -> List[str]:
+        """
+        Creates the layers that do not already exist in a data store, checking against a single listing of the
+        data store's layers. Existing layers with update_existing set are updated to their definitions.
+
+        Parameters
+        ----------
+        workspace_name : str
+            The workspace the data store is in.
+        data_store_name : str
+            The data store to publish the layers from.
+        feature_types : Sequence[FeatureTypeDefinition]
+            The layers that should exist.
+
+        Returns
+        -------
+        List[str]
+            The names of the layers that were created by this call.
+        """
+        feature_type_names = self.get_feature_type_names(workspace_name, data_store_name)
+        missing_feature_types = [feature_type for feature_type in feature_types
+                                 if feature_type.name not in feature_type_names]
+        outdated_feature_types = [feature_type for feature_type in feature_types
+                                  if feature_type.update_existing and feature_type.name in feature_type_names]
+        for feature_type in missing_feature_types:
+            self._post_xml(f"workspaces/{workspace_name}/datastores/{data_store_name}/featuretypes",
+                           get_feature_type_xml(feature_type, data_store_name))
+            log.info(f"Created new datastore layer {workspace_name}:{feature_type.name}.")
+            feature_type_names.add(feature_type.name)
+        for feature_type in outdated_feature_types:
+            self._put_xml(f"workspaces/{workspace_name}/datastores/{data_store_name}/featuretypes/{feature_type.name}",
+                          get_feature_type_xml(feature_type, data_store_name))
+            log.info(f"Updated datastore layer {workspace_name}:{feature_type.name}.")
+        return [feature_type.name for feature_type in missing_feature_types]
+
+    def provision(self,
+                  workspace_name: str,
+                  db_name: str,
+                  data_store_name: str,
+                  feature_types: Sequence[FeatureTypeDefinition]) -> List[str]:
+        """
+        Ensures a workspace, a PostGIS data store within it, and the data store's layers all exist.
+
+        Parameters
+        ----------
+        workspace_name : str
+            The workspace to create if it does not exist.
+        db_name : str
+            The database the data store connects to.
+        data_store_name : str
+            The data store to create if it does not exist.
+        feature_types : Sequence[FeatureTypeDefinition]
+            The layers that should exist.
+
+        Returns
+        -------
+        List[str]
+            The names of the layers that were created by this call.
+        """
+        self.create_workspace_if_not_exists(workspace_name)
+        self.create_db_store_if_not_exists(db_name, workspace_name, data_store_name)
+        return self.create_feature_types_if_not_exist(workspace_name, data_store_name, feature_types)
+
+
+def provision_geoserver(workspace_name: str,
+                        db_name: str,
+                        data_store_name: str,
+                        feature_types: Sequence[FeatureTypeDefinition]) -> List[str]:
+    """
+    Ensures a workspace, a PostGIS data store within it, and the data store's layers all exist, using the client
+    selected by GEOSERVER_PROVISIONING_MODE: "sync" sends one request at a time, "async" creates the layers
+    concurrently, up to GEOSERVER_CONCURRENCY requests at once.
+
+    Parameters
+    ----------
+    workspace_name : str
+        The workspace to create if it does not exist.
+    db_name : str
+        The database the data store connects to.
+    data_store_name : str
+        The data store to create if it does not exist.
+    feature_types : Sequence[FeatureTypeDefinition]
+        The layers that should exist.
+
+    Returns
+    -------
+    List[str]
+        The names of the layers that were created by this call.
+
+    Raises
+    ------
+    ValueError
+        If GEOSERVER_PROVISIONING_MODE is not "sync" or "async".
+    GeoServerRequestError
+        If GeoServer responds to a request with an unexpected status, in either mode.
+    """
+    mode = Env.GEOSERVER_PROVISIONING_MODE.lower()
+    if mode == "async":
+        # Imported here to avoid a circular import, and so aiohttp is only needed in async mode
+        from geoserver_async import provision_concurrently
+        return provision_concurrently(workspace_name, db_name, data_store_name, feature_types)
+    if mode == "sync":
+        with GeoServerClient() as client:
+            return client.provision(workspace_name, db_name, data_store_name, feature_types)
+    raise ValueError(f"GEOSERVER_PROVISIONING_MODE={mode} must be 'sync' or 'async'")
@@ -1,34 +1,58 @@
+import argparse
 import logging
 
 from dotenv import load_dotenv
 
-from config import get_db_engine
-from emissions.emissions_geoserver import initialise_geoserver_emissions
-from emissions.initialise_co2_sa1s import initialise_co2_sa1s
-from mode_share.flowmap import save_flow_map_sheets
-from mode_share.initialise_mode_share import initialise_mode_share
-from mode_share.mode_share_geoserver import initialise_geoserver_mode_share
+import instrumentation
+from config import EnvVariable as Env
 from setup_logging import setup_logging
+from stage_runner import Stage, run_stages
 
 log = logging.getLogger(__name__)
 
+# Stage functions are given by path, so each stage's dependencies are only imported by the process that runs it
+STAGES = [
+    # Only loads anything when AREA_FILTER_MODE is postgis
+    Stage("national_geographies", "national_geographies:load_national_geographies"),
+    Stage("co2_sa1s", "emissions.initialise_co2_sa1s:initialise_co2_sa1s", dependencies=["national_geographies"]),
+    Stage("vector_tiles", "emissions.vector_tiles:create_sa1_emissions_tiles", dependencies=["co2_sa1s"]),
+    Stage("emissions_exports", "emissions.static_exports:export_sa1_emissions", dependencies=["co2_sa1s"]),
+    Stage("mode_share", "mode_share.initialise_mode_share:initialise_mode_share",
+          dependencies=["national_geographies"]),
+    Stage("flow_sheets", "mode_share.flowmap:save_flow_map_sheets", dependencies=["mode_share"]),
+    # GeoServer only needs the tables and views its layers are published from
+    Stage("geoserver_emissions", "emissions.emissions_geoserver:initialise_geoserver_emissions",
+          dependencies=["co2_sa1s"], uses_database=False),
+    Stage("geoserver_mode_share", "mode_share.mode_share_geoserver:initialise_geoserver_mode_share",
+          dependencies=["mode_share", "flow_sheets"], uses_database=False),
+]
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Initialise the database, flow map sheets and GeoServer layers.")
+    stage_names = [stage.name for stage in STAGES]
+    parser.add_argument("stages", nargs="*", metavar="stage",
+                        help=f"Stages to run, from {stage_names}. "
+                             f"Dependencies that are not listed are not run. Runs all stages if none are given.")
+    parser.add_argument("--workers", type=int, default=None,
+                        help="The maximum number of stages to run at once. Defaults to INITIALISATION_WORKERS.")
+    args = parser.parse_args()
+    unknown_stages = [stage for stage in args.stages if stage not in stage_names]
+    if unknown_stages:
+        parser.error(f"unknown stages {unknown_stages}, choose from {stage_names}")
+    return args
+
 
 def main():
     setup_logging()
-    log.info(f"Checking database initialisation")
     load_dotenv()
-    engine = get_db_engine()
-    log.info(f"Initialising database {engine}")
-    initialise_co2_sa1s(engine)
-    initialise_mode_share(engine)
-    log.info("Database initialised")
-    log.info("Initialising flow map Google Sheets")
-    save_flow_map_sheets(engine)
-    log.info("Flow map Google Sheets initialised")
-    log.info("Initialising geoserver")
-    initialise_geoserver_emissions()
-    initialise_geoserver_mode_share()
-    log.info("Geoserver initialised")
+    args = parse_args()
+    max_workers = Env.INITIALISATION_WORKERS if args.workers is None else args.workers
+    log.info(f"Initialising data sources with up to {max_workers} concurrent stages")
+    instrumentation.start_run()
+    with instrumentation.span("initialisation", stages=args.stages or [stage.name for stage in STAGES]):
+        run_stages(STAGES, args.stages or None, max_workers)
+    log.info("Data sources initialised")
 
 
 if __name__ == '__main__':
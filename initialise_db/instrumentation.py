@@ -0,0 +1,265 @@
+import contextlib
+import contextvars
+import cProfile
+import datetime
+import itertools
+import json
+import logging
+import os
+import pathlib
+import threading
+import time
+import tracemalloc
+import uuid
+from typing import Any, Iterator, Optional, Set, Union
+
+from config import EnvVariable as Env
+
+try:
+    import resource
+except ImportError:
+    # Only available on Unix, where the pipeline runs in docker. Peak RSS is not reported elsewhere.
+    resource = None
+
+log = logging.getLogger(__name__)
+
+# Set by start_run in the main process and inherited by the spawned stage processes, so their records share a run id
+RUN_ID_ENV_VARIABLE = "INSTRUMENTATION_RUN_ID"
+MIB = 1024 * 1024
+
+# The innermost open span of the current thread or asyncio task, which becomes the parent of spans opened inside it
+_current_span: contextvars.ContextVar[Optional["Span"]] = contextvars.ContextVar("current_span", default=None)
+_span_ids = itertools.count(1)
+_report_lock = threading.Lock()
+# Spans open while tracemalloc is tracing. tracemalloc has a single process-wide peak, so whenever a span opens or
+# closes the peak so far is credited to every open span before it is reset.
+_traced_spans: Set["Span"] = set()
+_traced_spans_lock = threading.Lock()
+# The span of the stage running in this process, the parent of spans opened in threads without a parent of their own
+_stage_span: Optional["Span"] = None
+
+
+def is_enabled() -> bool:
+    return bool(Env.INSTRUMENTATION_REPORT)
+
+
+def get_report_path() -> pathlib.Path:
+    return pathlib.Path(Env.INSTRUMENTATION_REPORT)
+
+
+def get_profile_path(stage_name: str) -> pathlib.Path:
+    report_dir = get_report_path().parent if is_enabled() else pathlib.Path(".")
+    return report_dir / f"{stage_name}_{os.environ.get(RUN_ID_ENV_VARIABLE, os.getpid())}.prof"
+
+
+def _credit_traced_peak() -> None:
+    # Must be called holding _traced_spans_lock
+    _, peak = tracemalloc.get_traced_memory()
+    for traced_span in _traced_spans:
+        traced_span.traced_peak_bytes = max(traced_span.traced_peak_bytes or 0, peak)
+    tracemalloc.reset_peak()
+
+
+def _write_record(record: dict) -> None:
+    report_path = get_report_path()
+    line = json.dumps(record, default=str) + "\n"
+    with _report_lock:
+        report_path.parent.mkdir(parents=True, exist_ok=True)
+        # Each record is appended with a single write, so records from concurrent stage processes do not interleave
+        with open(report_path, "a") as report_file:
+            report_file.write(line)
+
+
+class Span:
+    """
+    Measures a section of the pipeline, such as a stage or a single download or database write, and appends a record
+    of it to the run report when it closes. Spans opened inside another span record it as their parent.
+
+    Parameters
+    ----------
+    name : str
+        What the span measures, e.g. stats_nz_fetch or db_write.
+    rows_in : Optional[int] = None
+        The number of rows going into the section, if known when it starts.
+    **attributes : Any
+        Details to identify the span in the report, e.g. the table name.
+
+    Attributes
+    ----------
+    rows_in : Optional[int]
+        The number of rows going into the section. May be set while the span is open.
+    rows_out : Optional[int]
+        The number of rows the section produced. May be set while the span is open.
+    traced_peak_bytes : Optional[int]
+        The peak memory traced by tracemalloc while the span was open, if tracemalloc is tracing.
+        The peak is for the whole process, so it includes memory used by any concurrent threads.
+    """
+
+    def __init__(self, name: str, rows_in: Optional[int] = None, **attributes: Any):
+        self.name = name
+        self.rows_in = rows_in
+        self.rows_out: Optional[int] = None
+        self.attributes = attributes
+        self.traced_peak_bytes: Optional[int] = None
+        self.span_id = f"{os.getpid()}-{next(_span_ids)}"
+        self.parent_id: Optional[str] = None
+        self._token: Optional[contextvars.Token] = None
+        self._started_at = 0.0
+        self._wall_start = 0.0
+        self._cpu_start = 0.0
+
+    def set(self, **attributes: Any) -> None:
+        """Adds details that are only known once the section has run, e.g. the number of retries."""
+        self.attributes.update(attributes)
+
+    def __enter__(self) -> "Span":
+        parent = _current_span.get() or _stage_span
+        self.parent_id = parent.span_id if parent is not None else None
+        self._token = _current_span.set(self)
+        if tracemalloc.is_tracing():
+            with _traced_spans_lock:
+                _credit_traced_peak()
+                self.traced_peak_bytes = tracemalloc.get_traced_memory()[0]
+                _traced_spans.add(self)
+        self._started_at = time.time()
+        self._wall_start = time.perf_counter()
+        self._cpu_start = time.process_time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback) -> None:
+        wall_seconds = time.perf_counter() - self._wall_start
+        cpu_seconds = time.process_time() - self._cpu_start
+        if self in _traced_spans:
+            with _traced_spans_lock:
+                _credit_traced_peak()
+                _traced_spans.discard(self)
+        _current_span.reset(self._token)
+        _write_record({
+            "run_id": os.environ.get(RUN_ID_ENV_VARIABLE),
+            "pid": os.getpid(),
+            "stage": _stage_span.attributes.get("stage") if _stage_span is not None else None,
+            "span_id": self.span_id,
+            "parent_id": self.parent_id,
+            "name": self.name,
+            "attributes": self.attributes,
+            "started_at": datetime.datetime.fromtimestamp(self._started_at, datetime.timezone.utc).isoformat(),
+            "wall_seconds": round(wall_seconds, 6),
+            # CPU time of the whole process, so it includes any threads running at the same time
+            "cpu_seconds": round(cpu_seconds, 6),
+            # The high-water mark of the process so far. Each stage runs in its own process, so for a stage span
+            # this is the stage's peak.
+            "max_rss_mib": get_max_rss_mib(),
+            "traced_peak_mib": round(self.traced_peak_bytes / MIB, 3) if self.traced_peak_bytes is not None else None,
+            "rows_in": self.rows_in,
+            "rows_out": self.rows_out,
+            "error": exc_type.__name__ if exc_type is not None else None,
+        })
+
+
+class _DisabledSpan:
+    """Stands in for a Span when instrumentation is disabled, ignoring everything it is given."""
+    __slots__ = ()
+
+    def __setattr__(self, name: str, value: Any) -> None:
+        pass
+
+    def set(self, **attributes: Any) -> None:
+        pass
+
+    def __enter__(self) -> "_DisabledSpan":
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback) -> None:
+        pass
+
+
+_DISABLED_SPAN = _DisabledSpan()
+
+
+def span(name: str, rows_in: Optional[int] = None, **attributes: Any) -> Union[Span, _DisabledSpan]:
+    """
+    Measures the section of code in a with block, if instrumentation is enabled by INSTRUMENTATION_REPORT.
+    When it is disabled, a shared object that does nothing is returned, so instrumented code costs only this call.
+
+    Parameters
+    ----------
+    name : str
+        What the span measures, e.g. stats_nz_fetch or db_write.
+    rows_in : Optional[int] = None
+        The number of rows going into the section, if known when it starts.
+    **attributes : Any
+        Details to identify the span in the report, e.g. the table name.
+
+    Returns
+    -------
+    Union[Span, _DisabledSpan]
+        The context manager to measure the section with. rows_in, rows_out and set() can be used on it either way.
+    """
+    if not Env.INSTRUMENTATION_REPORT:
+        return _DISABLED_SPAN
+    return Span(name, rows_in, **attributes)
+
+
+def get_max_rss_mib() -> Optional[float]:
+    if resource is None:
+        return None
+    # ru_maxrss is in KiB on Linux
+    return round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 3)
+
+
+def start_run() -> str:
+    """
+    Assigns an id to this initialisation run, which every process started afterwards includes in its records.
+
+    Returns
+    -------
+    str
+        The run id.
+    """
+    run_id = os.environ.setdefault(RUN_ID_ENV_VARIABLE, uuid.uuid4().hex[:12])
+    if is_enabled():
+        log.info(f"Recording run {run_id} to {get_report_path()}")
+    return run_id
+
+
+@contextlib.contextmanager
+def instrument_stage(stage_name: str) -> Iterator[None]:
+    """
+    Measures a pipeline stage in the process running it, optionally tracing its memory with tracemalloc
+    (INSTRUMENTATION_TRACEMALLOC) and profiling it with cProfile if it is the INSTRUMENTATION_PROFILE_STAGE.
+    The profile only covers the stage's main thread, and is written as a .prof file next to the run report, which
+    can be opened with pstats or snakeviz.
+
+    Parameters
+    ----------
+    stage_name : str
+        The name of the stage.
+
+    Returns
+    -------
+    Iterator[None]
+        A context manager to run the stage in.
+    """
+    global _stage_span
+    profiler = cProfile.Profile() if Env.INSTRUMENTATION_PROFILE_STAGE == stage_name else None
+    if is_enabled() and Env.INSTRUMENTATION_TRACEMALLOC and not tracemalloc.is_tracing():
+        tracemalloc.start()
+    stage_span = span("stage", stage=stage_name)
+    try:
+        with stage_span:
+            if isinstance(stage_span, Span):
+                _stage_span = stage_span
+            if profiler is not None:
+                profiler.enable()
+            try:
+                yield
+            finally:
+                if profiler is not None:
+                    profiler.disable()
+    finally:
+        _stage_span = None
+        if profiler is not None:
+            profile_path = get_profile_path(stage_name)
+            profile_path.parent.mkdir(parents=True, exist_ok=True)
+            profiler.dump_stats(profile_path)
+            log.info(f"Wrote cProfile stats for stage {stage_name} to {profile_path}")
@@ -0,0 +1,120 @@
+import hashlib
+import json
+import logging
+from typing import Dict, List, NamedTuple, Optional, Sequence
+
+import sqlalchemy
+
+from sql_quoting import quote_identifier, quote_literal
+
+log = logging.getLogger(__name__)
+
+
+class MaterialisedView(NamedTuple):
+    """
+    Definition of a PostGIS materialised view that precomputes a query served by GeoServer.
+
+    Attributes
+    ----------
+    name : str
+        The name of the materialised view.
+    query : str
+        The SELECT statement that populates the view.
+    unique_columns : Sequence[str]
+        Columns that uniquely identify a row. A unique index on these is required to refresh the view concurrently.
+    index_columns : Sequence[str] = ()
+        Columns that are filtered on, which each get a btree index.
+    geometry_column : Optional[str] = None
+        The geometry column, if any, which gets a GiST index.
+    """
+    name: str
+    query: str
+    unique_columns: Sequence[str]
+    index_columns: Sequence[str] = ()
+    geometry_column: Optional[str] = None
+
+
+def get_definition_hash(view: MaterialisedView) -> str:
+    # Stored as the view's comment, so a view whose definition has changed in the code is recreated
+    return hashlib.sha256(json.dumps(view._asdict(), sort_keys=True, default=list).encode()).hexdigest()
+
+
+def _materialised_view_comments(connection: sqlalchemy.engine.Connection) -> Dict[str, Optional[str]]:
+    return dict(connection.execute(sqlalchemy.text("""
+        SELECT relname, obj_description(oid, 'pg_class')
+        FROM pg_class
+        WHERE relkind = 'm' AND pg_table_is_visible(oid)
+    """)).all())
+
+
+def create_materialised_views_if_not_exist(engine: sqlalchemy.engine.Engine,
+                                           views: Sequence[MaterialisedView]) -> List[str]:
+    """
+    Creates and populates materialised views and their indexes, if they do not already exist.
+    A view created from a different definition, such as by an earlier version of the code, is dropped and created
+    again in the same transaction.
+
+    Parameters
+    ----------
+    engine : sqlalchemy.engine.Engine
+        The engine connected to the PostGIS database.
+    views : Sequence[MaterialisedView]
+        The materialised views to create.
+
+    Returns
+    -------
+    List[str]
+        The names of the views that were created by this call.
+    """
+    created = []
+    with engine.begin() as connection:
+        existing_views = _materialised_view_comments(connection)
+        for view in views:
+            definition_hash = get_definition_hash(view)
+            view_name = quote_identifier(view.name)
+            if view.name in existing_views:
+                if existing_views[view.name] == definition_hash:
+                    continue
+                log.info(f"Materialised view {view.name} has changed, dropping it to create it again")
+                connection.execute(sqlalchemy.text(f"DROP MATERIALIZED VIEW {view_name}"))
+            log.info(f"Creating materialised view {view.name}")
+            connection.execute(sqlalchemy.text(f"CREATE MATERIALIZED VIEW {view_name} AS {view.query}"))
+            unique_columns = ", ".join(quote_identifier(column) for column in view.unique_columns)
+            connection.execute(sqlalchemy.text(f"CREATE UNIQUE INDEX ON {view_name} ({unique_columns})"))
+            for column in view.index_columns:
+                connection.execute(sqlalchemy.text(f"CREATE INDEX ON {view_name} ({quote_identifier(column)})"))
+            if view.geometry_column is not None:
+                connection.execute(sqlalchemy.text(
+                    f"CREATE INDEX ON {view_name} USING GIST ({quote_identifier(view.geometry_column)})"))
+            connection.execute(sqlalchemy.text(
+                f"COMMENT ON MATERIALIZED VIEW {view_name} IS {quote_literal(definition_hash)}"))
+            created.append(view.name)
+    return created
+
+
+def refresh_materialised_views(engine: sqlalchemy.engine.Engine, views: Sequence[MaterialisedView]) -> None:
+    """
+    Recomputes materialised views after their source tables have been reloaded, creating any that do not exist.
+    Existing views are refreshed concurrently, so GeoServer can keep reading them during the refresh.
+
+    Parameters
+    ----------
+    engine : sqlalchemy.engine.Engine
+        The engine connected to the PostGIS database.
+    views : Sequence[MaterialisedView]
+        The materialised views to refresh, in dependency order.
+
+    Returns
+    -------
+    None
+        This function does not return anything.
+    """
+    created = set(create_materialised_views_if_not_exist(engine, views))
+    for view in views:
+        if view.name in created:
+            # Already populated when it was created
+            continue
+        log.info(f"Refreshing materialised view {view.name}")
+        with engine.begin() as connection:
+            connection.execute(sqlalchemy.text(
+                f"REFRESH MATERIALIZED VIEW CONCURRENTLY {quote_identifier(view.name)}"))
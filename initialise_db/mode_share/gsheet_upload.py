@@ -0,0 +1,265 @@
+import logging
+import random
+import threading
+import time
+from http import HTTPStatus
+from typing import Callable, Dict, List, Optional, TypeVar, Union
+
+import gspread
+import instrumentation
+import pandas as pd
+
+log = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+RETRYABLE_STATUSES = {
+    HTTPStatus.TOO_MANY_REQUESTS,
+    HTTPStatus.INTERNAL_SERVER_ERROR,
+    HTTPStatus.BAD_GATEWAY,
+    HTTPStatus.SERVICE_UNAVAILABLE,
+    HTTPStatus.GATEWAY_TIMEOUT,
+}
+
+
+class TokenBucket:
+    """
+    A thread safe token bucket that limits the rate of Google API requests across every upload sharing it.
+    When a quota error is hit, pause() holds back every caller, not just the one that hit the error, since the quota
+    is shared by the whole service account.
+
+    Parameters
+    ----------
+    requests_per_minute : float
+        The sustained rate that tokens are added to the bucket.
+    capacity : Optional[float] = None
+        The maximum number of tokens, i.e. the largest burst of requests. Defaults to one second's worth of requests.
+    clock : Callable[[], float] = time.monotonic
+        The time source, which can be replaced to test the limiter without waiting.
+    sleep : Callable[[float], None] = time.sleep
+        Waits for a number of seconds, which can be replaced along with clock.
+    """
+
+    def __init__(self,
+                 requests_per_minute: float,
+                 capacity: Optional[float] = None,
+                 clock: Callable[[], float] = time.monotonic,
+                 sleep: Callable[[float], None] = time.sleep):
+        self.rate = requests_per_minute / 60
+        self.capacity = max(self.rate, 1) if capacity is None else capacity
+        self.clock = clock
+        self.sleep = sleep
+        self._tokens = self.capacity
+        self._updated_at = clock()
+        self._paused_until = 0.0
+        self._lock = threading.Lock()
+
+    def _reserve(self) -> float:
+        # Takes a token, possibly going into debt, and returns how long the caller must wait for it
+        with self._lock:
+            now = self.clock()
+            self._tokens = min(self.capacity, self._tokens + (now - self._updated_at) * self.rate)
+            self._updated_at = now
+            self._tokens -= 1
+            wait_for_token = -self._tokens / self.rate if self._tokens < 0 else 0
+            return max(wait_for_token, self._paused_until - now)
+
+    def acquire(self) -> None:
+        """Blocks until a request may be sent."""
+        wait = self._reserve()
+        if wait > 0:
+            self.sleep(wait)
+
+    def pause(self, seconds: float) -> None:
+        """Holds back every caller for at least the given number of seconds, and empties the bucket."""
+        with self._lock:
+            now = self.clock()
+            self._paused_until = max(self._paused_until, now + seconds)
+            self._tokens = min(self._tokens, 0)
+
+
+def get_retry_after(error: gspread.exceptions.APIError) -> Optional[float]:
+    """
+    Reads how long the API asked us to wait before retrying from a quota error's Retry-After header.
+
+    Parameters
+    ----------
+    error : gspread.exceptions.APIError
+        The error raised by gspread.
+
+    Returns
+    -------
+    Optional[float]
+        The number of seconds to wait, or None if the response did not say.
+    """
+    retry_after = error.response.headers.get("Retry-After")
+    try:
+        return float(retry_after) if retry_after is not None else None
+    except ValueError:
+        # Retry-After may also be an HTTP date, which the Google APIs do not send in practice
+        return None
+
+
+def call_with_backoff(rate_limiter: TokenBucket,
+                      request: Callable[[], T],
+                      max_attempts: int = 6,
+                      base_delay: float = 2,
+                      max_delay: float = 120,
+                      request_name: Optional[str] = None) -> T:
+    """
+    Sends a Google API request through the shared rate limiter, retrying quota and server errors with exponential
+    backoff and full jitter. The API's Retry-After hint is used as the minimum delay when it is given.
+
+    Parameters
+    ----------
+    rate_limiter : TokenBucket
+        The limiter shared by every upload.
+    request : Callable[[], T]
+        Sends the request.
+    max_attempts : int = 6
+        The number of times to try the request before giving up.
+    base_delay : float = 2
+        The backoff delay in seconds after the first failure, doubling after each further failure.
+    max_delay : float = 120
+        The largest backoff delay in seconds.
+    request_name : Optional[str] = None
+        Identifies the request in the run report. Defaults to the name of the request function.
+
+    Returns
+    -------
+    T
+        The result of the request.
+
+    Raises
+    ------
+    gspread.exceptions.APIError
+        If the request fails with an error that is not retryable, or fails max_attempts times.
+    """
+    request_name = request_name or getattr(request, "__name__", "request")
+    # The span includes time spent waiting on the rate limiter and backing off, as well as the requests themselves
+    with instrumentation.span("sheets_request", request=request_name) as request_span:
+        for attempt in range(max_attempts):
+            request_span.set(attempts=attempt + 1)
+            rate_limiter.acquire()
+            try:
+                return request()
+            except gspread.exceptions.APIError as e:
+                if e.response.status_code not in RETRYABLE_STATUSES or attempt >= max_attempts - 1:
+                    raise
+                backoff = random.uniform(0, min(max_delay, base_delay * 2 ** attempt))
+                delay = max(backoff, get_retry_after(e) or 0)
+                log.warning(f"Google API returned {e.response.status_code}, retrying in {delay:.1f}s "
+                            f"(attempt {attempt + 1} of {max_attempts})")
+                rate_limiter.pause(delay)
+
+
+def frame_to_values(frame: pd.DataFrame) -> List[List[Union[str, int, float]]]:
+    # noinspection PyTypeChecker
+    return [frame.columns.values.tolist()] + frame.values.tolist()
+
+
+def upload_spreadsheet(gspread_client: gspread.Client,
+                       rate_limiter: TokenBucket,
+                       spreadsheet_name: str,
+                       sheets: Dict[str, pd.DataFrame]) -> gspread.Spreadsheet:
+    """
+    Replaces the contents of a spreadsheet, creating it if it does not exist, using a fixed number of API calls no
+    matter how many sheets there are: one to find the spreadsheet, one to read its sheet metadata, one batch_update to
+    remove the old sheets and add the new ones, and one values_batch_update to write every sheet's values.
+
+    Parameters
+    ----------
+    gspread_client : gspread.Client
+        The authorised client.
+    rate_limiter : TokenBucket
+        The limiter shared by every upload.
+    spreadsheet_name : str
+        The name of the spreadsheet.
+    sheets : Dict[str, pd.DataFrame]
+        The sheets to write in order, by title. Each frame is written with its columns as a header row.
+
+    Returns
+    -------
+    gspread.Spreadsheet
+        The uploaded spreadsheet.
+    """
+    log.info(f"Uploading Google Sheet {spreadsheet_name}")
+    existing_spreadsheets = call_with_backoff(rate_limiter, lambda: gspread_client.openall(spreadsheet_name),
+                                              request_name="openall")
+    if existing_spreadsheets:
+        spreadsheet = existing_spreadsheets[0]
+    else:
+        spreadsheet = call_with_backoff(rate_limiter, lambda: gspread_client.create(spreadsheet_name),
+                                        request_name="create")
+    metadata = call_with_backoff(rate_limiter, spreadsheet.fetch_sheet_metadata)
+    existing_sheets = sorted((sheet["properties"] for sheet in metadata["sheets"]), key=lambda sheet: sheet["index"])
+
+    # A spreadsheet must always have a sheet, so the first existing sheet is kept, cleared and reused for the first
+    # new sheet, and the rest are replaced
+    first_sheet_id = existing_sheets[0]["sheetId"]
+    next_sheet_id = max(sheet["sheetId"] for sheet in existing_sheets) + 1
+    sheet_ids = {}
+    requests = [{"deleteSheet": {"sheetId": sheet["sheetId"]}} for sheet in existing_sheets[1:]]
+    requests.append({"updateCells": {"range": {"sheetId": first_sheet_id}, "fields": "userEnteredValue"}})
+    for index, (title, frame) in enumerate(sheets.items()):
+        properties = {
+            "title": title,
+            "index": index,
+            "gridProperties": {"rowCount": len(frame) + 1, "columnCount": max(len(frame.columns), 1)},
+        }
+        if index == 0:
+            sheet_ids[title] = first_sheet_id
+            requests.append({"updateSheetProperties": {
+                "properties": {"sheetId": first_sheet_id, **properties},
+                "fields": "title,index,gridProperties(rowCount,columnCount)",
+            }})
+        else:
+            sheet_ids[title] = next_sheet_id
+            requests.append({"addSheet": {"properties": {"sheetId": next_sheet_id, **properties}}})
+            next_sheet_id += 1
+    call_with_backoff(rate_limiter, lambda: spreadsheet.batch_update({"requests": requests}),
+                      request_name="batch_update")
+
+    value_ranges = [
+        {"range": f"'{title}'!A1", "values": frame_to_values(frame)}
+        for title, frame in sheets.items()
+    ]
+    call_with_backoff(rate_limiter, lambda: spreadsheet.values_batch_update(
+        body={"valueInputOption": "RAW", "data": value_ranges}), request_name="values_batch_update")
+    return spreadsheet
+
+
+def share_spreadsheet(rate_limiter: TokenBucket, spreadsheet: gspread.Spreadsheet, admin_email: str) -> None:
+    """
+    Makes a spreadsheet readable by anyone with the link, and transfers its ownership to the admin, if that has not
+    already been done.
+
+    Parameters
+    ----------
+    rate_limiter : TokenBucket
+        The limiter shared by every upload.
+    spreadsheet : gspread.Spreadsheet
+        The spreadsheet to share.
+    admin_email : str
+        The email address of the user to transfer ownership to.
+
+    Returns
+    -------
+    None
+        This function does not return anything.
+    """
+    permissions = call_with_backoff(rate_limiter, spreadsheet.list_permissions)
+    if not any(permission["id"] == "anyoneWithLink" and permission["role"] == "reader"
+               for permission in permissions):
+        call_with_backoff(rate_limiter, lambda: spreadsheet.share(
+            email_address=None, perm_type="anyone", role="reader", with_link=True),
+                          request_name="share_with_link").raise_for_status()
+    if not any(permission.get("emailAddress") == admin_email and (
+            permission["role"] == "writer" or permission.get("pendingOwner"))
+               for permission in permissions):
+        transfer_ownership_response = call_with_backoff(rate_limiter, lambda: spreadsheet.share(
+            email_address=admin_email, perm_type="user", role="writer", notify=True), request_name="share_with_admin")
+        transfer_ownership_response.raise_for_status()
+        owner_permission_id = transfer_ownership_response.json()["id"]
+        call_with_backoff(rate_limiter, lambda: spreadsheet.transfer_ownership(owner_permission_id),
+                          request_name="transfer_ownership").raise_for_status()
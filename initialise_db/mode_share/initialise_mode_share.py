@@ -1,51 +1,117 @@
+import functools
 import logging
+import pathlib
+from typing import List, Optional, Sequence
 
-import geoapis.vector
 import geopandas as gpd
+import instrumentation
+import national_geographies
 import pandas as pd
 import sqlalchemy
 import stats_nz_geographies
+from build_manifest import fingerprint, rebuild_changed_areas, rebuild_changed_areas_from_query
 from config import EnvVariable as Env
 from config import get_db_engine
+from data_cache import CachedStatsNz, file_hash
+from materialised_views import create_materialised_views_if_not_exist
+from mode_share.mode_share_views import MODE_SHARE_VIEWS, refresh_mode_share_views
+from table_indexes import ensure_table_indexes
+from table_schemas import describe_schema
 
 log = logging.getLogger(__name__)
 
+MODE_SHARE_INDEX_COLUMNS = ["SA2_code_usual_residence_address", "SA2_code_workplace_address"]
+# Info that is duplicated in SA2 table, dropped to keep data normalised
+MODE_SHARE_DROPPED_COLUMNS = {
+    "SA2_name_usual_residence_address",
+    "SA2_usual_residence_easting",
+    "SA2_usual_residence_northing",
+    "SA2_name_workplace_address",
+    "SA2_workplace_easting",
+    "SA2_workplace_northing",
+}
+SUPPRESSED_VALUE = -999
+# Names of SA2s that represent inlets and other non-mainland features
+NON_MAINLAND_SA2_PREFIXES = ("Inlet", "Inland water", "Oceanic")
 
-def find_sa2s_in_area(area_of_interest: stats_nz_geographies.AreaOfInterest) -> gpd.GeoDataFrame:
+
+def find_sa2s_in_areas_of_interest(
+        areas_of_interest: Sequence[stats_nz_geographies.AreaOfInterest] = stats_nz_geographies.AREAS_OF_INTEREST
+) -> gpd.GeoDataFrame:
+    # The urban/rural layer is fetched nationally in the CRS of the sa2s, so one filter serves every area
+    urban_area_filter = stats_nz_geographies.fetch_urban_area_filter(
+        CachedStatsNz(key=Env.STATS_API_KEY, crs=4326), [aoi.ua_name for aoi in areas_of_interest])
+    return pd.concat(stats_nz_geographies.fetch_for_areas_of_interest(
+        functools.partial(find_sa2s_in_area, urban_area_filter=urban_area_filter), areas_of_interest))
+
+
+def find_sa2s_in_area(area_of_interest: stats_nz_geographies.AreaOfInterest,
+                      urban_area_filter: Optional[stats_nz_geographies.UrbanAreaFilter] = None) -> gpd.GeoDataFrame:
     # All SA2s in bbox
-    vector_fetcher = geoapis.vector.StatsNz(key=Env.STATS_API_KEY,
-                                            bounding_polygon=area_of_interest.bbox.as_gdf())
+    vector_fetcher = CachedStatsNz(key=Env.STATS_API_KEY, bounding_polygon=area_of_interest.bbox.as_gdf())
     sa2s = vector_fetcher.run(92212)
     sa2s.set_index("SA22018_V1_00", verify_integrity=True, inplace=True)
     sa2s.index = sa2s.index.astype('int64')
-    sa2s_in_urban_area = stats_nz_geographies.filter_gdf_by_urban_rural_area(sa2s, area_of_interest.ua_name,
-                                                                             vector_fetcher)
+    sa2s_in_urban_area = stats_nz_geographies.filter_gdf_by_urban_rural_area(
+        sa2s, area_of_interest.ua_name, vector_fetcher, urban_area_filter=urban_area_filter)
     # Filter to remove SA1s that represent inlets and other non-mainland features.
     return sa2s_in_urban_area.loc[
-        ~sa2s_in_urban_area["SA22018_V1_NAME"].str.startswith(("Inlet", "Inland water", "Oceanic"))
+        ~sa2s_in_urban_area["SA22018_V1_NAME"].str.startswith(NON_MAINLAND_SA2_PREFIXES)
     ]
 
 
-def find_mode_shares_in_areas_of_interest(sa2_ids: pd.DataFrame) -> pd.DataFrame:
-    mode_shares = pd.read_csv(Env.MEANS_OF_TRAVEL_DATA)
-    # Drop info that is duplicated in SA2 table to keep data normalised
-    mode_shares = mode_shares.drop(columns=[
-        "SA2_name_usual_residence_address",
-        "SA2_usual_residence_easting",
-        "SA2_usual_residence_northing",
-        "SA2_name_workplace_address",
-        "SA2_workplace_easting",
-        "SA2_workplace_northing",
-    ])
-    mode_shares = mode_shares.loc[
-        mode_shares["SA2_code_usual_residence_address"].isin(sa2_ids.index)
-        & mode_shares["SA2_code_workplace_address"].isin(sa2_ids.index)]
-    return mode_shares.set_index(["SA2_code_usual_residence_address", "SA2_code_workplace_address"],
-                                 verify_integrity=True)
+def find_mode_shares_in_areas_of_interest(sa2_ids: pd.DataFrame,
+                                          residence_sa2_ids: Optional[pd.DataFrame] = None,
+                                          chunk_size: int = 100_000) -> pd.DataFrame:
+    """
+    Streams the means of travel CSV in chunks, keeping only the rows where both the usual residence and workplace are
+    in the given SA2s. Only the needed columns are read, with compact integer types, so peak memory depends on the
+    size of the filtered result rather than the size of the input file.
+
+    Parameters
+    ----------
+    sa2_ids : pd.DataFrame
+        A DataFrame indexed by the SA2 ids to keep.
+    residence_sa2_ids : Optional[pd.DataFrame] = None
+        If given, only keep rows whose usual residence is one of these SA2 ids, e.g. when rebuilding a single area.
+    chunk_size : int = 100_000
+        The number of CSV rows to parse at a time.
+
+    Returns
+    -------
+    pd.DataFrame
+        The mode share counts, indexed by usual residence and workplace SA2 codes, with suppressed values set to zero.
+    """
+    data_file = Env.MEANS_OF_TRAVEL_DATA
+    header = pd.read_csv(data_file, nrows=0).columns
+    use_columns = [column for column in header if column not in MODE_SHARE_DROPPED_COLUMNS]
+    # SA2 codes are six digits and commuter counts are small, so 32-bit integers hold every value
+    column_dtypes = {column: "int32" for column in use_columns}
+    sa2_id_set = sa2_ids.index.unique()
+    residence_sa2_id_set = sa2_id_set if residence_sa2_ids is None else residence_sa2_ids.index.unique()
+
+    log.info(f"Streaming {data_file} in chunks of {chunk_size} rows")
+    filtered_chunks = []
+    num_rows_read = 0
+    with instrumentation.span("csv_read", file=data_file.name) as read_span:
+        for chunk in pd.read_csv(data_file, usecols=use_columns, dtype=column_dtypes, chunksize=chunk_size):
+            num_rows_read += len(chunk)
+            chunk = chunk.loc[
+                chunk["SA2_code_usual_residence_address"].isin(residence_sa2_id_set)
+                & chunk["SA2_code_workplace_address"].isin(sa2_id_set)]
+            filtered_chunks.append(set_suppressed_values_as_zero(chunk))
+        if filtered_chunks:
+            mode_shares = pd.concat(filtered_chunks, ignore_index=True)
+        else:
+            # A CSV with a header but no rows can produce no chunks at all
+            mode_shares = pd.DataFrame({column: pd.Series(dtype=dtype) for column, dtype in column_dtypes.items()})
+        read_span.rows_in = num_rows_read
+        read_span.rows_out = len(mode_shares)
+    return mode_shares.set_index(MODE_SHARE_INDEX_COLUMNS, verify_integrity=True)
 
 
 def set_suppressed_values_as_zero(mode_shares: pd.DataFrame) -> pd.DataFrame:
-    return mode_shares.replace(-999, 0)
+    return mode_shares.replace(SUPPRESSED_VALUE, 0)
 
 
 def convert_mode_share_df_to_gdf(mode_shares: pd.DataFrame) -> gpd.GeoDataFrame:
@@ -68,30 +134,69 @@ def convert_mode_share_df_to_gdf(mode_shares: pd.DataFrame) -> gpd.GeoDataFrame:
 
 def initialise_mode_share(engine: sqlalchemy.engine.Engine) -> None:
     sa2s_table_name = "sa2s"
+    mode_share_table_name = "mode_share"
     index_col = "SA22018_V1_00"
-    if sqlalchemy.inspect(engine).has_table(sa2s_table_name):
-        log.info(f"Table {sa2s_table_name} exists, reading")
-        sa2_ids = pd.read_sql(f'SELECT "{index_col}" FROM {sa2s_table_name}', engine, index_col=index_col)
+    code_version = file_hash(pathlib.Path(__file__))
+    areas_of_interest = {aoi.ua_name: aoi for aoi in stats_nz_geographies.AREAS_OF_INTEREST}
+
+    def build_sa2s(area_names: List[str]) -> gpd.GeoDataFrame:
+        return find_sa2s_in_areas_of_interest([areas_of_interest[area_name] for area_name in area_names])
+
+    if national_geographies.is_enabled():
+        sa2s_inputs = national_geographies.get_area_inputs(engine, "national_sa2s", code_version)
+        sa2s_reloaded = rebuild_changed_areas_from_query(
+            engine, sa2s_table_name, sa2s_inputs,
+            # Filter to remove SA2s that represent inlets and other non-mainland features, as find_sa2s_in_area does
+            national_geographies.select_polygons_in_urban_areas("national_sa2s", condition=" AND ".join(
+                f"NOT starts_with(polygons.\"SA22018_V1_NAME\", '{prefix}')" for prefix in NON_MAINLAND_SA2_PREFIXES)),
+            area_condition='"UR2023_V1_00_NAME" = ANY(%(areas)s)',
+        )
     else:
-        log.info(f"Table {sa2s_table_name} does not exist, initialising...")
-        sa2s = pd.concat([find_sa2s_in_area(aoi) for aoi in stats_nz_geographies.AREAS_OF_INTEREST])
-        sa2s.to_postgis(sa2s_table_name, engine, if_exists="replace", index=True)
-        sa2_ids = sa2s[[]]  # Only save the index since its all we need
-        log.info(f"Table {sa2s_table_name} initialised.")
-    mode_share_table_name = "mode_share"
-    if sqlalchemy.inspect(engine).has_table(mode_share_table_name):
-        log.info(f"Table {mode_share_table_name} exists, skipping")
+        sa2s_inputs = {
+            area_name: {"area_of_interest": aoi, "code_version": code_version,
+                        "urban_area_predicate": Env.URBAN_AREA_PREDICATE}
+            for area_name, aoi in areas_of_interest.items()
+        }
+        sa2s_reloaded = rebuild_changed_areas(
+            engine, sa2s_table_name, sa2s_inputs, build_sa2s,
+            area_condition='"UR2023_V1_00_NAME" = ANY(%(areas)s)',
+        )
+
+    def build_mode_shares(area_names: List[str]) -> pd.DataFrame:
+        sa2_ids = pd.read_sql(f'SELECT "{index_col}" FROM {sa2s_table_name}', engine, index_col=index_col)
+        residence_sa2_ids = pd.read_sql(
+            f'SELECT "{index_col}" FROM {sa2s_table_name} WHERE "UR2023_V1_00_NAME" = ANY(%(areas)s)',
+            engine, index_col=index_col, params={"areas": area_names})
+        return find_mode_shares_in_areas_of_interest(sa2_ids, residence_sa2_ids)
+
+    # Rows are assigned to the area of their usual residence, but their workplace may be in any area, so every area's
+    # rows depend on the SA2s of all areas
+    all_sa2s_fingerprint = fingerprint(sa2s_inputs)
+    means_of_travel_data_hash = file_hash(Env.MEANS_OF_TRAVEL_DATA)
+    mode_share_inputs = {
+        area_name: {"means_of_travel_data": means_of_travel_data_hash, "code_version": code_version,
+                    "sa2s": all_sa2s_fingerprint, "schema": describe_schema(mode_share_table_name)}
+        for area_name in sa2s_inputs
+    }
+    mode_share_reloaded = rebuild_changed_areas(
+        engine, mode_share_table_name, mode_share_inputs, build_mode_shares,
+        # Rows for the areas, plus any left behind by SA2s that were removed when sa2s was rebuilt
+        area_condition=f'''
+            "SA2_code_usual_residence_address" IN (
+                SELECT "{index_col}" FROM {sa2s_table_name} WHERE "UR2023_V1_00_NAME" = ANY(%(areas)s))
+            OR NOT EXISTS (SELECT 1 FROM {sa2s_table_name} sa2s
+                           WHERE sa2s."{index_col}" = {mode_share_table_name}."SA2_code_usual_residence_address")
+            OR NOT EXISTS (SELECT 1 FROM {sa2s_table_name} sa2s
+                           WHERE sa2s."{index_col}" = {mode_share_table_name}."SA2_code_workplace_address")
+        ''',
+        index_label=MODE_SHARE_INDEX_COLUMNS,
+    )
+
+    ensure_table_indexes(engine, [sa2s_table_name, mode_share_table_name])
+    if sa2s_reloaded or mode_share_reloaded:
+        refresh_mode_share_views(engine)
     else:
-        log.info(f"Table {mode_share_table_name} does not exist, initialising...")
-        mode_shares = find_mode_shares_in_areas_of_interest(sa2_ids)
-        mode_shares = set_suppressed_values_as_zero(mode_shares)
-        mode_shares.to_sql(mode_share_table_name,
-                           engine,
-                           if_exists="replace",
-                           index=True,
-                           index_label=["SA2_code_usual_residence_address", "SA2_code_workplace_address"])
-
-        log.info(f"Table {mode_share_table_name} initialised.")
+        create_materialised_views_if_not_exist(engine, MODE_SHARE_VIEWS)
 
 
 if __name__ == '__main__':
@@ -1,16 +1,14 @@
 import logging
+from typing import List
 
 from config import EnvVariable
-from geoserver_common import create_workspace_if_not_exists, create_datastore_layer, create_db_store_if_not_exists
+from geometry_simplification import SIMPLIFICATION_LEVELS, get_simplified_layer_name
+from geoserver_common import FeatureTypeDefinition, provision_geoserver
 
 log = logging.getLogger(__name__)
 
 
-def create_sa2_view(workspace_name: str, data_store_name: str):
-    create_datastore_layer(workspace_name, data_store_name, layer_name="sa2s")
-
-
-def create_mode_share_view(workspace_name: str, data_store_name: str):
+def get_mode_share_feature_type() -> FeatureTypeDefinition:
     mode_share_layer_name = "mode_share"
     mode_share_query = f"""
         <metadata>
@@ -35,26 +33,23 @@ def create_mode_share_view(workspace_name: str, data_store_name: str):
             </entry>
         </metadata>
     """
-    create_datastore_layer(workspace_name, data_store_name, layer_name=mode_share_layer_name,
-                           metadata_elem=mode_share_query
-                           )
+    return FeatureTypeDefinition(mode_share_layer_name, metadata_elem=mode_share_query)
 
 
-def create_flow_sheets_view(workspace_name: str, data_store_name: str) -> None:
-    create_datastore_layer(workspace_name, data_store_name, layer_name="flow_sheets")
+def get_mode_share_feature_types() -> List[FeatureTypeDefinition]:
+    return [
+        FeatureTypeDefinition("sa2s"),
+        # Published directly from the simplified geometry materialised views created in mode_share_views
+        *(FeatureTypeDefinition(get_simplified_layer_name("sa2s", level), num_decimals=level.num_decimals)
+          for level in SIMPLIFICATION_LEVELS),
+        get_mode_share_feature_type(),
+        FeatureTypeDefinition("flow_sheets"),
+    ]
 
 
 def initialise_geoserver_mode_share():
     log.info("Creating SA2 mode share database views if they do not exist")
-
-    workspace_name = "sa2_mode_share"
-    create_workspace_if_not_exists(workspace_name)
-
     db_name = EnvVariable.POSTGRES_DB
-    data_store_name = f"{db_name} PostGIS"
-    create_db_store_if_not_exists(db_name, workspace_name, data_store_name)
-
-    create_sa2_view(workspace_name, data_store_name)
-    create_mode_share_view(workspace_name, data_store_name)
-    create_flow_sheets_view(workspace_name, data_store_name)
+    provision_geoserver(workspace_name="sa2_mode_share", db_name=db_name, data_store_name=f"{db_name} PostGIS",
+                        feature_types=get_mode_share_feature_types())
     log.info("SA2 mode share database views initialised")
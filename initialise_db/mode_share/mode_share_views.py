@@ -0,0 +1,58 @@
+import logging
+
+import sqlalchemy
+
+from config import get_db_engine
+from geometry_simplification import create_simplified_geometry_views
+from materialised_views import MaterialisedView, refresh_materialised_views
+
+log = logging.getLogger(__name__)
+
+SA2_SIMPLIFIED_VIEWS = create_simplified_geometry_views(
+    "sa2s", "SA22018_V1_00",
+    attribute_columns=["SA22018_V1_NAME", "UR2023_V1_00_NAME"],
+    index_columns=["UR2023_V1_00_NAME"],
+    coverage_columns=["UR2023_V1_00_NAME"],
+)
+
+# Computed once per sa2s load instead of on every flow extraction
+SA2_CENTROIDS_VIEW = MaterialisedView(
+    name="sa2_centroids",
+    query="""
+        SELECT "SA22018_V1_00",
+               "SA22018_V1_NAME",
+               "UR2023_V1_00_NAME",
+               ST_Y(ST_Centroid("geometry")) AS lat,
+               ST_X(ST_Centroid("geometry")) AS lon
+        FROM sa2s
+    """,
+    unique_columns=["SA22018_V1_00"],
+    index_columns=["UR2023_V1_00_NAME"],
+)
+
+MODE_SHARE_VIEWS = [*SA2_SIMPLIFIED_VIEWS, SA2_CENTROIDS_VIEW]
+
+
+def refresh_mode_share_views(engine: sqlalchemy.engine.Engine) -> None:
+    """
+    Creates or refreshes the materialised views that simplify sa2s for GeoServer and hold the SA2 centroids.
+    Should run whenever sa2s is reloaded.
+
+    Parameters
+    ----------
+    engine : sqlalchemy.engine.Engine
+        The engine connected to the PostGIS database.
+
+    Returns
+    -------
+    None
+        This function does not return anything.
+    """
+    log.info("Refreshing SA2 mode share materialised views")
+    refresh_materialised_views(engine, MODE_SHARE_VIEWS)
+    log.info("SA2 mode share materialised views refreshed")
+
+
+if __name__ == '__main__':
+    engine = get_db_engine()
+    refresh_mode_share_views(engine)
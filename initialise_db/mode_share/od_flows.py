@@ -0,0 +1,270 @@
+import dataclasses
+import logging
+import os
+import pathlib
+from typing import Dict, Optional, Sequence
+
+import numpy as np
+import pandas as pd
+import scipy.sparse
+import sqlalchemy
+
+import stats_nz_geographies
+from build_manifest import BuildManifest, fingerprint
+from config import get_db_engine
+from data_cache import file_hash, get_cache_dir
+from mode_share.mode_share_views import SA2_CENTROIDS_VIEW
+
+log = logging.getLogger(__name__)
+
+# Travel modes aggregated from the mode_share census columns, as published in the flow map sheets
+FLOW_COLUMN_EXPRESSIONS = {
+    "Active Transport": '"Walk_or_jog" + "Bicycle"',
+    "Public Transport": '"Public_bus" + "Train" + "Ferry"',
+    "Drive": '"Drive_a_private_car_truck_or_van" + "Drive_a_company_car_truck_or_van"',
+    "Passenger": '"Passenger_in_a_car_truck_van_or_company_bus"',
+    "Other": '"Other"',
+    "Total": '"Total"',
+}
+FLOW_COLUMNS = list(FLOW_COLUMN_EXPRESSIONS)
+
+
+@dataclasses.dataclass
+class AreaFlows:
+    """
+    The commuter flows between the SA2s of one urban area, as sparse origin-destination matrices.
+    SA2s are numbered by their row in locations, and every mode's matrix shares the same sparsity pattern: the OD pairs
+    present in mode_share, including pairs with zero commuters for some modes.
+
+    Attributes
+    ----------
+    urban_area : str
+        The UR2023_V1_00_NAME of the urban area.
+    locations : pd.DataFrame
+        The SA2s of the urban area indexed by SA2 code, with ua_name (the SA2 name), lat and lon of the centroid columns.
+        The row number of each SA2 is its dense id, used as the matrix row and column.
+    flows : Dict[str, scipy.sparse.csr_matrix]
+        The number of commuters from each origin (row) to each destination (column), by mode.
+    """
+    urban_area: str
+    locations: pd.DataFrame
+    flows: Dict[str, scipy.sparse.csr_matrix]
+
+    @classmethod
+    def from_frame(cls, urban_area: str, locations: pd.DataFrame, flows: pd.DataFrame) -> "AreaFlows":
+        """
+        Builds the matrices from flows in long format.
+
+        Parameters
+        ----------
+        urban_area : str
+            The UR2023_V1_00_NAME of the urban area.
+        locations : pd.DataFrame
+            The SA2s of the urban area indexed by SA2 code.
+        flows : pd.DataFrame
+            One row per OD pair, with origin and dest SA2 codes and a column per mode.
+
+        Returns
+        -------
+        AreaFlows
+            The flows as sparse matrices.
+        """
+        num_locations = len(locations)
+        # Sorting keeps each row's column indices sorted, since dense ids follow the SA2 code order of locations
+        flows = flows.sort_values(["origin", "dest"])
+        locations = locations.sort_index()
+        origins = locations.index.get_indexer(flows["origin"])
+        destinations = locations.index.get_indexer(flows["dest"])
+        if (origins < 0).any() or (destinations < 0).any():
+            raise ValueError(f"Flows for {urban_area} reference SA2s that are not in its locations")
+        matrices = {
+            column: scipy.sparse.csr_matrix((flows[column].to_numpy(), (origins, destinations)),
+                                            shape=(num_locations, num_locations))
+            for column in flows.columns if column not in {"origin", "dest"}
+        }
+        return cls(urban_area, locations, matrices)
+
+    def to_frame(self) -> pd.DataFrame:
+        """
+        Converts the matrices back to long format, one row per OD pair ordered by origin then destination SA2 code.
+
+        Returns
+        -------
+        pd.DataFrame
+            The flows, with origin and dest SA2 codes and a column per mode.
+        """
+        sa2_ids = self.locations.index.to_numpy()
+        pattern = next(iter(self.flows.values())).tocoo()
+        frame = pd.DataFrame({"origin": sa2_ids[pattern.row], "dest": sa2_ids[pattern.col]})
+        for column, matrix in self.flows.items():
+            frame[column] = matrix.tocoo().data
+        return frame.sort_values(["origin", "dest"], ignore_index=True)
+
+    def save(self, path: pathlib.Path) -> None:
+        """
+        Saves the flows to a compressed .npz file. Since every mode shares the same sparsity pattern, the indices are
+        stored once, with one data array per mode. The file is written next to its destination and moved into place.
+
+        Parameters
+        ----------
+        path : pathlib.Path
+            The .npz file to write.
+
+        Returns
+        -------
+        None
+            This function does not return anything.
+        """
+        pattern = next(iter(self.flows.values()))
+        temp_path = path.with_name(f".{path.stem}.{os.getpid()}.tmp.npz")
+        np.savez_compressed(
+            temp_path,
+            urban_area=np.array(self.urban_area),
+            sa2_ids=self.locations.index.to_numpy(),
+            sa2_names=self.locations["ua_name"].to_numpy(dtype=str),
+            lat=self.locations["lat"].to_numpy(),
+            lon=self.locations["lon"].to_numpy(),
+            indptr=pattern.indptr,
+            indices=pattern.indices,
+            modes=np.array(list(self.flows), dtype=str),
+            **{f"data_{i}": matrix.data for i, matrix in enumerate(self.flows.values())},
+        )
+        os.replace(temp_path, path)
+
+    @classmethod
+    def load(cls, path: pathlib.Path) -> "AreaFlows":
+        """
+        Loads flows saved by AreaFlows.save.
+
+        Parameters
+        ----------
+        path : pathlib.Path
+            The .npz file to read.
+
+        Returns
+        -------
+        AreaFlows
+            The loaded flows.
+        """
+        with np.load(path) as saved:
+            locations = pd.DataFrame(
+                {"ua_name": saved["sa2_names"].astype(object), "lat": saved["lat"], "lon": saved["lon"]},
+                index=pd.Index(saved["sa2_ids"], name="id"))
+            shape = (len(locations), len(locations))
+            flows = {
+                str(mode): scipy.sparse.csr_matrix((saved[f"data_{i}"], saved["indices"], saved["indptr"]), shape=shape)
+                for i, mode in enumerate(saved["modes"])
+            }
+            return cls(str(saved["urban_area"]), locations, flows)
+
+
+def find_sa2_locations(engine: sqlalchemy.engine.Engine, urban_area_names: Sequence[str]) -> pd.DataFrame:
+    query = f"""
+        SELECT "SA22018_V1_00"     AS id,
+               "UR2023_V1_00_NAME" AS urban_area,
+               "SA22018_V1_NAME"   AS ua_name,
+               lat,
+               lon
+        FROM {SA2_CENTROIDS_VIEW.name}
+        WHERE "UR2023_V1_00_NAME" = ANY(%(urban_area_names)s)
+        ORDER BY "SA22018_V1_00"
+    """
+    return pd.read_sql(query, engine, index_col="id", params={"urban_area_names": list(urban_area_names)})
+
+
+def find_flows(engine: sqlalchemy.engine.Engine, urban_area_names: Sequence[str]) -> pd.DataFrame:
+    flow_columns = ",\n".join(f'({expression}) AS "{column}"' for column, expression in FLOW_COLUMN_EXPRESSIONS.items())
+    query = f"""
+        SELECT residence."UR2023_V1_00_NAME"      AS urban_area,
+               "SA2_code_usual_residence_address" AS origin,
+               "SA2_code_workplace_address"       AS dest,
+               {flow_columns}
+        FROM mode_share
+            JOIN {SA2_CENTROIDS_VIEW.name} AS residence
+                ON residence."SA22018_V1_00" = "SA2_code_usual_residence_address"
+            JOIN {SA2_CENTROIDS_VIEW.name} AS workplace
+                ON workplace."SA22018_V1_00" = "SA2_code_workplace_address"
+        WHERE residence."UR2023_V1_00_NAME" = ANY(%(urban_area_names)s)
+          AND workplace."UR2023_V1_00_NAME" = residence."UR2023_V1_00_NAME"
+    """
+    return pd.read_sql(query, engine, params={"urban_area_names": list(urban_area_names)})
+
+
+def extract_od_flows(engine: sqlalchemy.engine.Engine, urban_area_names: Sequence[str]) -> Dict[str, AreaFlows]:
+    """
+    Extracts the flows within each urban area with one query for the SA2 locations and one for the flows of all areas.
+
+    Parameters
+    ----------
+    engine : sqlalchemy.engine.Engine
+        The engine connected to the PostGIS database.
+    urban_area_names : Sequence[str]
+        The UR2023_V1_00_NAMEs of the urban areas.
+
+    Returns
+    -------
+    Dict[str, AreaFlows]
+        The flows of each urban area, by name.
+    """
+    log.info(f"Extracting OD flows for {list(urban_area_names)}")
+    locations = find_sa2_locations(engine, urban_area_names)
+    flows = find_flows(engine, urban_area_names)
+    area_locations = dict(tuple(locations.groupby("urban_area", sort=False)))
+    area_flows = dict(tuple(flows.groupby("urban_area", sort=False)))
+    empty_flows = flows.iloc[:0]
+    return {
+        urban_area_name: AreaFlows.from_frame(
+            urban_area_name,
+            area_locations.get(urban_area_name, locations.iloc[:0]).drop(columns="urban_area"),
+            area_flows.get(urban_area_name, empty_flows).drop(columns="urban_area"),
+        )
+        for urban_area_name in urban_area_names
+    }
+
+
+def load_od_flows(engine: sqlalchemy.engine.Engine,
+                  urban_area_names: Optional[Sequence[str]] = None) -> Dict[str, AreaFlows]:
+    """
+    Loads the flows within each urban area from the local cache, extracting the areas whose sa2s or mode_share rows
+    have changed since they were cached in a single pass.
+
+    Parameters
+    ----------
+    engine : sqlalchemy.engine.Engine
+        The engine connected to the PostGIS database.
+    urban_area_names : Optional[Sequence[str]] = None
+        The UR2023_V1_00_NAMEs of the urban areas. Defaults to every area of interest.
+
+    Returns
+    -------
+    Dict[str, AreaFlows]
+        The flows of each urban area, by name, in the same order as urban_area_names.
+    """
+    if urban_area_names is None:
+        urban_area_names = [aoi.ua_name for aoi in stats_nz_geographies.AREAS_OF_INTEREST]
+    cache_dir = get_cache_dir("od_flows")
+    code_version = file_hash(pathlib.Path(__file__))
+    sa2s_fingerprints = BuildManifest(engine, "sa2s").recorded_fingerprints
+    mode_share_fingerprints = BuildManifest(engine, "mode_share").recorded_fingerprints
+    cache_paths = {
+        urban_area_name: cache_dir / "{}_{}.npz".format(urban_area_name, fingerprint({
+            "code_version": code_version,
+            "sa2s": sa2s_fingerprints.get(urban_area_name),
+            "mode_share": mode_share_fingerprints.get(urban_area_name),
+        }))
+        for urban_area_name in urban_area_names
+    }
+
+    od_flows = {name: AreaFlows.load(path) for name, path in cache_paths.items() if path.exists()}
+    missing_area_names = [name for name in urban_area_names if name not in od_flows]
+    if missing_area_names:
+        for urban_area_name, area_flows in extract_od_flows(engine, missing_area_names).items():
+            for stale_path in cache_dir.glob(f"{urban_area_name}_*.npz"):
+                stale_path.unlink(missing_ok=True)
+            area_flows.save(cache_paths[urban_area_name])
+            od_flows[urban_area_name] = area_flows
+    return {name: od_flows[name] for name in urban_area_names}
+
+
+if __name__ == '__main__':
+    load_od_flows(get_db_engine())
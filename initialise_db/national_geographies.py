@@ -0,0 +1,267 @@
+import logging
+import pathlib
+from typing import Dict, List, NamedTuple, Sequence
+
+import geopandas as gpd
+import sqlalchemy
+
+import stats_nz_geographies
+from build_manifest import AreaInputs, BuildManifest, rebuild_changed_areas
+from config import EnvVariable as Env
+from config import get_db_engine
+from data_cache import STATS_NZ_LAYER_VERSIONS, CachedStatsNz, file_fingerprint, file_hash
+from sql_quoting import quote_identifier
+from table_indexes import ensure_table_indexes
+
+log = logging.getLogger(__name__)
+
+# "python" fetches the SA1s and SA2s of each area of interest within its bounding box and filters them to the urban
+# area in GeoPandas. "postgis" loads the layers nationally once and derives the sa1s and sa2s tables from them in SQL.
+AREA_FILTER_MODES = ["python", "postgis"]
+NATIONAL_AREA = "national"
+URBAN_RURAL_TABLE_NAME = "national_urban_rural"
+# The CRS the rest of the pipeline, e.g. GeoServer and the vector tiles, expects the sa1s and sa2s tables in. Without a
+# bounding polygon, Stats NZ would otherwise return the layers in NZTM.
+NATIONAL_CRS = 4326
+
+# SQL equivalents of stats_nz_geographies.URBAN_AREA_PREDICATES, with the urban area as ur and the polygon as polygons
+SQL_URBAN_AREA_PREDICATES = {
+    "intersects": "ST_Intersects(ur.geometry, polygons.geometry)",
+    "within": "ST_Contains(ur.geometry, polygons.geometry)",
+    "covered_by": "ST_Covers(ur.geometry, polygons.geometry)",
+    "overlaps": "ST_Overlaps(ur.geometry, polygons.geometry)",
+    "touches": "ST_Touches(ur.geometry, polygons.geometry)",
+    "crosses": "ST_Crosses(ur.geometry, polygons.geometry)",
+    # ST_Intersects lets the spatial index on the polygons find the candidates for the point test
+    stats_nz_geographies.REPRESENTATIVE_POINT_WITHIN: (
+        "ST_Intersects(ur.geometry, polygons.geometry) "
+        "AND ST_Contains(ur.geometry, ST_PointOnSurface(polygons.geometry))"
+    ),
+}
+
+
+class NationalLayer(NamedTuple):
+    """
+    A Stats NZ layer loaded nationally into a staging table.
+
+    Attributes
+    ----------
+    layer_id : int
+        The Stats NZ layer id.
+    integer_codes : bool
+        If True, the layer's code column is stored as bigint, as the sa1s and sa2s tables store it.
+    """
+    layer_id: int
+    integer_codes: bool
+
+    @property
+    def code_column(self) -> str:
+        return STATS_NZ_LAYER_VERSIONS[self.layer_id]
+
+
+NATIONAL_LAYERS = {
+    "national_sa1s": NationalLayer(92210, integer_codes=True),
+    "national_sa2s": NationalLayer(92212, integer_codes=True),
+    URBAN_RURAL_TABLE_NAME: NationalLayer(111198, integer_codes=False),
+}
+
+
+def is_enabled() -> bool:
+    """
+    Checks whether the sa1s and sa2s tables are derived from the national layers in PostGIS.
+
+    Returns
+    -------
+    bool
+        True if AREA_FILTER_MODE is postgis.
+
+    Raises
+    ------
+    ValueError
+        If AREA_FILTER_MODE is not one of AREA_FILTER_MODES.
+    """
+    if Env.AREA_FILTER_MODE not in AREA_FILTER_MODES:
+        raise ValueError(f"AREA_FILTER_MODE is {Env.AREA_FILTER_MODE}, expected one of {AREA_FILTER_MODES}")
+    return Env.AREA_FILTER_MODE == "postgis"
+
+
+def read_national_layer(vector_fetcher: CachedStatsNz, layer: NationalLayer) -> gpd.GeoDataFrame:
+    layer_gdf = vector_fetcher.run(layer.layer_id)
+    if layer_gdf.crs is None or layer_gdf.crs.to_epsg() != NATIONAL_CRS:
+        raise ValueError(f"Stats NZ layer {layer.layer_id} is in {layer_gdf.crs}, expected EPSG:{NATIONAL_CRS}")
+    layer_gdf.set_index(layer.code_column, verify_integrity=True, inplace=True)
+    if layer.integer_codes:
+        layer_gdf.index = layer_gdf.index.astype('int64')
+    return layer_gdf
+
+
+def check_srid(engine: sqlalchemy.engine.Engine, table_name: str) -> None:
+    """
+    Checks that every geometry in a table is in NATIONAL_CRS.
+
+    Parameters
+    ----------
+    engine : sqlalchemy.engine.Engine
+        The engine connected to the PostGIS database.
+    table_name : str
+        The table to check, with a geometry column named geometry.
+
+    Returns
+    -------
+    None
+        This function does not return anything.
+
+    Raises
+    ------
+    ValueError
+        If any geometry has a different SRID.
+    """
+    with engine.connect() as connection:
+        srids = connection.execute(sqlalchemy.text(
+            f"SELECT DISTINCT ST_SRID(geometry) FROM {quote_identifier(table_name)}")).scalars().all()
+    if set(srids) - {NATIONAL_CRS}:
+        raise ValueError(f"Table {table_name} has geometries with SRIDs {sorted(srids)}, expected {NATIONAL_CRS}")
+
+
+def load_national_geographies(engine: sqlalchemy.engine.Engine) -> None:
+    """
+    Loads the SA1, SA2 and urban/rural layers nationally into staging tables, for the sa1s and sa2s tables to be derived
+    from in SQL. A layer is only reloaded when its cache entry changes, e.g. after it expires and is downloaded again.
+    Does nothing unless AREA_FILTER_MODE is postgis.
+
+    Parameters
+    ----------
+    engine : sqlalchemy.engine.Engine
+        The engine connected to the PostGIS database.
+
+    Returns
+    -------
+    None
+        This function does not return anything.
+    """
+    if not is_enabled():
+        log.info(f"AREA_FILTER_MODE is {Env.AREA_FILTER_MODE}, skipping national geographies")
+        return
+    vector_fetcher = CachedStatsNz(key=Env.STATS_API_KEY, crs=NATIONAL_CRS)
+    code_version = file_hash(pathlib.Path(__file__))
+    for table_name, layer in NATIONAL_LAYERS.items():
+        # Downloaded up front, so the staging table is keyed by the cache entry it is loaded from
+        if not vector_fetcher.is_cached(layer.layer_id):
+            vector_fetcher.run(layer.layer_id)
+
+        layer_inputs = {NATIONAL_AREA: {
+            "layer": layer.layer_id,
+            "cache_entry": file_fingerprint(vector_fetcher.cache_path(layer.layer_id)),
+            "code_version": code_version,
+        }}
+        rebuild_changed_areas(engine, table_name, layer_inputs,
+                              lambda _: read_national_layer(vector_fetcher, layer), area_condition="TRUE")
+        check_srid(engine, table_name)
+    ensure_table_indexes(engine, NATIONAL_LAYERS)
+
+
+def find_urban_area_names(engine: sqlalchemy.engine.Engine,
+                          areas_of_interest: Sequence[stats_nz_geographies.AreaOfInterest]) -> List[str]:
+    """
+    Finds which areas of interest are urban areas in the national urban/rural table.
+
+    Parameters
+    ----------
+    engine : sqlalchemy.engine.Engine
+        The engine connected to the PostGIS database.
+    areas_of_interest : Sequence[stats_nz_geographies.AreaOfInterest]
+        The configured areas of interest.
+
+    Returns
+    -------
+    List[str]
+        The UR2023_V1_00_NAME of each area of interest found, in the configured order.
+    """
+    configured_names = [aoi.ua_name for aoi in areas_of_interest]
+    with engine.connect() as connection:
+        found_names = set(connection.execute(sqlalchemy.text(f"""
+            SELECT DISTINCT "UR2023_V1_00_NAME"
+            FROM {URBAN_RURAL_TABLE_NAME}
+            WHERE "UR2023_V1_00_NAME" = ANY(:names)
+        """), {"names": configured_names}).scalars())
+    missing_names = [name for name in configured_names if name not in found_names]
+    if missing_names:
+        log.warning(f"Areas of interest {missing_names} are not urban areas in {URBAN_RURAL_TABLE_NAME}, skipping them")
+    return [name for name in configured_names if name in found_names]
+
+
+def get_area_inputs(engine: sqlalchemy.engine.Engine,
+                    layer_table_name: str,
+                    code_version: str,
+                    areas_of_interest: Sequence[stats_nz_geographies.AreaOfInterest]
+                    = stats_nz_geographies.AREAS_OF_INTEREST) -> Dict[str, AreaInputs]:
+    """
+    Describes the inputs of a table derived from a national layer, for each area of interest, so the build manifest
+    rebuilds an area when either national layer it is derived from is reloaded.
+
+    Parameters
+    ----------
+    engine : sqlalchemy.engine.Engine
+        The engine connected to the PostGIS database.
+    layer_table_name : str
+        The staging table of the layer the table is derived from, e.g. national_sa1s.
+    code_version : str
+        The version of the code deriving the table.
+    areas_of_interest : Sequence[stats_nz_geographies.AreaOfInterest] = AREAS_OF_INTEREST
+        The configured areas of interest.
+
+    Returns
+    -------
+    Dict[str, AreaInputs]
+        The inputs of each area of interest found in the urban/rural table.
+    """
+    national_inputs = {
+        table_name: BuildManifest(engine, table_name).recorded_fingerprints.get(NATIONAL_AREA)
+        for table_name in [layer_table_name, URBAN_RURAL_TABLE_NAME]
+    }
+    return {
+        area_name: {"national_layers": national_inputs, "code_version": code_version,
+                    "urban_area_predicate": Env.URBAN_AREA_PREDICATE}
+        for area_name in find_urban_area_names(engine, areas_of_interest)
+    }
+
+
+def select_polygons_in_urban_areas(layer_table_name: str, condition: str = "TRUE") -> str:
+    """
+    Writes a query selecting the polygons of a national layer that are in the urban areas named in the %(areas)s array
+    parameter, with the name of their urban area, like stats_nz_geographies.filter_gdf_by_urban_rural_area.
+
+    Parameters
+    ----------
+    layer_table_name : str
+        The staging table of the layer, e.g. national_sa1s.
+    condition : str = "TRUE"
+        SQL condition that the polygons, aliased as polygons, must also meet, e.g. to leave out inlets.
+
+    Returns
+    -------
+    str
+        The SELECT statement.
+
+    Raises
+    ------
+    ValueError
+        If URBAN_AREA_PREDICATE is not supported.
+    """
+    predicate = SQL_URBAN_AREA_PREDICATES.get(Env.URBAN_AREA_PREDICATE)
+    if predicate is None:
+        raise ValueError(f"Unsupported URBAN_AREA_PREDICATE {Env.URBAN_AREA_PREDICATE}, "
+                         f"expected one of {list(SQL_URBAN_AREA_PREDICATES)}")
+    return f"""
+        SELECT polygons.*, ur."UR2023_V1_00_NAME"
+        FROM {URBAN_RURAL_TABLE_NAME} ur
+            JOIN {layer_table_name} polygons
+                ON {predicate}
+        WHERE ur."UR2023_V1_00_NAME" = ANY(%(areas)s)
+            AND ({condition})
+    """
+
+
+if __name__ == '__main__':
+    engine = get_db_engine()
+    load_national_geographies(engine)
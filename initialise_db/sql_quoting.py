@@ -0,0 +1,32 @@
+def quote_identifier(identifier: str) -> str:
+    """
+    Quotes a PostgreSQL identifier so that column names with spaces, capitals, or quotes can be used safely.
+
+    Parameters
+    ----------
+    identifier : str
+        The table or column name to quote.
+
+    Returns
+    -------
+    str
+        The quoted identifier.
+    """
+    return '"' + identifier.replace('"', '""') + '"'
+
+
+def quote_literal(value: str) -> str:
+    """
+    Quotes a PostgreSQL string literal, for statements such as CREATE TYPE that do not accept bound parameters.
+
+    Parameters
+    ----------
+    value : str
+        The string to quote.
+
+    Returns
+    -------
+    str
+        The quoted literal.
+    """
+    return "'" + value.replace("'", "''") + "'"
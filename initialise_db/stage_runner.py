@@ -0,0 +1,203 @@
+import importlib
+import importlib.util
+import logging
+import multiprocessing
+import multiprocessing.connection
+from typing import Callable, Dict, List, NamedTuple, Optional, Sequence, Tuple
+
+import instrumentation
+from config import get_db_engine
+from setup_logging import setup_logging
+
+log = logging.getLogger(__name__)
+
+
+class Stage(NamedTuple):
+    """
+    A step of the initialisation pipeline, run in its own process once the stages it depends on have finished.
+
+    Attributes
+    ----------
+    name : str
+        The name used to select the stage from the command line.
+    function : str
+        The module level function that runs the stage, as "module:function", e.g.
+        "emissions.initialise_co2_sa1s:initialise_co2_sa1s". It is only imported in the stage's own process, so the
+        runner does not import the dependencies of every stage.
+    dependencies : Sequence[str] = ()
+        Names of the stages whose outputs this stage reads.
+    uses_database : bool = True
+        If True, the function is passed a database engine created in the stage's own process.
+    """
+    name: str
+    function: str
+    dependencies: Sequence[str] = ()
+    uses_database: bool = True
+
+
+def _split_function_path(function_path: str) -> Tuple[str, str]:
+    module_name, separator, function_name = function_path.partition(":")
+    if not separator or not module_name or not function_name:
+        raise ValueError(f"Stage function {function_path} is not of the form module:function")
+    return module_name, function_name
+
+
+def import_stage_function(function_path: str) -> Callable[..., None]:
+    """
+    Imports the function that runs a stage.
+
+    Parameters
+    ----------
+    function_path : str
+        The function as "module:function".
+
+    Returns
+    -------
+    Callable[..., None]
+        The function.
+
+    Raises
+    ------
+    ValueError
+        If the path is not of the form "module:function".
+    """
+    module_name, function_name = _split_function_path(function_path)
+    return getattr(importlib.import_module(module_name), function_name)
+
+
+class StageFailedError(RuntimeError):
+    """Raised when a stage exits unsuccessfully, after the other running stages have been stopped."""
+
+
+def _run_stage(stage: Stage) -> None:
+    # Runs in the stage's own process, so logging and the database connection are set up again here
+    setup_logging()
+    log.info(f"Starting stage {stage.name}")
+    stage_function = import_stage_function(stage.function)
+    with instrumentation.instrument_stage(stage.name):
+        if stage.uses_database:
+            stage_function(get_db_engine())
+        else:
+            stage_function()
+    log.info(f"Finished stage {stage.name}")
+
+
+def order_stages(stages: Sequence[Stage], selected_stage_names: Optional[Sequence[str]] = None) -> List[Stage]:
+    """
+    Selects stages to run and sorts them so every stage comes after its dependencies.
+
+    Parameters
+    ----------
+    stages : Sequence[Stage]
+        All stages of the pipeline.
+    selected_stage_names : Optional[Sequence[str]] = None
+        The stages to run. Dependencies that are not selected are assumed to be up to date and are not run.
+        If None, all stages are run.
+
+    Returns
+    -------
+    List[Stage]
+        The selected stages in dependency order.
+
+    Raises
+    ------
+    ValueError
+        If a selected stage or a dependency does not exist, or the dependencies contain a cycle.
+    """
+    stages_by_name = {stage.name: stage for stage in stages}
+    for stage in stages:
+        unknown_dependencies = set(stage.dependencies) - stages_by_name.keys()
+        if unknown_dependencies:
+            raise ValueError(f"Stage {stage.name} depends on unknown stages {sorted(unknown_dependencies)}")
+    if selected_stage_names is None:
+        selected_stage_names = list(stages_by_name)
+    unknown_stages = set(selected_stage_names) - stages_by_name.keys()
+    if unknown_stages:
+        raise ValueError(f"Unknown stages {sorted(unknown_stages)}, expected some of {list(stages_by_name)}")
+
+    ordered_stages = []
+    remaining = [stages_by_name[name] for name in dict.fromkeys(selected_stage_names)]
+    while remaining:
+        ordered_names = {stage.name for stage in ordered_stages}
+        remaining_names = {stage.name for stage in remaining}
+        ready = [stage for stage in remaining
+                 if all(dependency in ordered_names or dependency not in remaining_names
+                        for dependency in stage.dependencies)]
+        if not ready:
+            raise ValueError(f"Stage dependencies contain a cycle between {sorted(remaining_names)}")
+        ordered_stages.extend(ready)
+        remaining = [stage for stage in remaining if stage not in ready]
+    return ordered_stages
+
+
+def run_stages(stages: Sequence[Stage],
+               selected_stage_names: Optional[Sequence[str]] = None,
+               max_workers: int = 1) -> None:
+    """
+    Runs pipeline stages, each in a separate process, starting every stage as soon as the stages it depends on have
+    finished and a worker is free. Independent branches, such as emissions and mode share, therefore run concurrently.
+    If any stage fails, the stages still running are terminated and no further stages are started.
+
+    Parameters
+    ----------
+    stages : Sequence[Stage]
+        All stages of the pipeline.
+    selected_stage_names : Optional[Sequence[str]] = None
+        The stages to run. Dependencies that are not selected are assumed to be up to date and are not run.
+        If None, all stages are run.
+    max_workers : int = 1
+        The maximum number of stages to run at once.
+
+    Returns
+    -------
+    None
+        This function does not return anything.
+
+    Raises
+    ------
+    ValueError
+        If a stage's function module does not exist.
+    StageFailedError
+        If any stage exits unsuccessfully.
+    """
+    # Spawn rather than fork, so stages do not inherit database connections or threads from this process
+    context = multiprocessing.get_context("spawn")
+    pending = order_stages(stages, selected_stage_names)
+    # Stage modules are only imported by the stage processes, so check they exist before any stage starts
+    for stage in pending:
+        module_name, _ = _split_function_path(stage.function)
+        if importlib.util.find_spec(module_name) is None:
+            raise ValueError(f"Stage {stage.name} function module {module_name} does not exist")
+    pending_names = {stage.name for stage in pending}
+    finished_names = set()
+    running: Dict[str, multiprocessing.process.BaseProcess] = {}
+    try:
+        while pending or running:
+            for stage in list(pending):
+                if len(running) >= max(max_workers, 1):
+                    break
+                if set(stage.dependencies) & (pending_names - finished_names):
+                    continue
+                log.info(f"Launching stage {stage.name}")
+                process = context.Process(target=_run_stage, args=(stage,), name=stage.name)
+                process.start()
+                running[stage.name] = process
+                pending.remove(stage)
+            if not running:
+                raise RuntimeError(f"No stage is ready to run out of {[stage.name for stage in pending]}")
+
+            multiprocessing.connection.wait([process.sentinel for process in running.values()])
+            for stage_name, process in list(running.items()):
+                if process.exitcode is None:
+                    continue
+                del running[stage_name]
+                if process.exitcode != 0:
+                    raise StageFailedError(f"Stage {stage_name} failed with exit code {process.exitcode}")
+                finished_names.add(stage_name)
+                log.info(f"Stage {stage_name} complete")
+    finally:
+        for stage_name, process in running.items():
+            log.warning(f"Stopping stage {stage_name}")
+            process.terminate()
+        for process in running.values():
+            process.join()
@@ -1,10 +1,26 @@
 import dataclasses
-from typing import NamedTuple
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, List, NamedTuple, Optional, Protocol, Sequence, TypeVar
 
-import geoapis.vector
 import geopandas as gpd
+import numpy as np
 import shapely
 
+from config import EnvVariable as Env
+
+log = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+
+class VectorFetcher(Protocol):
+    """Anything that fetches Stats NZ vector layers by id, such as geoapis.vector.StatsNz or data_cache.CachedStatsNz"""
+
+    def run(self, layer: int) -> gpd.GeoDataFrame:
+        ...
+
 
 @dataclasses.dataclass
 class Bbox:
@@ -41,19 +57,185 @@ AREAS_OF_INTEREST = [
 ]
 
 
+def fetch_for_areas_of_interest(fetch_area: Callable[[AreaOfInterest], T],
+                                areas_of_interest: Sequence[AreaOfInterest] = AREAS_OF_INTEREST,
+                                max_workers: Optional[int] = None) -> List[T]:
+    """
+    Runs a fetch function for each area of interest using a bounded thread pool, so that the slow Stats NZ downloads
+    for different areas happen concurrently.
+
+    Parameters
+    ----------
+    fetch_area : Callable[[AreaOfInterest], T]
+        The function that fetches the data for a single area of interest.
+    areas_of_interest : Sequence[AreaOfInterest] = AREAS_OF_INTEREST
+        The areas of interest to fetch data for.
+    max_workers : Optional[int] = None
+        The maximum number of areas to fetch concurrently. Defaults to the STATS_NZ_FETCH_WORKERS environment variable.
+        A value of 1 fetches each area sequentially.
+
+    Returns
+    -------
+    List[T]
+        The results of fetch_area, in the same order as areas_of_interest regardless of which fetch finished first.
+    """
+    if max_workers is None:
+        max_workers = Env.STATS_NZ_FETCH_WORKERS
+    if max_workers < 1:
+        raise ValueError(f"max_workers must be at least 1, got {max_workers}")
+    if max_workers == 1:
+        return [fetch_area(aoi) for aoi in areas_of_interest]
+    log.info(f"Fetching {len(areas_of_interest)} areas of interest using {max_workers} workers")
+    with ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="stats_nz_fetch") as executor:
+        # executor.map yields results in submission order, keeping the concatenated output deterministic
+        return list(executor.map(fetch_area, areas_of_interest))
+
+
+# Predicates that a polygon can be required to have with an urban area, as named by GeoDataFrame.sjoin, mapped to the
+# same test with the urban area as the first argument, since shapely only uses a prepared geometry as the first argument
+URBAN_AREA_PREDICATES = {
+    "intersects": shapely.intersects,
+    "within": shapely.contains,
+    "covered_by": shapely.covers,
+    "overlaps": shapely.overlaps,
+    "touches": shapely.touches,
+    "crosses": shapely.crosses,
+}
+# Keeps polygons whose representative point is inside the urban area, so that polygons sharing only a sliver with the
+# urban area along its border are left out, and every polygon belongs to at most one urban area
+REPRESENTATIVE_POINT_WITHIN = "representative_point_within"
+
+
+class UrbanAreaFilter:
+    """
+    Filters polygons to those in an urban area of the Stats NZ urban/rural layer.
+    The urban/rural polygons are prepared and indexed with an STRtree once, so a single filter can be reused for
+    several layers and areas of interest. The prepared geometries are only queried under a lock, since GEOS builds
+    parts of a prepared geometry lazily and the filter is shared by the threads of fetch_for_areas_of_interest.
+
+    Parameters
+    ----------
+    urban_rural : gpd.GeoDataFrame
+        Urban/rural area polygons from Stats NZ layer 111198, or any part of it.
+    """
+
+    def __init__(self, urban_rural: gpd.GeoDataFrame):
+        self.crs = urban_rural.crs
+        self.area_names = urban_rural["UR2023_V1_00_NAME"].to_numpy()
+        self.geometries = urban_rural.geometry.to_numpy()
+        shapely.prepare(self.geometries)
+        self.tree = shapely.STRtree(self.geometries)
+        self._lock = threading.Lock()
+
+    def filter(self,
+               gdf_to_filter: gpd.GeoDataFrame,
+               area_name: str,
+               predicate: str = "intersects") -> gpd.GeoDataFrame:
+        """
+        Finds the polygons that are in an urban area, keeping their order.
+
+        Parameters
+        ----------
+        gdf_to_filter : gpd.GeoDataFrame
+            The polygons to filter, in the same CRS as the urban/rural layer.
+        area_name : str
+            The UR2023_V1_00_NAME of the urban area.
+        predicate : str = "intersects"
+            How a polygon must relate to the urban area to be kept. One of URBAN_AREA_PREDICATES, or
+            REPRESENTATIVE_POINT_WITHIN.
+
+        Returns
+        -------
+        gpd.GeoDataFrame
+            The polygons in the urban area, with the urban area name in UR2023_V1_00_NAME.
+
+        Raises
+        ------
+        ValueError
+            If the predicate is not supported, or the polygons are in a different CRS.
+        """
+        if predicate != REPRESENTATIVE_POINT_WITHIN and predicate not in URBAN_AREA_PREDICATES:
+            raise ValueError(f"Unsupported predicate {predicate}, "
+                             f"expected one of {[*URBAN_AREA_PREDICATES, REPRESENTATIVE_POINT_WITHIN]}")
+        if gdf_to_filter.crs != self.crs:
+            raise ValueError(f"Polygons are in {gdf_to_filter.crs}, but the urban/rural areas are in {self.crs}")
+        area_mask = self.area_names == area_name
+        in_area = np.zeros(len(gdf_to_filter), dtype=bool)
+        if area_mask.any() and len(gdf_to_filter):
+            geometries = gdf_to_filter.geometry.to_numpy()
+            # Cull the polygons outside the urban area's bounding box with cheap array comparisons
+            area_min_x, area_min_y, area_max_x, area_max_y = shapely.total_bounds(self.geometries[area_mask])
+            bounds = shapely.bounds(geometries)
+            candidates = np.flatnonzero((bounds[:, 0] <= area_max_x) & (bounds[:, 2] >= area_min_x)
+                                        & (bounds[:, 1] <= area_max_y) & (bounds[:, 3] >= area_min_y))
+            if predicate == REPRESENTATIVE_POINT_WITHIN:
+                candidate_geometries = shapely.point_on_surface(geometries[candidates])
+                area_predicate = shapely.contains
+            else:
+                candidate_geometries = geometries[candidates]
+                area_predicate = URBAN_AREA_PREDICATES[predicate]
+            # Pairs of candidates and urban/rural polygons whose bounding boxes overlap, kept for this urban area
+            with self._lock:
+                candidate_positions, area_positions = self.tree.query(candidate_geometries)
+                in_urban_area = area_mask[area_positions]
+                candidate_positions, area_positions = candidate_positions[in_urban_area], area_positions[in_urban_area]
+                matches = area_predicate(self.geometries[area_positions], candidate_geometries[candidate_positions])
+            in_area[candidates[candidate_positions[matches]]] = True
+        return gdf_to_filter.loc[in_area].assign(UR2023_V1_00_NAME=area_name)
+
+
+def fetch_urban_area_filter(vector_fetcher: VectorFetcher, area_names: Sequence[str]) -> UrbanAreaFilter:
+    """
+    Fetches the urban/rural layer once and builds a filter for the named urban areas, to share between every area of
+    interest instead of fetching the layer and building a filter for each.
+
+    Parameters
+    ----------
+    vector_fetcher : VectorFetcher
+        Fetches the urban/rural layer, in the same CRS as the polygons that will be filtered.
+    area_names : Sequence[str]
+        The UR2023_V1_00_NAME of each urban area polygons will be filtered to.
+
+    Returns
+    -------
+    UrbanAreaFilter
+        A filter over the polygons of the named urban areas.
+    """
+    urban_rural = vector_fetcher.run(111198)
+    return UrbanAreaFilter(urban_rural.loc[urban_rural["UR2023_V1_00_NAME"].isin(area_names)])
+
+
 def filter_gdf_by_urban_rural_area(gdf_to_filter: gpd.GeoDataFrame,
                                    area_name: str,
-                                   vector_fetcher: geoapis.vector.StatsNz,
-                                   predicate: str = "intersects"
-                                   ):
-    # Urban/Rural area polygons
-    urban_rural = vector_fetcher.run(111198)
-    # Find gdf polygons that are within the urban area Polygon
-    urban_area = urban_rural.loc[urban_rural['UR2023_V1_00_NAME'] == area_name]
-    gdf_join_urban_area = gdf_to_filter.sjoin(urban_area, how='inner', predicate=predicate)
-    # Filter gdf polygons for those values that exist in the spatial join above
-    # Keeps data more simple than using the spatial join
-    polygons_in_urban_area = gdf_to_filter.loc[gdf_to_filter.index.isin(gdf_join_urban_area.index)]
-    # Add urban area name
-    polygons_in_urban_area['UR2023_V1_00_NAME'] = gdf_join_urban_area["UR2023_V1_00_NAME"]
-    return polygons_in_urban_area
+                                   vector_fetcher: VectorFetcher,
+                                   predicate: Optional[str] = None,
+                                   urban_area_filter: Optional[UrbanAreaFilter] = None
+                                   ) -> gpd.GeoDataFrame:
+    """
+    Finds the polygons that are in an urban area.
+
+    Parameters
+    ----------
+    gdf_to_filter : gpd.GeoDataFrame
+        The polygons to filter.
+    area_name : str
+        The UR2023_V1_00_NAME of the urban area.
+    vector_fetcher : VectorFetcher
+        Fetches the urban/rural layer, if urban_area_filter is not given.
+    predicate : Optional[str] = None
+        How a polygon must relate to the urban area to be kept, as for UrbanAreaFilter.filter.
+        Defaults to the URBAN_AREA_PREDICATE environment variable.
+    urban_area_filter : Optional[UrbanAreaFilter] = None
+        A filter built from the urban/rural layer, to reuse instead of building one from vector_fetcher.
+
+    Returns
+    -------
+    gpd.GeoDataFrame
+        The polygons in the urban area, with the urban area name in UR2023_V1_00_NAME.
+    """
+    if predicate is None:
+        predicate = Env.URBAN_AREA_PREDICATE
+    if urban_area_filter is None:
+        # Urban/Rural area polygons
+        urban_area_filter = UrbanAreaFilter(vector_fetcher.run(111198))
+    return urban_area_filter.filter(gdf_to_filter, area_name, predicate)
@@ -0,0 +1,106 @@
+import logging
+from typing import Iterable, NamedTuple, Sequence
+
+import sqlalchemy
+
+from sql_quoting import quote_identifier
+
+log = logging.getLogger(__name__)
+
+
+class TableIndexes(NamedTuple):
+    """
+    The primary key and secondary indexes declared for a table created by the initialiser.
+
+    Attributes
+    ----------
+    primary_key : Sequence[str]
+        The columns that make up the primary key.
+    index_columns : Sequence[Sequence[str]] = ()
+        Column lists that are joined or filtered on, which each get a btree index.
+    geometry_columns : Sequence[str] = ()
+        Geometry columns, which each get a GiST index.
+    """
+    primary_key: Sequence[str]
+    index_columns: Sequence[Sequence[str]] = ()
+    geometry_columns: Sequence[str] = ()
+
+
+TABLE_INDEXES = {
+    "sa1s": TableIndexes(
+        primary_key=["SA12018_V1_00"],
+        index_columns=[["UR2023_V1_00_NAME"]],
+        geometry_columns=["geometry"],
+    ),
+    # Partitioned by fuel_type, so each partition holds a single fuel type and needs no index on it
+    "vehicle_stats": TableIndexes(primary_key=["SA12018_V1_00", "vehicle_class", "fuel_type"]),
+    "sa2s": TableIndexes(
+        primary_key=["SA22018_V1_00"],
+        index_columns=[["UR2023_V1_00_NAME"]],
+        geometry_columns=["geometry"],
+    ),
+    "mode_share": TableIndexes(
+        # The primary key also serves lookups by usual residence, so only workplace needs its own index
+        primary_key=["SA2_code_usual_residence_address", "SA2_code_workplace_address"],
+        index_columns=[["SA2_code_workplace_address"]],
+    ),
+    "flow_sheets": TableIndexes(primary_key=["urban_area"]),
+    "national_sa1s": TableIndexes(primary_key=["SA12018_V1_00"], geometry_columns=["geometry"]),
+    "national_sa2s": TableIndexes(primary_key=["SA22018_V1_00"], geometry_columns=["geometry"]),
+    "national_urban_rural": TableIndexes(
+        primary_key=["UR2023_V1_00"],
+        index_columns=[["UR2023_V1_00_NAME"]],
+        geometry_columns=["geometry"],
+    ),
+}
+
+
+def _has_index(inspector: sqlalchemy.engine.reflection.Inspector, table_name: str, columns: Sequence[str]) -> bool:
+    return any(index["column_names"] == list(columns) for index in inspector.get_indexes(table_name))
+
+
+def ensure_table_indexes(engine: sqlalchemy.engine.Engine, table_names: Iterable[str]) -> None:
+    """
+    Adds the declared primary key and indexes to each table if they are missing, then analyses the tables.
+    Existing keys and indexes, including those with other names on older databases, are left alone, so this is safe
+    to run on every start-up.
+
+    Parameters
+    ----------
+    engine : sqlalchemy.engine.Engine
+        The engine connected to the PostGIS database.
+    table_names : Iterable[str]
+        The tables to index. Each must be declared in TABLE_INDEXES.
+
+    Returns
+    -------
+    None
+        This function does not return anything.
+    """
+    with engine.begin() as connection:
+        inspector = sqlalchemy.inspect(connection)
+        for table_name in table_names:
+            if not inspector.has_table(table_name):
+                continue
+            table_indexes = TABLE_INDEXES[table_name]
+            quoted_table_name = quote_identifier(table_name)
+
+            if not inspector.get_pk_constraint(table_name)["constrained_columns"]:
+                log.info(f"Adding primary key to {table_name}")
+                primary_key_columns = ", ".join(quote_identifier(column) for column in table_indexes.primary_key)
+                connection.execute(sqlalchemy.text(
+                    f"ALTER TABLE {quoted_table_name} ADD PRIMARY KEY ({primary_key_columns})"))
+
+            for columns in table_indexes.index_columns:
+                if not _has_index(inspector, table_name, columns):
+                    log.info(f"Adding index on {table_name} {columns}")
+                    index_columns = ", ".join(quote_identifier(column) for column in columns)
+                    connection.execute(sqlalchemy.text(f"CREATE INDEX ON {quoted_table_name} ({index_columns})"))
+
+            for column in table_indexes.geometry_columns:
+                if not _has_index(inspector, table_name, [column]):
+                    log.info(f"Adding spatial index on {table_name} {column}")
+                    connection.execute(sqlalchemy.text(
+                        f"CREATE INDEX ON {quoted_table_name} USING GIST ({quote_identifier(column)})"))
+
+            connection.execute(sqlalchemy.text(f"ANALYZE {quoted_table_name}"))
@@ -0,0 +1,275 @@
+import logging
+import re
+from typing import Dict, List, NamedTuple, Optional, Sequence
+
+import numpy as np
+import pandas as pd
+import sqlalchemy
+from sqlalchemy.dialects import postgresql
+
+from emissions.fuel_types import FUEL_TYPES
+from sql_quoting import quote_identifier, quote_literal
+
+log = logging.getLogger(__name__)
+
+
+class SchemaValidationError(ValueError):
+    """Raised when the data built for a table does not fit the table's declared schema."""
+
+
+class ColumnSchema(NamedTuple):
+    """
+    The type of a column, both in memory and in the database.
+
+    Attributes
+    ----------
+    dtype : str
+        The pandas dtype, one of the numpy integer or float types, or "category".
+    sql_type : Optional[sqlalchemy.types.TypeEngine] = None
+        The database type. Enum columns use a type named after enum_name instead.
+    min_value : Optional[float] = None
+        The smallest valid value of a numeric column, in addition to the limits of its dtype.
+    enum_name : Optional[str] = None
+        For category columns, the name of the Postgres enum type the column is stored as.
+    categories : Optional[Sequence[str]] = None
+        For category columns, the allowed values. If None, any value is allowed and is added to the enum type when it
+        is first seen.
+    """
+    dtype: str
+    sql_type: Optional[sqlalchemy.types.TypeEngine] = None
+    min_value: Optional[float] = None
+    enum_name: Optional[str] = None
+    categories: Optional[Sequence[str]] = None
+
+
+# Commuter counts between two SA2s are at most an SA2's working population, and the census suppresses counts it cannot
+# release as -999, which are zeroed before loading
+COMMUTER_COUNT = ColumnSchema("int16", sqlalchemy.SmallInteger(), min_value=0)
+# SA1 codes are seven digits and SA2 codes six
+AREA_CODE = ColumnSchema("int32", sqlalchemy.Integer(), min_value=0)
+# VKT and CO2 are modelled estimates with far fewer significant figures than float32 keeps
+EMISSIONS_ESTIMATE = ColumnSchema("float32", sqlalchemy.REAL(), min_value=0)
+
+TABLE_SCHEMAS: Dict[str, Dict[str, ColumnSchema]] = {
+    "vehicle_stats": {
+        "SA12018_V1_00": AREA_CODE,
+        "vehicle_class": ColumnSchema("category", enum_name="vehicle_class_enum"),
+        "fuel_type": ColumnSchema("category", enum_name="fuel_type_enum", categories=FUEL_TYPES),
+        "VKT ('000 km/Year)": EMISSIONS_ESTIMATE,
+        "CO2 (Tonnes/Year)": EMISSIONS_ESTIMATE,
+    },
+    "mode_share": {
+        "SA2_code_usual_residence_address": AREA_CODE,
+        "SA2_code_workplace_address": AREA_CODE,
+        "Work_at_home": COMMUTER_COUNT,
+        "Drive_a_private_car_truck_or_van": COMMUTER_COUNT,
+        "Drive_a_company_car_truck_or_van": COMMUTER_COUNT,
+        "Passenger_in_a_car_truck_van_or_company_bus": COMMUTER_COUNT,
+        "Public_bus": COMMUTER_COUNT,
+        "Train": COMMUTER_COUNT,
+        "Bicycle": COMMUTER_COUNT,
+        "Walk_or_jog": COMMUTER_COUNT,
+        "Ferry": COMMUTER_COUNT,
+        "Other": COMMUTER_COUNT,
+        "Total": COMMUTER_COUNT,
+    },
+}
+
+
+class ListPartitions(NamedTuple):
+    """
+    A table split into one partition per value of a column, so that queries filtering the column by equality, such as
+    the GeoServer views of a single fuel type, only scan the matching partition.
+
+    Attributes
+    ----------
+    column : str
+        The column the table is partitioned by. It must be part of the table's primary key.
+    values : Sequence[str]
+        The values of the column, each of which gets a partition. Rows with other values cannot be loaded.
+    """
+    column: str
+    values: Sequence[str]
+
+    def partition_name(self, table_name: str, value: str) -> str:
+        # e.g. vehicle_stats_plugin_hybrid
+        suffix = re.sub(r"\W+", "_", value).lower()
+        return f"{table_name}_{suffix}"
+
+
+TABLE_PARTITIONS: Dict[str, ListPartitions] = {
+    "vehicle_stats": ListPartitions("fuel_type", FUEL_TYPES),
+}
+
+
+def describe_schema(table_name: str) -> Dict[str, str]:
+    """
+    Describes a table's declared schema and partitioning, so it can be included in the inputs the table is
+    fingerprinted by and a change of type or partitioning rebuilds the table.
+
+    Parameters
+    ----------
+    table_name : str
+        The table to describe.
+
+    Returns
+    -------
+    Dict[str, str]
+        The type of each column, and the partitioning under "PARTITION BY" if the table is partitioned. Empty if the
+        table has neither.
+    """
+    description = {column: repr(column_schema) for column, column_schema in TABLE_SCHEMAS.get(table_name, {}).items()}
+    if table_name in TABLE_PARTITIONS:
+        description["PARTITION BY"] = repr(TABLE_PARTITIONS[table_name])
+    return description
+
+
+def get_sql_types(table_name: str) -> Dict[str, sqlalchemy.types.TypeEngine]:
+    """
+    Finds the database types of a table's columns, to create the table with.
+
+    Parameters
+    ----------
+    table_name : str
+        The table to find the types of.
+
+    Returns
+    -------
+    Dict[str, sqlalchemy.types.TypeEngine]
+        The type of each declared column. Empty if the table has no declared schema.
+    """
+    return {
+        column: postgresql.ENUM(name=column_schema.enum_name, create_type=False)
+        if column_schema.enum_name is not None else column_schema.sql_type
+        for column, column_schema in TABLE_SCHEMAS.get(table_name, {}).items()
+    }
+
+
+def _find_column_problems(values: pd.Series, column: str, column_schema: ColumnSchema) -> List[str]:
+    problems = []
+    num_missing = int(values.isna().sum())
+    if num_missing:
+        problems.append(f"{column} has {num_missing} missing values")
+    values = values.dropna()
+    if values.empty:
+        return problems
+
+    if column_schema.dtype == "category":
+        if column_schema.categories is not None:
+            unknown_values = set(values.unique()) - set(column_schema.categories)
+            if unknown_values:
+                problems.append(f"{column} has values {sorted(unknown_values)} outside {list(column_schema.categories)}")
+        return problems
+
+    if not pd.api.types.is_numeric_dtype(values):
+        return problems + [f"{column} is {values.dtype}, not numeric"]
+    dtype = np.dtype(column_schema.dtype)
+    type_info = np.iinfo(dtype) if dtype.kind in "iu" else np.finfo(dtype)
+    min_value = type_info.min if column_schema.min_value is None else max(type_info.min, column_schema.min_value)
+    values_min, values_max = values.min(), values.max()
+    if values_min < min_value or values_max > type_info.max:
+        problems.append(f"{column} ranges from {values_min} to {values_max}, outside {min_value} to {type_info.max}")
+    if dtype.kind in "iu" and pd.api.types.is_float_dtype(values) and not (values == values.round()).all():
+        problems.append(f"{column} has fractional values, but is declared {column_schema.dtype}")
+    if dtype.kind == "f" and not np.isfinite(values.to_numpy(dtype="float64")).all():
+        problems.append(f"{column} has infinite values")
+    return problems
+
+
+def conform_to_schema(frame: pd.DataFrame, table_name: str) -> pd.DataFrame:
+    """
+    Checks that the data built for a table fits the table's declared schema, then casts it to the declared dtypes.
+    Index levels are checked and cast like columns, although pandas keeps integer index levels as int64 in memory.
+    Tables without a declared schema are returned unchanged.
+
+    Parameters
+    ----------
+    frame : pd.DataFrame
+        The data to load into the table.
+    table_name : str
+        The table the data is for.
+
+    Returns
+    -------
+    pd.DataFrame
+        The data with the declared dtypes, and the same index levels and column order.
+
+    Raises
+    ------
+    SchemaValidationError
+        If the data has missing or undeclared columns, missing values, or values outside the declared types.
+    """
+    schema = TABLE_SCHEMAS.get(table_name)
+    if schema is None:
+        return frame
+    index_names = [name for name in frame.index.names if name is not None]
+    flat_frame = frame.reset_index() if index_names else frame
+
+    problems = []
+    missing_columns = [column for column in schema if column not in flat_frame.columns]
+    undeclared_columns = [column for column in flat_frame.columns if column not in schema]
+    if missing_columns:
+        problems.append(f"missing columns {missing_columns}")
+    if undeclared_columns:
+        problems.append(f"undeclared columns {undeclared_columns}")
+    for column, column_schema in schema.items():
+        if column in flat_frame.columns:
+            problems.extend(_find_column_problems(flat_frame[column], column, column_schema))
+    if problems:
+        raise SchemaValidationError(f"Data for {table_name} does not match its schema: {'; '.join(problems)}")
+
+    flat_frame = flat_frame.astype({
+        column: pd.CategoricalDtype(column_schema.categories)
+        if column_schema.dtype == "category" and column_schema.categories is not None else column_schema.dtype
+        for column, column_schema in schema.items()
+    })
+    return flat_frame.set_index(index_names) if index_names else flat_frame
+
+
+def create_enum_types(engine: sqlalchemy.engine.Engine, table_name: str, frame: pd.DataFrame) -> None:
+    """
+    Creates the enum types of a table's category columns if they do not exist, and adds any values in the data that
+    they are missing. Runs in its own transaction, since Postgres does not allow new enum values to be used in the
+    transaction that adds them.
+
+    Parameters
+    ----------
+    engine : sqlalchemy.engine.Engine
+        The engine connected to the PostGIS database.
+    table_name : str
+        The table the data is for.
+    frame : pd.DataFrame
+        The data to load into the table, as returned by conform_to_schema.
+
+    Returns
+    -------
+    None
+        This function does not return anything.
+    """
+    enum_columns = {column: column_schema for column, column_schema in TABLE_SCHEMAS.get(table_name, {}).items()
+                    if column_schema.enum_name is not None}
+    if not enum_columns:
+        return
+    flat_frame = frame.reset_index()
+    with engine.begin() as connection:
+        for column, column_schema in enum_columns.items():
+            values = flat_frame[column].astype("category").cat.categories
+            labels = list(column_schema.categories or []) + sorted(set(values) - set(column_schema.categories or []))
+            existing_labels = connection.execute(sqlalchemy.text("""
+                SELECT enumlabel
+                FROM pg_enum
+                    JOIN pg_type ON pg_type.oid = pg_enum.enumtypid
+                WHERE typname = :enum_name
+            """), {"enum_name": column_schema.enum_name}).scalars().all()
+            if not existing_labels:
+                log.info(f"Creating enum type {column_schema.enum_name} with {labels}")
+                connection.execute(sqlalchemy.text(
+                    f"CREATE TYPE {quote_identifier(column_schema.enum_name)} "
+                    f"AS ENUM ({', '.join(quote_literal(label) for label in labels)})"))
+                continue
+            for label in labels:
+                if label not in existing_labels:
+                    log.info(f"Adding {label} to enum type {column_schema.enum_name}")
+                    connection.execute(sqlalchemy.text(
+                        f"ALTER TYPE {quote_identifier(column_schema.enum_name)} "
+                        f"ADD VALUE IF NOT EXISTS {quote_literal(label)}"))
@@ -0,0 +1,23 @@
+from typing import Any, Callable, Dict, Iterator
+
+import pytest
+
+from config import EnvVariable
+
+
+@pytest.fixture
+def override_settings() -> Iterator[Callable[..., None]]:
+    """
+    Overrides settings of config.EnvVariable for a test, restoring them afterwards.
+    The originals are saved from the class dict rather than with monkeypatch, whose getattr would read the environment.
+    """
+    originals: Dict[str, Any] = {}
+
+    def override(**settings: Any) -> None:
+        for name, value in settings.items():
+            originals.setdefault(name, vars(EnvVariable)[name])
+            setattr(EnvVariable, name, value)
+
+    yield override
+    for name, value in originals.items():
+        setattr(EnvVariable, name, value)
@@ -0,0 +1,181 @@
+import asyncio
+import re
+from typing import Dict, List, Set, Tuple
+
+import pytest
+import requests
+from aiohttp import web
+from aiohttp.test_utils import TestServer
+
+from geoserver_async import AsyncGeoServerClient, gather_or_cancel
+from geoserver_common import FeatureTypeDefinition, GeoServerRequestError
+
+REST_PATH = "/geoserver/rest"
+WORKSPACE = "workspace"
+DATA_STORE = "data_store"
+
+
+class StubGeoServer:
+    """
+    An in-memory GeoServer REST API serving the requests AsyncGeoServerClient sends, which records every request and
+    the largest number of requests handled at once.
+    """
+
+    def __init__(self, failing_layers: Set[str] = frozenset(), delay: float = 0.01):
+        self.workspaces: Set[str] = set()
+        self.data_stores: Dict[str, Set[str]] = {}
+        self.feature_types: Dict[Tuple[str, str], Set[str]] = {}
+        self.failing_layers = failing_layers
+        self.delay = delay
+        self.requests: List[Tuple[str, str]] = []
+        self.in_flight = 0
+        self.max_in_flight = 0
+
+    def create_app(self) -> web.Application:
+        app = web.Application(middlewares=[self.track_requests])
+        app.router.add_get(f"{REST_PATH}/workspaces.json", self.list_workspaces)
+        app.router.add_post(f"{REST_PATH}/workspaces", self.create_workspace)
+        app.router.add_get(f"{REST_PATH}/workspaces/{{workspace}}/datastores.json", self.list_data_stores)
+        app.router.add_post(f"{REST_PATH}/workspaces/{{workspace}}/datastores", self.create_data_store)
+        feature_types_path = f"{REST_PATH}/workspaces/{{workspace}}/datastores/{{data_store}}/featuretypes"
+        app.router.add_get(f"{feature_types_path}.json", self.list_feature_types)
+        app.router.add_post(feature_types_path, self.create_feature_type)
+        app.router.add_put(f"{feature_types_path}/{{name}}", self.update_feature_type)
+        return app
+
+    @web.middleware
+    async def track_requests(self, request: web.Request, handler) -> web.StreamResponse:
+        self.requests.append((request.method, request.path[len(REST_PATH) + 1:]))
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        try:
+            # Holds each request open, so that concurrent requests overlap
+            await asyncio.sleep(self.delay)
+            return await handler(request)
+        finally:
+            self.in_flight -= 1
+
+    @staticmethod
+    def listing(collection_key: str, item_key: str, names: Set[str]) -> web.Response:
+        # GeoServer lists an empty collection as an empty string
+        items = {item_key: [{"name": name} for name in sorted(names)]} if names else ""
+        return web.json_response({collection_key: items})
+
+    async def list_workspaces(self, request: web.Request) -> web.Response:
+        return self.listing("workspaces", "workspace", self.workspaces)
+
+    async def create_workspace(self, request: web.Request) -> web.Response:
+        self.workspaces.add((await request.json())["workspace"]["name"])
+        return web.Response(status=201)
+
+    async def list_data_stores(self, request: web.Request) -> web.Response:
+        return self.listing("dataStores", "dataStore", self.data_stores.get(request.match_info["workspace"], set()))
+
+    async def create_data_store(self, request: web.Request) -> web.Response:
+        name = re.search(r"<name>(.*?)</name>", await request.text()).group(1)
+        self.data_stores.setdefault(request.match_info["workspace"], set()).add(name)
+        return web.Response(status=201)
+
+    async def list_feature_types(self, request: web.Request) -> web.Response:
+        key = (request.match_info["workspace"], request.match_info["data_store"])
+        return self.listing("featureTypes", "featureType", self.feature_types.get(key, set()))
+
+    async def create_feature_type(self, request: web.Request) -> web.Response:
+        name = re.search(r"<name>(.*?)</name>", await request.text()).group(1)
+        if name in self.failing_layers:
+            return web.Response(status=500, text=f"Could not create {name}")
+        key = (request.match_info["workspace"], request.match_info["data_store"])
+        self.feature_types.setdefault(key, set()).add(name)
+        return web.Response(status=201)
+
+    async def update_feature_type(self, request: web.Request) -> web.Response:
+        return web.Response(status=200)
+
+
+async def provision(stub: StubGeoServer, feature_types: List[FeatureTypeDefinition], concurrency: int) -> List[str]:
+    async with TestServer(stub.create_app()) as server:
+        async with AsyncGeoServerClient(str(server.make_url(REST_PATH)), ("admin", "password"), concurrency) as client:
+            return await client.provision(WORKSPACE, "db", DATA_STORE, feature_types)
+
+
+@pytest.fixture(autouse=True)
+def postgres_settings(override_settings):
+    # Written into the data store XML
+    override_settings(POSTGRES_USER="user", POSTGRES_PASSWORD="password")
+
+
+def test_provision_creates_workspace_then_data_store_then_layers():
+    stub = StubGeoServer()
+    layer_names = [f"layer_{i}" for i in range(6)]
+
+    created = asyncio.run(provision(stub, [FeatureTypeDefinition(name) for name in layer_names], concurrency=2))
+
+    assert created == layer_names
+    assert stub.feature_types[(WORKSPACE, DATA_STORE)] == set(layer_names)
+    workspace_position = stub.requests.index(("POST", "workspaces"))
+    data_store_position = stub.requests.index(("POST", f"workspaces/{WORKSPACE}/datastores"))
+    layer_positions = [position for position, request in enumerate(stub.requests)
+                       if request == ("POST", f"workspaces/{WORKSPACE}/datastores/{DATA_STORE}/featuretypes")]
+    assert len(layer_positions) == len(layer_names)
+    assert workspace_position < data_store_position < min(layer_positions)
+    # A new data store has no layers to list
+    assert ("GET", f"workspaces/{WORKSPACE}/datastores/{DATA_STORE}/featuretypes.json") not in stub.requests
+
+
+@pytest.mark.parametrize("concurrency", [1, 3])
+def test_provision_keeps_requests_in_flight_within_concurrency(concurrency):
+    stub = StubGeoServer()
+
+    asyncio.run(provision(stub, [FeatureTypeDefinition(f"layer_{i}") for i in range(10)], concurrency))
+
+    assert stub.max_in_flight == concurrency
+
+
+def test_provision_updates_existing_layers_with_update_existing():
+    stub = StubGeoServer()
+    stub.workspaces.add(WORKSPACE)
+    stub.data_stores[WORKSPACE] = {DATA_STORE}
+    stub.feature_types[(WORKSPACE, DATA_STORE)] = {"kept", "updated"}
+    feature_types = [FeatureTypeDefinition("kept"), FeatureTypeDefinition("updated", update_existing=True),
+                     FeatureTypeDefinition("new")]
+
+    created = asyncio.run(provision(stub, feature_types, concurrency=2))
+
+    assert created == ["new"]
+    feature_types_path = f"workspaces/{WORKSPACE}/datastores/{DATA_STORE}/featuretypes"
+    assert [request for request in stub.requests if request[0] in {"POST", "PUT"}] == [
+        ("POST", feature_types_path), ("PUT", f"{feature_types_path}/updated")]
+
+
+def test_failed_request_raises_geoserver_request_error():
+    stub = StubGeoServer(failing_layers={"layer_2"})
+
+    with pytest.raises(GeoServerRequestError) as error_info:
+        asyncio.run(provision(stub, [FeatureTypeDefinition(f"layer_{i}") for i in range(5)], concurrency=5))
+
+    # The same error type the sync client raises
+    assert isinstance(error_info.value, requests.HTTPError)
+    assert error_info.value.status == 500
+
+
+def test_gather_or_cancel_cancels_the_other_tasks_before_raising():
+    cancelled = []
+
+    async def slow_request():
+        try:
+            await asyncio.sleep(10)
+        except asyncio.CancelledError:
+            cancelled.append(True)
+            raise
+
+    async def failing_request():
+        await asyncio.sleep(0)
+        raise GeoServerRequestError("POST", "featuretypes", 500, "error")
+
+    async def run():
+        with pytest.raises(GeoServerRequestError):
+            await gather_or_cancel(slow_request(), failing_request(), slow_request())
+        # Cancelled before gather_or_cancel raised, rather than left running
+        return list(cancelled)
+
+    assert asyncio.run(run()) == [True, True]
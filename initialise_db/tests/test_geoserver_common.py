@@ -0,0 +1,175 @@
+import json
+import re
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, Iterator, List, Set, Tuple
+
+import pytest
+import requests
+
+from geoserver_common import FeatureTypeDefinition, GeoServerClient, GeoServerRequestError
+
+REST_PATH = "/geoserver/rest"
+WORKSPACE = "workspace"
+DATA_STORE = "data_store"
+FEATURE_TYPES_PATH = f"workspaces/{WORKSPACE}/datastores/{DATA_STORE}/featuretypes"
+
+
+class StubGeoServer(ThreadingHTTPServer):
+    """
+    An in-memory GeoServer REST API on localhost, serving the requests GeoServerClient sends. It records every request
+    and the client address it came from, to tell whether connections were reused.
+    """
+
+    def __init__(self):
+        super().__init__(("127.0.0.1", 0), StubGeoServerHandler)
+        self.workspaces: Set[str] = set()
+        self.data_stores: Dict[str, Set[str]] = {}
+        self.feature_types: Dict[Tuple[str, str], Set[str]] = {}
+        self.failing_layers: Set[str] = set()
+        self.requests: List[Tuple[str, str]] = []
+        self.client_addresses: Set[Tuple[str, int]] = set()
+
+    @property
+    def base_url(self) -> str:
+        return f"http://127.0.0.1:{self.server_port}{REST_PATH}"
+
+
+class StubGeoServerHandler(BaseHTTPRequestHandler):
+    # Keeps connections open between requests, as GeoServer does
+    protocol_version = "HTTP/1.1"
+    server: StubGeoServer
+
+    def log_message(self, format, *args) -> None:
+        pass
+
+    def respond(self, status: int, body: object = None) -> None:
+        data = b"" if body is None else json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Length", str(len(data)))
+        if body is not None:
+            self.send_header("Content-Type", "application/json")
+        self.end_headers()
+        self.wfile.write(data)
+
+    def record_request(self) -> Tuple[List[str], str]:
+        path = self.path.split("?")[0][len(REST_PATH) + 1:]
+        self.server.requests.append((self.command, path))
+        self.server.client_addresses.add(self.client_address)
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0))).decode()
+        return path.split("/"), body
+
+    def respond_with_listing(self, collection_key: str, item_key: str, names: Set[str]) -> None:
+        # GeoServer lists an empty collection as an empty string
+        items = {item_key: [{"name": name} for name in sorted(names)]} if names else ""
+        self.respond(200, {collection_key: items})
+
+    def do_GET(self) -> None:
+        parts, _ = self.record_request()
+        if parts == ["workspaces.json"]:
+            self.respond_with_listing("workspaces", "workspace", self.server.workspaces)
+        elif len(parts) == 3 and parts[2] == "datastores.json":
+            self.respond_with_listing("dataStores", "dataStore", self.server.data_stores.get(parts[1], set()))
+        elif len(parts) == 5 and parts[4] == "featuretypes.json":
+            self.respond_with_listing("featureTypes", "featureType",
+                                      self.server.feature_types.get((parts[1], parts[3]), set()))
+        else:
+            self.respond(404)
+
+    def do_POST(self) -> None:
+        parts, body = self.record_request()
+        if parts == ["workspaces"]:
+            self.server.workspaces.add(json.loads(body)["workspace"]["name"])
+            self.respond(201)
+        elif len(parts) == 3 and parts[2] == "datastores":
+            self.server.data_stores.setdefault(parts[1], set()).add(re.search(r"<name>(.*?)</name>", body).group(1))
+            self.respond(201)
+        elif len(parts) == 5 and parts[4] == "featuretypes":
+            name = re.search(r"<name>(.*?)</name>", body).group(1)
+            if name in self.server.failing_layers:
+                self.respond(500)
+                return
+            self.server.feature_types.setdefault((parts[1], parts[3]), set()).add(name)
+            self.respond(201)
+        else:
+            self.respond(404)
+
+    def do_PUT(self) -> None:
+        parts, _ = self.record_request()
+        self.respond(200 if len(parts) == 6 and parts[4] == "featuretypes" else 404)
+
+
+@pytest.fixture
+def stub() -> Iterator[StubGeoServer]:
+    server = StubGeoServer()
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    try:
+        yield server
+    finally:
+        server.shutdown()
+        server.server_close()
+        thread.join()
+
+
+@pytest.fixture
+def existing_layers(stub) -> StubGeoServer:
+    stub.workspaces.add(WORKSPACE)
+    stub.data_stores[WORKSPACE] = {DATA_STORE}
+    stub.feature_types[(WORKSPACE, DATA_STORE)] = {"kept", "updated"}
+    return stub
+
+
+def provision(stub: StubGeoServer, *feature_type_lists: List[FeatureTypeDefinition]) -> List[List[str]]:
+    # Provisions each list of layers in turn with the same client
+    with GeoServerClient(stub.base_url, ("admin", "password")) as client:
+        return [client.provision(WORKSPACE, "db", DATA_STORE, feature_types) for feature_types in feature_type_lists]
+
+
+def test_provision_lists_each_inventory_once(existing_layers):
+    emissions_layers = [FeatureTypeDefinition("kept"), FeatureTypeDefinition("emissions_a"),
+                        FeatureTypeDefinition("emissions_b")]
+    mode_share_layers = [FeatureTypeDefinition("mode_share_a"), FeatureTypeDefinition("mode_share_b")]
+
+    provision(existing_layers, emissions_layers, mode_share_layers)
+
+    listings = [request for request in existing_layers.requests if request[0] == "GET"]
+    assert sorted(listings) == sorted([
+        ("GET", "workspaces.json"),
+        ("GET", f"workspaces/{WORKSPACE}/datastores.json"),
+        ("GET", f"{FEATURE_TYPES_PATH}.json"),
+    ])
+
+
+def test_provision_only_posts_missing_layers_and_puts_updated_layers(existing_layers):
+    feature_types = [FeatureTypeDefinition("kept"), FeatureTypeDefinition("updated", update_existing=True),
+                     FeatureTypeDefinition("new")]
+
+    [created] = provision(existing_layers, feature_types)
+
+    assert created == ["new"]
+    assert existing_layers.feature_types[(WORKSPACE, DATA_STORE)] == {"kept", "updated", "new"}
+    assert [request for request in existing_layers.requests if request[0] in {"POST", "PUT"}] == [
+        ("POST", FEATURE_TYPES_PATH), ("PUT", f"{FEATURE_TYPES_PATH}/updated")]
+
+
+def test_provision_reuses_one_session(stub, override_settings):
+    override_settings(POSTGRES_USER="user", POSTGRES_PASSWORD="password")
+
+    [created] = provision(stub, [FeatureTypeDefinition(f"layer_{i}") for i in range(5)])
+
+    assert created == [f"layer_{i}" for i in range(5)]
+    assert stub.workspaces == {WORKSPACE} and stub.data_stores == {WORKSPACE: {DATA_STORE}}
+    # Every request was sent over the same keep-alive connection
+    assert len(stub.requests) == 9
+    assert len(stub.client_addresses) == 1
+
+
+def test_failed_request_raises_geoserver_request_error(existing_layers):
+    existing_layers.failing_layers.add("broken")
+
+    with pytest.raises(GeoServerRequestError) as error_info:
+        provision(existing_layers, [FeatureTypeDefinition("broken")])
+
+    assert isinstance(error_info.value, requests.HTTPError)
+    assert error_info.value.status == 500
@@ -0,0 +1,203 @@
+import json
+from typing import List, Optional
+
+import gspread
+import pandas as pd
+import pytest
+import requests
+
+from mode_share.gsheet_upload import TokenBucket, call_with_backoff, upload_spreadsheet
+
+
+class FakeClock:
+    """A clock and sleep for TokenBucket that record each sleep, and optionally advance the time by it."""
+
+    def __init__(self, advance_on_sleep: bool = True):
+        self.now = 0.0
+        self.advance_on_sleep = advance_on_sleep
+        self.sleeps: List[float] = []
+
+    def __call__(self) -> float:
+        return self.now
+
+    def sleep(self, seconds: float) -> None:
+        self.sleeps.append(seconds)
+        if self.advance_on_sleep:
+            self.now += seconds
+
+
+def make_api_error(status: int, retry_after: Optional[str] = None) -> gspread.exceptions.APIError:
+    response = requests.Response()
+    response.status_code = status
+    response._content = json.dumps({"error": {"code": status, "message": "error"}}).encode()
+    if retry_after is not None:
+        response.headers["Retry-After"] = retry_after
+    return gspread.exceptions.APIError(response)
+
+
+class FailingRequest:
+    """Raises the given errors on successive calls, then returns "done"."""
+
+    def __init__(self, *errors: Exception):
+        self.errors = list(errors)
+        self.calls = 0
+
+    def __call__(self) -> str:
+        self.calls += 1
+        if self.errors:
+            raise self.errors.pop(0)
+        return "done"
+
+
+def test_token_bucket_allows_a_burst_then_limits_the_rate():
+    clock = FakeClock()
+    # One request per second, with bursts of up to three
+    bucket = TokenBucket(60, capacity=3, clock=clock, sleep=clock.sleep)
+
+    for _ in range(5):
+        bucket.acquire()
+
+    assert clock.sleeps == [pytest.approx(1), pytest.approx(1)]
+
+
+def test_token_bucket_queues_callers_that_reserve_at_the_same_time():
+    # The time does not advance, as when several threads reserve a token at once
+    clock = FakeClock(advance_on_sleep=False)
+    bucket = TokenBucket(60, capacity=1, clock=clock, sleep=clock.sleep)
+
+    for _ in range(4):
+        bucket.acquire()
+
+    # Each caller goes into debt behind the one before it
+    assert clock.sleeps == [pytest.approx(1), pytest.approx(2), pytest.approx(3)]
+
+
+def test_token_bucket_pause_holds_back_every_caller():
+    clock = FakeClock(advance_on_sleep=False)
+    bucket = TokenBucket(60, capacity=3, clock=clock, sleep=clock.sleep)
+
+    bucket.pause(10)
+    bucket.acquire()
+    bucket.acquire()
+
+    assert len(clock.sleeps) == 2
+    assert all(seconds >= 10 for seconds in clock.sleeps)
+
+
+def test_token_bucket_pause_empties_the_bucket():
+    clock = FakeClock()
+    # One request every ten seconds, with bursts of up to three
+    bucket = TokenBucket(6, capacity=3, clock=clock, sleep=clock.sleep)
+
+    bucket.pause(1)
+    clock.now = 1
+    bucket.acquire()
+
+    # The burst was used up by the pause, so the request waits for the rest of a new token
+    assert clock.sleeps == [pytest.approx(9)]
+
+
+def test_call_with_backoff_waits_at_least_retry_after():
+    clock = FakeClock()
+    bucket = TokenBucket(6000, clock=clock, sleep=clock.sleep)
+    request = FailingRequest(make_api_error(429, retry_after="30"))
+
+    assert call_with_backoff(bucket, request, base_delay=1) == "done"
+
+    assert request.calls == 2
+    assert sum(clock.sleeps) >= 30
+
+
+def test_call_with_backoff_raises_non_retryable_errors_immediately():
+    clock = FakeClock()
+    bucket = TokenBucket(6000, clock=clock, sleep=clock.sleep)
+    request = FailingRequest(make_api_error(403))
+
+    with pytest.raises(gspread.exceptions.APIError) as error_info:
+        call_with_backoff(bucket, request)
+
+    assert error_info.value.response.status_code == 403
+    assert request.calls == 1
+    assert clock.sleeps == []
+
+
+def test_call_with_backoff_raises_the_error_of_the_last_attempt():
+    clock = FakeClock()
+    bucket = TokenBucket(6000, clock=clock, sleep=clock.sleep)
+    errors = [make_api_error(503) for _ in range(3)]
+    request = FailingRequest(*errors)
+
+    with pytest.raises(gspread.exceptions.APIError) as error_info:
+        call_with_backoff(bucket, request, max_attempts=3)
+
+    assert error_info.value is errors[-1]
+    assert request.calls == 3
+
+
+class FakeSpreadsheet:
+    def __init__(self, calls: List[str], num_sheets: int):
+        self.calls = calls
+        self.sheets = [{"properties": {"sheetId": sheet_id, "index": index, "title": f"Old {index}"}}
+                       for index, sheet_id in enumerate(range(10, 10 + num_sheets))]
+        self.batch_update_body = None
+        self.values_batch_update_body = None
+
+    def fetch_sheet_metadata(self) -> dict:
+        self.calls.append("fetch_sheet_metadata")
+        return {"sheets": self.sheets}
+
+    def batch_update(self, body: dict) -> dict:
+        self.calls.append("batch_update")
+        self.batch_update_body = body
+        return {}
+
+    def values_batch_update(self, body: dict) -> dict:
+        self.calls.append("values_batch_update")
+        self.values_batch_update_body = body
+        return {}
+
+
+class FakeClient:
+    """A gspread client holding at most one spreadsheet, recording the API calls made through it."""
+
+    def __init__(self, num_existing_sheets: Optional[int]):
+        self.calls: List[str] = []
+        self.spreadsheet = None if num_existing_sheets is None else FakeSpreadsheet(self.calls, num_existing_sheets)
+
+    def openall(self, title: str) -> List[FakeSpreadsheet]:
+        self.calls.append("openall")
+        return [] if self.spreadsheet is None else [self.spreadsheet]
+
+    def create(self, title: str) -> FakeSpreadsheet:
+        self.calls.append("create")
+        self.spreadsheet = FakeSpreadsheet(self.calls, 1)
+        return self.spreadsheet
+
+
+def make_sheets(num_sheets: int) -> dict:
+    return {f"Sheet {i}": pd.DataFrame({"SA2": [i, i + 1], "Count": [3, 4]}) for i in range(num_sheets)}
+
+
+@pytest.mark.parametrize("num_sheets", [1, 5, 50])
+def test_upload_spreadsheet_makes_the_same_calls_for_any_number_of_sheets(num_sheets):
+    clock = FakeClock()
+    client = FakeClient(num_existing_sheets=3)
+
+    upload_spreadsheet(client, TokenBucket(6000, clock=clock, sleep=clock.sleep), "Mode share", make_sheets(num_sheets))
+
+    assert client.calls == ["openall", "fetch_sheet_metadata", "batch_update", "values_batch_update"]
+    requests_by_kind = [next(iter(request)) for request in client.spreadsheet.batch_update_body["requests"]]
+    # The first old sheet is reused for the first new sheet and the others are deleted
+    assert requests_by_kind.count("deleteSheet") == 2
+    assert requests_by_kind.count("addSheet") == num_sheets - 1
+    assert [value_range["range"] for value_range in client.spreadsheet.values_batch_update_body["data"]] == [
+        f"'Sheet {i}'!A1" for i in range(num_sheets)]
+
+
+def test_upload_spreadsheet_creates_a_missing_spreadsheet():
+    clock = FakeClock()
+    client = FakeClient(num_existing_sheets=None)
+
+    upload_spreadsheet(client, TokenBucket(6000, clock=clock, sleep=clock.sleep), "Mode share", make_sheets(2))
+
+    assert client.calls == ["openall", "create", "fetch_sheet_metadata", "batch_update", "values_batch_update"]
@@ -0,0 +1,64 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from emissions.initialise_co2_sa1s import get_long_format_sa1_emissions
+
+VEHICLE_TYPES = ["Light Passenger Vehicle Petrol", "Light Passenger Vehicle Hybrid", "Motorcycle"]
+VARIABLES = ["VKT\n('000 km/Year)", "CO2\n(Tonnes/Year)"]
+
+
+def get_long_format_sa1_emissions_with_melt(emissions_data: pd.DataFrame) -> pd.DataFrame:
+    """The implementation get_long_format_sa1_emissions replaced, kept as the reference its output is checked against."""
+    vehicle_types, variables = (level.values.tolist() for level in emissions_data.columns.levels)
+    melts = []
+    for var in variables:
+        if var.startswith("Unnamed"):
+            break
+        melt = emissions_data.melt(ignore_index=False, var_name="Vehicle Type", value_name=var,
+                                   value_vars=[(vehicle_type, var) for vehicle_type in vehicle_types])
+        melt.set_index('Vehicle Type', append=True, inplace=True)
+        melts.append(melt)
+    merged = pd.merge(melts[0], melts[1], left_index=True, right_index=True)
+    return merged.rename(columns=lambda name: name.replace("\n", " "))
+
+
+@pytest.fixture
+def emissions_data() -> pd.DataFrame:
+    """A small emissions sheet with its two-level header, an SA1 with no data and a missing value."""
+    sa1s = pd.Index([7001130, 7000012, 7001125, 7000999], name="SA12018_V1_00")
+    columns = pd.MultiIndex.from_product([VEHICLE_TYPES, VARIABLES])
+    rng = np.random.default_rng(0)
+    data = pd.DataFrame(rng.uniform(0, 100, (len(sa1s), len(columns))), index=sa1s, columns=columns)
+    data.loc[7001125] = np.nan
+    data.loc[7000012, ("Motorcycle", VARIABLES[1])] = np.nan
+    return data
+
+
+def test_long_format_matches_melt_implementation(emissions_data):
+    expected = get_long_format_sa1_emissions_with_melt(emissions_data)
+
+    long_emissions = get_long_format_sa1_emissions(emissions_data)
+
+    # The rows are the same, but in a different order, which test_long_format_row_order pins down
+    pd.testing.assert_frame_equal(long_emissions.sort_index(), expected.sort_index())
+
+
+def test_long_format_row_order(emissions_data):
+    long_emissions = get_long_format_sa1_emissions(emissions_data)
+
+    # Rows are grouped by SA1 in the order of the sheet, then by vehicle type in sorted order
+    expected_index = pd.MultiIndex.from_product([emissions_data.index, sorted(VEHICLE_TYPES)],
+                                                names=["SA12018_V1_00", "Vehicle Type"])
+    pd.testing.assert_index_equal(long_emissions.index, expected_index)
+    # Variables are in sorted order, as the melt implementation left them
+    assert list(long_emissions.columns) == ["CO2 (Tonnes/Year)", "VKT ('000 km/Year)"]
+
+
+def test_long_format_drops_unlabelled_columns(emissions_data):
+    with_unlabelled_column = emissions_data.copy()
+    with_unlabelled_column[("Total", "Unnamed: 7_level_1")] = 1.0
+
+    long_emissions = get_long_format_sa1_emissions(with_unlabelled_column)
+
+    pd.testing.assert_frame_equal(long_emissions, get_long_format_sa1_emissions(emissions_data))